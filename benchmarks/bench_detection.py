@@ -0,0 +1,199 @@
+"""
+Micro-benchmarks of the detection pipeline.
+
+Runs the blocking rules, the single detectors and the login response
+handling on synthetic flows (see flows.py) and reports operations per
+second, p50/p99 latency and memory allocated per operation (tracemalloc).
+
+    python benchmarks/bench_detection.py --output before.json
+    python benchmarks/bench_detection.py --output after.json --compare before.json
+
+Results are saved as JSON so runs from different commits can be compared.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), "src"))
+
+import config
+
+# Keep the benchmarks off the disk and the console
+config.publish({"STATE_BACKEND": "memory", "ENABLE_LOGGING": False, "LOG_LEVEL": "ERROR"}, source="benchmark")
+
+import security_utils
+from brute_force import handle_login_response
+from detection.command_injection import match_command_injection_in
+from detection.login_detection import is_failed_login
+from detection.sql_injection import match_sql_injection_in
+from detection.test_string import detect_test_string_in
+from persistence.ip_blocking import clear_blocked_ips
+from request_view import InspectedText
+
+import flows
+
+def _values(values):
+    # A new InspectedText each time, so its decoded forms are not reused
+    return lambda n: InspectedText(values[n % len(values)])
+
+# name -> (function under test, factory of its argument)
+BENCHMARKS = {
+    "apply_blocking_rules/benign_browsing": (security_utils.apply_blocking_rules, flows.benign_browsing),
+    "apply_blocking_rules/large_form": (security_utils.apply_blocking_rules, flows.large_form),
+    "apply_blocking_rules/api_headers": (security_utils.apply_blocking_rules, flows.api_headers),
+    "apply_blocking_rules/attack_payloads": (security_utils.apply_blocking_rules, flows.attack_payloads),
+    "sql_injection/benign": (match_sql_injection_in, _values(flows.BENIGN_VALUES)),
+    "sql_injection/attack": (match_sql_injection_in, _values(flows.ATTACK_VALUES)),
+    "command_injection/benign": (match_command_injection_in, _values(flows.BENIGN_VALUES)),
+    "command_injection/attack": (match_command_injection_in, _values(flows.ATTACK_VALUES)),
+    "test_string/benign": (detect_test_string_in, _values(flows.BENIGN_VALUES)),
+    "is_failed_login/login_burst": (is_failed_login, flows.login_burst),
+    "handle_login_response/login_burst": (handle_login_response, flows.login_burst),
+}
+
+def measure_latency(function, factory, ops, warmup):
+    """
+    Call function once per argument and return the latencies in nanoseconds
+    The arguments are built before the clock starts
+    """
+    for n in range(warmup):
+        function(factory(n))
+    arguments = [factory(warmup + n) for n in range(ops)]
+    latencies = []
+    clock = time.perf_counter_ns
+    gc.collect()
+    for argument in arguments:
+        start = clock()
+        function(argument)
+        latencies.append(clock() - start)
+    return latencies
+
+def measure_allocations(function, factory, ops):
+    """
+    Average peak of memory allocated during one call, and the average
+    memory still held after it (e.g. blocks, counters and cache entries)
+    """
+    arguments = [factory(n) for n in range(ops)]
+    retained = 0
+    peak = 0
+    tracemalloc.start()
+    try:
+        for argument in arguments:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function(argument)
+            after, call_peak = tracemalloc.get_traced_memory()
+            peak += call_peak - before
+            retained += after - before
+    finally:
+        tracemalloc.stop()
+    return peak / ops, retained / ops
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run_benchmark(name, ops, warmup, alloc_ops):
+    function, factory = BENCHMARKS[name]
+    # Each benchmark starts without blocks, failed logins or cached verdicts
+    clear_blocked_ips()
+    security_utils.HEADER_VERDICTS.clear()
+    latencies = sorted(measure_latency(function, factory, ops, warmup))
+    total = sum(latencies)
+    result = {
+        "ops": ops,
+        "ops_per_sec": ops / (total / 1e9) if total else 0.0,
+        "p50_us": percentile(latencies, 0.50) / 1000,
+        "p99_us": percentile(latencies, 0.99) / 1000,
+    }
+    if alloc_ops:
+        peak, retained = measure_allocations(function, factory, alloc_ops)
+        result["peak_bytes_per_op"] = peak
+        result["retained_bytes_per_op"] = retained
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    print(f"{'benchmark':<40} {'ops/sec':>12} {'p50 us':>10} {'p99 us':>10} {'peak B/op':>12}")
+    for name, result in results.items():
+        alloc = result.get("peak_bytes_per_op")
+        print(f"{name:<40} {result['ops_per_sec']:>12.0f} {result['p50_us']:>10.1f} {result['p99_us']:>10.1f} "
+              f"{'-' if alloc is None else format(alloc, '.0f'):>12}")
+
+def compare_results(baseline, results, threshold):
+    """
+    Print the change against a saved run
+    Returns the names of benchmarks that got slower by more than threshold
+    """
+    print()
+    print(f"Compared to {baseline.get('commit') or 'baseline'} ({baseline.get('timestamp', '?')}):")
+    print(f"{'benchmark':<40} {'ops/sec':>10} {'p50':>10} {'p99':>10}")
+    regressions = []
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"{name:<40} {'new':>10}")
+            continue
+        speed = result["ops_per_sec"] / old["ops_per_sec"] - 1 if old["ops_per_sec"] else 0.0
+        p50 = result["p50_us"] / old["p50_us"] - 1 if old["p50_us"] else 0.0
+        p99 = result["p99_us"] / old["p99_us"] - 1 if old["p99_us"] else 0.0
+        marker = ""
+        if speed < -threshold:
+            regressions.append(name)
+            marker = "  SLOWER"
+        print(f"{name:<40} {speed:>+10.1%} {p50:>+10.1%} {p99:>+10.1%}{marker}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the WAF detection pipeline")
+    parser.add_argument("--ops", type=int, default=2000, help="timed calls per benchmark")
+    parser.add_argument("--warmup", type=int, default=200, help="untimed calls before measuring")
+    parser.add_argument("--alloc-ops", type=int, default=100,
+                        help="calls traced for allocations per benchmark (0 skips tracing)")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown in ops/sec reported as a regression (default 0.10)")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = {}
+    for name in names:
+        results[name] = run_benchmark(name, args.ops, args.warmup, args.alloc_ops)
+    print_results(results)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"ops": args.ops, "warmup": args.warmup, "alloc_ops": args.alloc_ops},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_results(baseline, results, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""
+End-to-end load test of the proxy against a local stand-in upstream.
+
+Starts the dummy upstream (upstream.py) and the proxy (start_proxy, or
+the supervisor with --workers), then sends a fixed rate of requests
+through the proxy:
+
+    benign      page views and API calls that must pass
+    login       successful logins that must pass
+    attack      injection and test string payloads that must get a 403
+    bruteforce  wrong passwords from a set of clients that must be blocked
+                after MAX_LOGIN_ATTEMPTS failures
+
+    python benchmarks/load_test.py --rps 200 --duration 30 --mix benign=80,login=5,attack=10,bruteforce=5
+
+Reports throughput, latency percentiles per traffic class, whether every
+request got the expected verdict and the proxy's RSS over time. Each
+class sends from its own loopback addresses (127.0.x.y), so brute force
+blocks do not hit the benign clients. Latency is measured from the time
+a request was due, so a proxy that falls behind shows it.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+from urllib.parse import urlencode
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), "src"))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import variables
+from flows import ATTACKS
+from upstream import run_upstream, CORRECT_PASSWORD
+
+PROXY_PORT = 8080  # start_proxy always listens here
+DEFAULT_MIX = "benign=80,login=5,attack=10,bruteforce=5"
+
+# Source address prefix of each traffic class
+CLIENT_NETWORKS = {"benign": "127.0.0", "login": "127.0.1", "attack": "127.0.2", "bruteforce": "127.0.3"}
+
+def _run_proxy(workers, log_path, settings):
+    """
+    Proxy process: apply the settings, then run start_proxy or the supervisor
+    """
+    log_file = open(log_path, "a")
+    os.dup2(log_file.fileno(), 1)
+    os.dup2(log_file.fileno(), 2)
+    import config
+    config.publish(settings, source="load test")
+    if workers > 1:
+        from supervisor import run_supervisor
+        run_supervisor(workers)
+    else:
+        from proxy_runner import start_proxy
+        try:
+            asyncio.run(start_proxy())
+        except KeyboardInterrupt:
+            pass
+
+def _process_tree_rss(pid):
+    """
+    Resident memory in bytes of a process and its children (Linux only)
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+def _wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+class TrafficClass:
+    """
+    Requests of one kind and what was observed for them
+    """
+    def __init__(self, name):
+        self.name = name
+        self.sent = 0
+        self.errors = 0
+        self.statuses = {}
+        self.latencies = []
+        self.unexpected = 0  # Requests that did not get the expected verdict
+
+    def record(self, status, latency, expected):
+        if status is None:
+            self.errors += 1
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        self.latencies.append(latency)
+        if not expected:
+            self.unexpected += 1
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000
+        return {
+            "sent": self.sent,
+            "completed": len(latencies),
+            "errors": self.errors,
+            "unexpected": self.unexpected,
+            "statuses": self.statuses,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": latencies[-1] * 1000 if latencies else None,
+        }
+
+class LoadGenerator:
+    """
+    Sends requests through the proxy at a fixed rate over keep-alive
+    connections, at most max_connections at a time
+    """
+    def __init__(self, proxy_port, upstream_port, max_connections, timeout, clients):
+        self.proxy_port = proxy_port
+        self.host = f"127.0.0.1:{upstream_port}"
+        self.timeout = timeout
+        self.clients = clients
+        self._slots = asyncio.Semaphore(max_connections)
+        self._idle = {}  # source address -> idle connections
+        self._brute_force_attempts = {}  # client -> failed logins sent
+        self.brute_force_passed = {}  # client -> failed logins the proxy let through
+        self.classes = {name: TrafficClass(name) for name in CLIENT_NETWORKS}
+
+    def build_request(self, kind, n):
+        """
+        Returns (source address, request bytes, expectation, client)
+        expectation is called with the status code (None if the request failed)
+        """
+        client = n % self.clients
+        source = f"{CLIENT_NETWORKS[kind]}.{client + 1}"
+        headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) load-test", "Accept": "text/html"}
+        body = b""
+        method = "GET"
+        if kind == "benign":
+            path = f"/api/items/{n}" if n % 3 == 0 else f"/catalog/item/{n % 500}?color=blue&page={n % 7}"
+            expected = lambda status: status == 200
+        elif kind == "login":
+            method, path = "POST", "/login"
+            body = urlencode({"username": f"user{client}", "password": CORRECT_PASSWORD}).encode()
+            expected = lambda status: status == 302
+        elif kind == "attack":
+            location, payload = ATTACKS[n % len(ATTACKS)]
+            path = "/search"
+            if location == "query":
+                path += "?" + payload
+            elif location == "form":
+                method = "POST"
+                body = urlencode(payload).encode()
+            else:
+                headers[payload[0]] = payload[1]
+            expected = lambda status: status == 403
+        else:
+            method, path = "POST", "/login"
+            body = urlencode({"username": "admin", "password": f"guess-{n}"}).encode()
+            # Checked per client once the run is over
+            expected = lambda status: status in (200, 429)
+        if method == "POST":
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        lines = [f"{method} http://{self.host}{path} HTTP/1.1", f"Host: {self.host}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append(f"Content-Length: {len(body)}")
+        return source, ("\r\n".join(lines) + "\r\n\r\n").encode() + body, expected, client
+
+    async def send(self, kind, n, due):
+        source, request, expected, client = self.build_request(kind, n)
+        traffic = self.classes[kind]
+        traffic.sent += 1
+        async with self._slots:
+            try:
+                status = await asyncio.wait_for(self._exchange(source, request), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                status = None
+        traffic.record(status, time.monotonic() - due, expected(status))
+        if kind == "bruteforce" and status is not None:
+            self._brute_force_attempts[client] = self._brute_force_attempts.get(client, 0) + 1
+            if status == 200:
+                self.brute_force_passed[client] = self.brute_force_passed.get(client, 0) + 1
+
+    async def _exchange(self, source, request):
+        idle = self._idle.setdefault(source, [])
+        if idle:
+            reader, writer = idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.proxy_port, local_addr=(source, 0))
+        try:
+            writer.write(request)
+            status, keep_alive = await self._read_response(reader)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return status
+
+    async def _read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("proxy closed the connection")
+        status = int(status_line.split()[1])
+        length = 0
+        chunked = False
+        keep_alive = True
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "transfer-encoding" and "chunked" in value:
+                chunked = True
+            elif name == "connection" and value == "close":
+                keep_alive = False
+        if chunked:
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await reader.readexactly(length)
+        return status, keep_alive
+
+    def brute_force_summary(self, max_attempts):
+        """
+        Each client must get exactly max_attempts - 1 failed logins through
+        """
+        clients = [client for client, attempts in self._brute_force_attempts.items() if attempts >= max_attempts]
+        wrong = {client: self.brute_force_passed.get(client, 0) for client in clients
+                 if self.brute_force_passed.get(client, 0) != max_attempts - 1}
+        return {"clients_checked": len(clients), "expected_passed": max_attempts - 1,
+                "clients_wrong": len(wrong), "passed_by_wrong_clients": wrong}
+
+def parse_mix(text):
+    mix = {}
+    for entry in text.split(","):
+        name, _, weight = entry.partition("=")
+        name = name.strip()
+        if name not in CLIENT_NETWORKS:
+            raise argparse.ArgumentTypeError(f"unknown traffic class: {name}")
+        mix[name] = float(weight)
+    return mix
+
+async def run_load(args, proxy_pid):
+    generator = LoadGenerator(PROXY_PORT, args.upstream_port, args.connections, args.timeout, args.clients)
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    chooser = random.Random(args.seed)
+    rss_samples = []
+
+    async def sample_rss():
+        while True:
+            if proxy_pid is not None:
+                rss_samples.append((round(time.monotonic() - start, 1), _process_tree_rss(proxy_pid)))
+            await asyncio.sleep(args.sample_interval)
+
+    start = time.monotonic()
+    sampler = asyncio.create_task(sample_rss())
+    tasks = set()
+    interval = 1.0 / args.rps
+    total = int(args.rps * args.duration)
+    for n in range(total):
+        due = start + n * interval
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(generator.send(chooser.choices(names, weights)[0], n, due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    send_time = time.monotonic() - start
+    if tasks:
+        await asyncio.wait(tasks)
+    elapsed = time.monotonic() - start
+    sampler.cancel()
+    if proxy_pid is not None:
+        rss_samples.append((round(elapsed, 1), _process_tree_rss(proxy_pid)))
+
+    completed = sum(len(traffic.latencies) for traffic in generator.classes.values())
+    return {
+        "target_rps": args.rps,
+        "duration": args.duration,
+        "send_seconds": send_time,
+        "elapsed_seconds": elapsed,
+        "achieved_rps": completed / elapsed if elapsed else 0.0,
+        "classes": {name: traffic.summary() for name, traffic in generator.classes.items() if traffic.sent},
+        "brute_force": generator.brute_force_summary(variables.MAX_LOGIN_ATTEMPTS),
+        "rss_bytes": rss_samples,
+    }
+
+def print_report(report):
+    print(f"\nTarget {report['target_rps']} rps for {report['duration']}s, "
+          f"achieved {report['achieved_rps']:.1f} rps ({report['elapsed_seconds']:.1f}s elapsed)")
+    print(f"{'class':<12} {'sent':>7} {'errors':>7} {'wrong':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}  statuses")
+    for name, summary in report["classes"].items():
+        values = [summary[key] for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")]
+        print(f"{name:<12} {summary['sent']:>7} {summary['errors']:>7} {summary['unexpected']:>7} "
+              + " ".join(f"{value:>8.1f}" if value is not None else f"{'-':>8}" for value in values)
+              + "  " + ", ".join(f"{status}: {count}" for status, count in sorted(summary["statuses"].items())))
+    brute_force = report["brute_force"]
+    if brute_force["clients_checked"]:
+        print(f"Brute force: {brute_force['clients_checked']} clients reached the limit, "
+              f"{brute_force['clients_wrong']} did not get exactly {brute_force['expected_passed']} failed logins through")
+    if report["rss_bytes"]:
+        rss = [value for _, value in report["rss_bytes"]]
+        print(f"Proxy RSS: start {rss[0] / 2**20:.1f} MB, max {max(rss) / 2**20:.1f} MB, end {rss[-1] / 2**20:.1f} MB")
+        print("  " + "  ".join(f"{seconds}s={value / 2**20:.0f}MB" for seconds, value in report["rss_bytes"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the WAF proxy against a local upstream")
+    parser.add_argument("--rps", type=float, default=100, help="requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"traffic classes and weights (default {DEFAULT_MIX})")
+    parser.add_argument("--connections", type=int, default=50, help="most requests in flight at once")
+    parser.add_argument("--clients", type=int, default=20, help="source addresses per traffic class")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds before a request counts as failed")
+    parser.add_argument("--workers", type=int, default=1, help="proxy worker processes (more than 1 uses the supervisor)")
+    parser.add_argument("--upstream-port", type=int, default=9090)
+    parser.add_argument("--no-proxy", action="store_true", help=f"use a proxy already listening on port {PROXY_PORT}")
+    parser.add_argument("--proxy-log", default=os.devnull, help="file receiving the proxy's output")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between RSS samples")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    upstream = context.Process(target=run_upstream, args=(args.upstream_port,), daemon=True)
+    upstream.start()
+    processes.append(upstream)
+    proxy = None
+    try:
+        if not args.no_proxy:
+            # No files, no persisted blocks and no per-request console output
+            settings = {"STATE_BACKEND": "memory", "ENABLE_LOGGING": False, "ENABLE_WEBINTERFACE": False,
+                        "LOG_LEVEL": "WARNING"}
+            proxy = context.Process(target=_run_proxy, args=(args.workers, args.proxy_log, settings))
+            proxy.start()
+            processes.append(proxy)
+        if not _wait_for_port(args.upstream_port, 10) or not _wait_for_port(PROXY_PORT, 30):
+            sys.exit("Upstream or proxy did not start")
+
+        report = asyncio.run(run_load(args, proxy.pid if proxy is not None else None))
+        print_report(report)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"\nReport written to {args.output}")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.join(10)
+
+if __name__ == "__main__":
+    main()
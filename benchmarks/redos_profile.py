@@ -0,0 +1,270 @@
+"""
+Worst-case cost of every signature rule on adversarial input.
+
+    python benchmarks/redos_profile.py
+    python benchmarks/redos_profile.py --engine re2 --filter sql --output profile.json
+
+For each signature of the rule file (RULES_FILE), inputs are built from
+the rule's own pattern: its literals repeated with separators that keep
+partial matches alive, pairs of literals, and random mixes of literals,
+separators and printable characters. Every input is screened at the
+smallest size; the slowest ones are timed at each size against the bare
+rule, and the growth between the two largest sizes estimates the
+complexity (n^1 is linear, n^2 quadratic).
+
+The worst input at the largest size is then run through the rule's
+SignatureSet.match, which applies MAX_MATCH_WINDOW and MATCH_TIME_BUDGET,
+so the report shows both what a rule costs on its own and what it costs
+in the proxy. --max-seconds makes the run fail if that capped cost is
+over a limit.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import string
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), "src"))
+
+import config
+
+config.publish({"STATE_BACKEND": "memory", "ENABLE_LOGGING": False, "LOG_LEVEL": "ERROR"}, source="benchmark")
+
+SEPARATORS = ["", " ", "  ", "\t", "'", "=", "(", "/*", "1"]
+FILLER = string.ascii_letters + string.digits + string.punctuation + " "
+
+# Inputs kept from the screening for the timing at every size
+WORST_PER_RULE = 3
+
+def _sre():
+    try:
+        from re import _parser as sre_parse, _constants as sre_constants
+    except ImportError:  # Python < 3.11
+        import sre_parse
+        import sre_constants
+    return sre_parse, sre_constants
+
+def pattern_tokens(pattern, flags):
+    """
+    Returns the literal runs of a pattern and a character of each of its
+    character classes, the material the adversarial inputs are built from
+    """
+    sre_parse, sre_constants = _sre()
+    tokens = set()
+    class_chars = set()
+
+    def walk(parsed):
+        run = []
+        for op, av in parsed:
+            if op is sre_constants.LITERAL:
+                run.append(chr(av))
+                continue
+            if run:
+                tokens.add("".join(run))
+                run = []
+            if op is sre_constants.SUBPATTERN:
+                walk(av[-1])
+            elif op is sre_constants.BRANCH:
+                for branch in av[1]:
+                    walk(branch)
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                walk(av[2])
+            elif op is sre_constants.IN:
+                for item_op, item_av in av:
+                    if item_op is sre_constants.LITERAL:
+                        class_chars.add(chr(item_av))
+                    elif item_op is sre_constants.RANGE:
+                        class_chars.add(chr(item_av[0]))
+                    elif item_op is sre_constants.CATEGORY:
+                        class_chars.add({sre_constants.CATEGORY_SPACE: " ",
+                                         sre_constants.CATEGORY_DIGIT: "1"}.get(item_av, "a"))
+            elif op is sre_constants.ANY:
+                class_chars.add("a")
+        if run:
+            tokens.add("".join(run))
+
+    walk(sre_parse.parse(pattern, flags))
+    # Longest first: the most specific literals make the best seeds
+    return sorted(tokens, key=lambda token: (-len(token), token))[:8], sorted(class_chars)
+
+def _fill(unit, size):
+    if not unit:
+        return ""
+    return (unit * (size // len(unit) + 1))[:size]
+
+def adversarial_inputs(pattern, flags, rounds, seed):
+    """
+    Returns a list of (description, function of size -> text)
+    """
+    tokens, class_chars = pattern_tokens(pattern, flags)
+    separators = SEPARATORS + [char for char in class_chars if char not in SEPARATORS]
+    inputs = []
+    for token in tokens:
+        for separator in separators:
+            unit = token + separator
+            inputs.append((f"repeat {unit!r}", lambda size, unit=unit: _fill(unit, size)))
+        inputs.append((f"open {token!r}", lambda size, token=token: token + " " + _fill("a", size - len(token) - 1)))
+    for first in tokens:
+        for second in tokens:
+            if first == second:
+                continue
+            for separator in (" ", "'", ""):
+                unit = first + separator + second + separator
+                inputs.append((f"repeat {unit!r}", lambda size, unit=unit: _fill(unit, size)))
+
+    pieces = tokens + separators + list(class_chars)
+    rng = random.Random(seed)
+    for index in range(rounds):
+        # A fuzz unit of a few pieces and random characters, repeated to size
+        parts = []
+        for _ in range(rng.randint(2, 8)):
+            if pieces and rng.random() < 0.7:
+                parts.append(rng.choice(pieces))
+            else:
+                parts.append(rng.choice(FILLER))
+        unit = "".join(parts)
+        inputs.append((f"fuzz {unit!r}", lambda size, unit=unit: _fill(unit, size)))
+    return inputs
+
+def time_call(function, text, repeat=5):
+    """
+    Seconds of the fastest call; slow calls are not repeated
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        if elapsed > 0.01:
+            break
+    return best
+
+def growth(sizes, seconds):
+    """
+    Exponent k of seconds ~ size^k between the two largest sizes measured,
+    or None when the times are too short to tell
+    """
+    measured = [(size, elapsed) for size, elapsed in zip(sizes, seconds) if elapsed is not None]
+    if len(measured) < 2:
+        return None
+    (small_size, small), (large_size, large) = measured[-2:]
+    if small < 0.0001:
+        return None
+    return math.log(large / small) / math.log(large_size / small_size)
+
+def signature_sets(rules_file=None):
+    """
+    Returns the signature sets of the rule file by name
+    """
+    from detection.rules import load_rules
+
+    return load_rules(rules_file).signatures
+
+def profile_rule(signature_set, position, sizes, rounds, seed, max_search):
+    rule_id, pattern = signature_set.rules[position]
+    search = signature_set._searches[position][1]
+    inputs = adversarial_inputs(pattern, signature_set.flags, rounds, seed)
+
+    # Screen everything at the smallest size, keep the slowest
+    screened = sorted(((time_call(search, make(sizes[0]), repeat=1), description, make)
+                       for description, make in inputs), key=lambda item: item[0], reverse=True)
+
+    worst = None
+    for _, description, make in screened[:WORST_PER_RULE]:
+        seconds = []
+        for size in sizes:
+            if seconds and seconds[-1] is not None and seconds[-1] > max_search:
+                seconds.append(None)  # Too slow to grow further
+                continue
+            seconds.append(time_call(search, make(size)))
+        largest = max(elapsed for elapsed in seconds if elapsed is not None)
+        if worst is None or largest > worst["worst_seconds"]:
+            worst = {"input": description, "seconds": seconds, "worst_seconds": largest, "make": make}
+
+    # The same input through the set, with its windows and time budget
+    text = worst.pop("make")(sizes[-1])
+    start = time.perf_counter()
+    verdict = signature_set.match(text)
+    worst["capped_seconds"] = time.perf_counter() - start
+    worst["capped_verdict"] = verdict
+    worst["growth"] = growth(sizes, worst["seconds"])
+    worst["rule"] = rule_id
+    worst["pattern"] = pattern
+    worst["linear_engine"] = signature_set._searches[position][2]
+    return worst
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.2f}"
+
+def print_results(results, sizes):
+    header = f"{'rule':<10} {'growth':>7} " + " ".join(f"{f'{size} ms':>10}" for size in sizes)
+    print(header + f" {'capped ms':>10}  worst input")
+    for result in results:
+        exponent = "-" if result["growth"] is None else f"n^{result['growth']:.1f}"
+        times = " ".join(f"{_ms(elapsed):>10}" for elapsed in result["seconds"])
+        capped = _ms(result["capped_seconds"])
+        if result["capped_verdict"] is not None and result["capped_verdict"].endswith(":budget"):
+            capped += "*"
+        print(f"{result['rule']:<10} {exponent:>7} {times} {capped:>10}  {result['input'][:60]}")
+    if any((result["capped_verdict"] or "").endswith(":budget") for result in results):
+        print("\n* ran out of MATCH_TIME_BUDGET")
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the signature rules on adversarial input")
+    parser.add_argument("--engine", choices=["re", "re2"], help="REGEX_ENGINE to compile the rules with")
+    parser.add_argument("--rules", help="rule file to profile instead of RULES_FILE")
+    parser.add_argument("--sizes", default="256,1024,4096", help="input lengths, comma separated")
+    parser.add_argument("--rounds", type=int, default=200, help="random fuzz inputs per rule")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the fuzz inputs")
+    parser.add_argument("--filter", default="", help="only profile rules whose id contains this")
+    parser.add_argument("--max-search", type=float, default=2.0,
+                        help="seconds after which larger sizes of an input are skipped")
+    parser.add_argument("--max-seconds", type=float,
+                        help="fail if a rule's capped cost on its worst input is over this")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.engine:
+        config.publish({"REGEX_ENGINE": args.engine}, source="command line")
+    settings = config.current()
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+
+    results = []
+    for signature_set in signature_sets(args.rules).values():
+        for position, (rule_id, _) in enumerate(signature_set.rules):
+            if args.filter not in rule_id:
+                continue
+            results.append(profile_rule(signature_set, position, sizes, args.rounds, args.seed, args.max_search))
+    results.sort(key=lambda result: result["worst_seconds"], reverse=True)
+
+    print(f"Engine {settings.REGEX_ENGINE}, MAX_MATCH_WINDOW {settings.MAX_MATCH_WINDOW}, "
+          f"MATCH_TIME_BUDGET {settings.MATCH_TIME_BUDGET}s\n")
+    print_results(results, sizes)
+
+    if args.output:
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "engine": settings.REGEX_ENGINE,
+            "sizes": sizes,
+            "settings": {"max_match_window": settings.MAX_MATCH_WINDOW,
+                         "match_window_overlap": settings.MATCH_WINDOW_OVERLAP,
+                         "match_time_budget": settings.MATCH_TIME_BUDGET},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.max_seconds is not None:
+        over = [result["rule"] for result in results if result["capped_seconds"] > args.max_seconds]
+        if over:
+            print(f"\nOver {args.max_seconds}s: {', '.join(over)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
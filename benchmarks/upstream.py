@@ -0,0 +1,69 @@
+"""
+Stand-in for the protected web servers, used by the load test.
+
+    python benchmarks/upstream.py [port]
+
+POST /login (and the other login URLs the WAF knows) accepts the form
+fields username and password: the password "correct-password" is
+answered with a redirect to /dashboard, any other with a 200 page saying
+"Invalid password". /api/ paths answer with JSON, everything else with a
+small HTML page.
+"""
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_PORT = 9090
+CORRECT_PASSWORD = "correct-password"
+LOGIN_PATHS = ("/login", "/signin", "/account/login")
+
+PAGE = b"<!DOCTYPE html><html><head><title>Shop</title></head><body>" + b"<p>Product</p>" * 50 + b"</body></html>"
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._handle(b"")
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length") or 0)
+        self._handle(self.rfile.read(length))
+
+    def _handle(self, body):
+        path = urlsplit(self.path).path
+        if self.command == "POST" and path in LOGIN_PATHS:
+            form = parse_qs(body.decode("utf-8", "replace"))
+            if form.get("password", [""])[0] == CORRECT_PASSWORD:
+                self._send(302, "text/html", b"", {"Location": "/dashboard"})
+            else:
+                self._send(200, "text/html", b"<html><body><p>Invalid password</p></body></html>")
+        elif path.startswith("/api/"):
+            self._send(200, "application/json", json.dumps({"ok": True, "path": path}).encode())
+        else:
+            self._send(200, "text/html", PAGE)
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_upstream(port=DEFAULT_PORT):
+    server = ThreadingHTTPServer(("127.0.0.1", port), UpstreamHandler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    run_upstream(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT)
@@ -0,0 +1,168 @@
+import codecs
+from urllib.parse import parse_qsl
+
+from config import get_flow_config
+from detection.rules import get_rules
+from request_view import InspectedText, get_request_view
+from waf_logger import get_logger
+
+_blocked_log = get_logger("blocked")
+
+# Key under which the inspector of a streamed body is stored in flow.metadata
+BODY_INSPECTOR_KEY = "waf_body_inspector"
+
+# Characters of the previous chunk scanned again with the next one, so a
+# marker split across two chunks is still found. Covers percent-encoded markers.
+OVERLAP = 256
+
+class BodyInspector:
+    """
+    Inspects a request body chunk by chunk while mitmproxy streams it upstream.
+
+    Set as flow.request.stream, it gets every chunk before it is forwarded.
+    Each chunk is scanned together with the tail of the previous one. For
+    url-encoded forms every complete field is checked like the fields of a
+    buffered body; a field longer than STREAM_FIELD_LIMIT is scanned in parts.
+    The bytes of a form field are held back until the field is complete (or
+    scanned in parts), so nothing is forwarded before it was inspected.
+    The body and form rules, and the settings, are those active when the
+    body started, even if new ones are loaded while it streams.
+    Once a rule fires, nothing more is forwarded and verdict is set; the proxy
+    add-on then kills the flow. Only MAX_INSPECT_BODY_SIZE bytes are scanned;
+    OVERSIZED_BODY_POLICY decides what happens to the rest.
+    """
+    def __init__(self, flow):
+        view = get_request_view(flow)
+        self.is_form = view.content_type.startswith("application/x-www-form-urlencoded")
+        self.config = get_flow_config(flow)
+        self.max_size = self.config.MAX_INSPECT_BODY_SIZE
+        self.rules = get_rules()
+        self.inspected = 0  # Bytes scanned so far
+        self.forwarded = 0  # Bytes passed on so far
+        self.verdict = None  # (location, field name, rule verdict) once a rule fired
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._overlap = ""
+        self._field = ""  # Incomplete form field carried over to the next chunk
+        self._held = []  # Bytes of that field, passed on once it was inspected
+
+    def __call__(self, data):
+        if self.verdict is not None:
+            return b""
+        if not data:
+            # End of the body: the last form field is complete
+            self._inspect_form_text(self._decoder.decode(b"", final=True), final=True)
+            if self.verdict is not None:
+                return b""
+            return self._release(b"")
+
+        remaining = self.max_size - self.inspected
+        if remaining <= 0:
+            return self._oversized(data)
+
+        chunk = data[:remaining]
+        self.inspected += len(chunk)
+        text = self._decoder.decode(chunk)
+        field_inspected = self._inspect_text(text)
+        if self.verdict is not None:
+            return b""
+        if len(data) > remaining:
+            return self._oversized(data)
+        if self.is_form and not field_inspected:
+            # The bytes of the field still being read are only passed on
+            # once the whole field was inspected
+            cut = data.rfind(b"&") + 1
+            if not cut:
+                self._held.append(data)
+                return b""
+            held = data[cut:]
+            data = self._release(data[:cut])
+            self._held.append(held)
+            return data
+        return self._release(data)
+
+    def _release(self, data):
+        """
+        The held back bytes followed by data, counted as forwarded
+        """
+        if self._held:
+            data = b"".join(self._held) + data
+            self._held = []
+        self.forwarded += len(data)
+        return data
+
+    def _oversized(self, data):
+        if self.config.OVERSIZED_BODY_POLICY == "block":
+            self._block("body", None, None)
+            return b""
+        return self._release(data)
+
+    def _inspect_text(self, text):
+        """
+        Returns True if the form field still being read was inspected as
+        far as it goes
+        """
+        # Check the raw content string
+        window = self._overlap + text
+        verdict = self.rules.check("body", InspectedText(window))
+        if verdict is not None:
+            self._block("body", None, verdict)
+            return True
+        self._overlap = window[-OVERLAP:]
+        if self.is_form:
+            return self._inspect_form_text(text)
+        return True
+
+    def _inspect_form_text(self, text, final=False):
+        """
+        Returns True if the field carried over to the next chunk was
+        scanned in parts, so none of its bytes need to be held back
+        """
+        if not self.is_form or self.verdict is not None:
+            return True
+        fields = (self._field + text).split("&")
+        # The last field may continue in the next chunk
+        self._field = "" if final else fields.pop()
+        for field in fields:
+            if self._inspect_form_field(field):
+                return True
+
+        if len(self._field) > self.config.STREAM_FIELD_LIMIT:
+            # Scan what there is, keeping the name and enough of the value
+            # to match across the cut
+            if not self._inspect_form_field(self._field):
+                name, separator, value = self._field.partition("=")
+                if separator:
+                    self._field = name[:OVERLAP] + "=" + value[-OVERLAP:]
+                else:
+                    self._field = self._field[-OVERLAP:]
+            return True
+        return not self._field
+
+    def _inspect_form_field(self, field):
+        for form_name, form_value in parse_qsl(field, keep_blank_values=True):
+            verdict = self.rules.check("form", InspectedText(form_value))
+            if verdict is not None:
+                self._block("form", form_name, verdict)
+                return True
+        return False
+
+    def block_reason(self):
+        """
+        The verdict as "location/rule", like the reasons of the blocking rules
+        """
+        location, _, verdict = self.verdict
+        if verdict is None:
+            return "body/too_large"
+        return self.rules.reason(location, verdict)
+
+    def _block(self, location, name, verdict):
+        """
+        verdict is that of the rule that fired, None for a body that is too large
+        """
+        self.verdict = (location, name, verdict)
+        if verdict is None:
+            _blocked_log.info("BLOCKED: Request body larger than %s bytes", self.max_size)
+        else:
+            rule, found = verdict
+            _blocked_log.info("BLOCKED: %s (%s) in streamed %s%s", rule.title, found, location,
+                              f" field '{name}'" if name else "")
@@ -2,86 +2,102 @@ import time
 from collections import defaultdict
 from mitmproxy import http
 
-# Import the variables module instead of individual variables
-import variables
+import metrics
+from config import current, get_flow_config
+from request_view import BLOCK_REASON_KEY
+from detection.literal_matcher import TermListMatcher
+from waf_logger import get_logger, DEBUG
 from persistence.ip_blocking import is_ip_blocked_for_domain, block_ip_for_domain
-from detection.login_detection import is_login_request, is_failed_login, record_failed_login, get_domain
+from detection.login_detection import get_login_info, is_failed_login, record_failed_login, LOGIN_SCAN_BYTES_KEY
+
+_log = get_logger("brute_force")
+_blocked_log = get_logger("blocked")
+
+FAILED_LOGINS_METRIC = metrics.series("waf_failed_logins_total")
+
+# Rebuilt whenever a new SUSPICIOUS_COOKIE_TERMS is published (e.g. from the web interface)
+SUSPICIOUS_COOKIE_MATCHER = TermListMatcher(lambda: current().SUSPICIOUS_COOKIE_TERMS)
+
+def find_suspicious_cookie_term(cookie_value):
+    """
+    Returns the first suspicious term found in the cookie value, or None
+    """
+    return SUSPICIOUS_COOKIE_MATCHER.search(cookie_value)
 
 def is_standard_cookie_format(cookie_value):
     """
     Returns True if the cookie value appears to be in standard format without malicious code
     """
-    # If the cookie contains obvious shell commands, return False
-    for term in variables.SUSPICIOUS_COOKIE_TERMS:
-        if term in cookie_value.lower():
-            return False
-            
-    # Otherwise, consider it a legitimate cookie
-    return True
+    # If the cookie contains obvious shell commands, it is not a standard cookie
+    return find_suspicious_cookie_term(cookie_value) is None
 
 def check_brute_force(flow):
     """
     Tracks login attempts and checks if the current IP should be blocked
     Returns True if the IP should be blocked
     """
-    client_ip = flow.client_conn.address[0]
-    domain = get_domain(flow)
+    info = get_login_info(flow)
+    client_ip, domain = info.client_ip, info.domain
     
     # ALWAYS log the current state for debugging
-    print(f"BRUTE FORCE CHECK for IP {client_ip} on domain {domain} - URL: {flow.request.url}")
+    _log.debug("BRUTE FORCE CHECK for IP %s on domain %s - URL: %s", client_ip, domain, flow.request.url)
     
     # Check if the IP is already blocked for this domain
     is_blocked, time_left = is_ip_blocked_for_domain(client_ip, domain)
     if is_blocked:
-        print(f"IP {client_ip} is BLOCKED for domain {domain}. Time remaining: {time_left} seconds")
+        _log.debug("IP %s is BLOCKED for domain %s. Time remaining: %s seconds", client_ip, domain, time_left)
+        if time_left is None:
+            return True, f"Your network is blocked on {domain}."
         return True, f"Too many failed login attempts on {domain}. Try again in {time_left} seconds."
     
     # For login requests, we only track attempts - blocking will be done after response
-    if is_login_request(flow):
-        return False, ""
-    
     return False, ""
 
 def handle_login_response(flow):
     """
     Process login responses to track failed attempts
     """
-    if not is_login_request(flow):
+    info = get_login_info(flow)
+    if not info.is_login:
         return
     
-    client_ip = flow.client_conn.address[0]
-    domain = get_domain(flow)
+    client_ip, domain = info.client_ip, info.domain
     
-    print(f"Processing login response for IP: {client_ip} on domain: {domain}")
+    _log.debug("Processing login response for IP: %s on domain: %s", client_ip, domain)
     
     # Log the credentials being used (for debugging)
-    if flow.request.urlencoded_form:
+    # Building the form is only worth it when the messages are printed
+    if _log.is_enabled_for(DEBUG) and flow.request.urlencoded_form:
+        _log.debug("LOGIN FORM DATA: %s", dict(flow.request.urlencoded_form))
         username = flow.request.urlencoded_form.get("username", "") or flow.request.urlencoded_form.get("email", "")
         has_password = bool(flow.request.urlencoded_form.get("password", ""))
-        print(f"Login attempt with username/email: '{username}', password provided: {has_password}")
+        _log.debug("Login attempt with username/email: '%s', password provided: %s", username, has_password)
     
     # Check if this is a failed login
     failed = is_failed_login(flow)
-    print(f"Login result: {'FAILED' if failed else 'SUCCESS'}")
+    _log.debug("Login result: %s (%s response bytes scanned)", 'FAILED' if failed else 'SUCCESS',
+               flow.metadata.get(LOGIN_SCAN_BYTES_KEY, 0))
     
     if failed:
+        metrics.inc(FAILED_LOGINS_METRIC)
         # Record the failed login and get the current count
         recent_attempts = record_failed_login(flow)
         
         # Check if we've exceeded the threshold and IP blocking is enabled
-        # Always use the current value of ENABLE_IP_BLOCKING
-        if recent_attempts >= variables.MAX_LOGIN_ATTEMPTS and variables.ENABLE_IP_BLOCKING:
+        config = get_flow_config(flow)
+        if recent_attempts >= config.MAX_LOGIN_ATTEMPTS and config.ENABLE_IP_BLOCKING:
             # Block the IP for this domain
-            block_ip_for_domain(client_ip, domain)
+            block_ip_for_domain(client_ip, domain, config.LOGIN_BLOCK_DURATION)
+            flow.metadata[BLOCK_REASON_KEY] = "client/failed_logins"
             # Modify the response to notify the user
             flow.response = http.Response.make(
                 429, 
-                f"<html><body><h1>429 Too Many Requests</h1><p>Too many failed login attempts on {domain}. Your IP has been blocked for {int(variables.LOGIN_BLOCK_DURATION*1)} seconds.</p></body></html>".encode(),
+                f"<html><body><h1>429 Too Many Requests</h1><p>Too many failed login attempts on {domain}. Your IP has been blocked for {int(config.LOGIN_BLOCK_DURATION)} seconds.</p></body></html>".encode(),
                 {"Content-Type": "text/html"}
             )
-            print(f"BLOCKED: Too many failed login attempts from IP: {client_ip} on domain: {domain}")
-        elif recent_attempts >= variables.MAX_LOGIN_ATTEMPTS:
+            _blocked_log.info("BLOCKED: Too many failed login attempts from IP: %s on domain: %s", client_ip, domain)
+        elif recent_attempts >= config.MAX_LOGIN_ATTEMPTS:
             # IP blocking is disabled, but we still want to log the excessive attempts
-            print(f"IP blocking disabled: Not blocking IP {client_ip} despite {recent_attempts} failed attempts")
+            _log.warning("IP blocking disabled: Not blocking IP %s despite %s failed attempts", client_ip, recent_attempts)
     else:
-        print(f"Login appears successful for IP: {client_ip} on domain: {domain}")
+        _log.debug("Login appears successful for IP: %s on domain: %s", client_ip, domain)
@@ -1,5 +1,245 @@
-# Import all variables from the variables file
-from variables import *
+import json
+import os
+import threading
+import time
 
-# This file now serves as a compatibility layer for existing imports
-# No variable definitions needed here as they're all imported from variables.py
+import variables
+import metrics
+from waf_logger import get_logger, reload_settings as reload_log_settings
+
+_log = get_logger("config")
+
+# Key under which the snapshot a flow was handled with is stored in flow.metadata
+CONFIG_KEY = "waf_config"
+
+# Relative CONFIG_FILE paths are relative to src/
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class ConfigError(ValueError):
+    """
+    A setting is unknown or its value has the wrong type
+    """
+
+class Config:
+    """
+    One version of every setting of variables.py, read as attributes.
+
+    A snapshot is never changed: publish builds a new one and swaps it in.
+    Lists are stored as tuples, and settings that did not change keep the
+    same object from one version to the next, so anything derived from a
+    setting can tell by identity whether it has to be rebuilt.
+    """
+    def __init__(self, version, values, source):
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "source", source)
+        object.__setattr__(self, "published_at", time.time())
+        object.__setattr__(self, "_names", tuple(sorted(values)))
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Config snapshots are read-only, use config.publish")
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self._names}
+
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+def _variables_settings():
+    return {name: _freeze(getattr(variables, name)) for name in dir(variables) if name.isupper()}
+
+def _check_type(name, old_value, value):
+    """
+    The value converted to the type of the setting's current value
+    Raises ConfigError
+    """
+    if isinstance(old_value, bool):
+        if isinstance(value, bool):
+            return value
+    elif isinstance(old_value, int):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    elif isinstance(old_value, float):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+    elif isinstance(old_value, tuple):
+        if isinstance(value, (list, tuple)):
+            return tuple(value)
+    elif isinstance(value, type(old_value)):
+        return value
+    raise ConfigError(f"{name}: expected {type(old_value).__name__}, got {type(value).__name__}")
+
+def parse_setting(name, text):
+    """
+    Convert the text of a form field to the type of a setting
+    Lists are comma separated
+    Raises ConfigError
+    """
+    old_value = getattr(current(), name, None) if name.isupper() else None
+    if old_value is None:
+        raise ConfigError(f"Unknown setting {name}")
+    try:
+        if isinstance(old_value, bool):
+            return text.strip().lower() == "true"
+        if isinstance(old_value, int):
+            return int(text)
+        if isinstance(old_value, float):
+            return float(text)
+    except ValueError as e:
+        raise ConfigError(f"{name}: {e}")
+    if isinstance(old_value, tuple):
+        return tuple(item.strip() for item in text.split(",") if item.strip())
+    return text
+
+_active = None
+_publish_lock = threading.Lock()  # One publish at a time; readers never take it
+_listeners = []  # Called with (config, changed names) after each publish
+_watcher = None
+
+def current():
+    """
+    The active Config, taken from variables.py on first use
+    """
+    config = _active
+    if config is None:
+        with _publish_lock:
+            if _active is None:
+                _activate(Config(1, _variables_settings(), "variables.py"))
+            config = _active
+    return config
+
+def get_flow_config(flow):
+    """
+    The Config a flow is handled with: the active one when the flow is
+    first seen, kept for the rest of the flow even if a newer one is
+    published meanwhile
+    """
+    config = flow.metadata.get(CONFIG_KEY)
+    if config is None:
+        config = flow.metadata[CONFIG_KEY] = current()
+    return config
+
+def _activate(config):
+    global _active
+    # A single assignment: readers see either the old or the new version
+    _active = config
+    # Kept in step for code that reads a setting once (startup, logging)
+    for name, value in config.as_dict().items():
+        if getattr(variables, name, None) is not value:
+            setattr(variables, name, value)
+
+def publish(changes, source="api"):
+    """
+    Make a new Config with the given settings changed the active one,
+    all of them at once. Returns the active Config, unchanged if every
+    value was already set.
+    Raises ConfigError, leaving the active Config as it is
+    """
+    current()  # Taken from variables.py if nothing was published yet
+    with _publish_lock:
+        old = _active
+        values = old.as_dict()
+        changed = []
+        for name, value in changes.items():
+            if name not in values:
+                raise ConfigError(f"Unknown setting {name}")
+            value = _check_type(name, values[name], value)
+            if value != values[name]:
+                values[name] = value
+                changed.append(name)
+        if not changed:
+            return old
+        config = Config(old.version + 1, values, source)
+        _activate(config)
+
+    # Logging settings are cached by waf_logger
+    reload_log_settings()
+    for name in changed:
+        _log.info("Setting updated by %s: %s: %s → %s", source, name, getattr(old, name), getattr(config, name))
+    for listener in _listeners:
+        try:
+            listener(config, changed)
+        except Exception as e:
+            _log.error("Error notifying config listener: %s", e)
+    return config
+
+def add_listener(listener):
+    """
+    Call listener(config, changed names) after every publish, e.g. to
+    send the new settings to the workers
+    """
+    _listeners.append(listener)
+
+def config_path():
+    config_file = current().CONFIG_FILE
+    if not config_file:
+        return None
+    return os.path.join(SRC_DIR, config_file)
+
+def load_config_file(path=None):
+    """
+    Publish the settings of a JSON file, {"SETTING": value, ...}
+    Raises OSError or ConfigError
+    """
+    path = path or config_path()
+    with open(path, encoding="utf-8") as config_file:
+        try:
+            changes = json.load(config_file)
+        except ValueError as e:
+            raise ConfigError(f"{path}: {e}")
+    if not isinstance(changes, dict):
+        raise ConfigError(f"{path}: expected an object of settings")
+    return publish(changes, source=os.path.basename(path))
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def _load_if_changed(path, last_state):
+    """
+    Load the file if it exists and changed since last_state
+    Returns its current state
+    """
+    state = _file_state(path) if path else None
+    if state is not None and state != last_state:
+        try:
+            load_config_file(path)
+        except (OSError, ConfigError) as e:
+            _log.error("Keeping the current settings, could not load %s: %s", path, e)
+    return state
+
+def _watch(path, last_state):
+    while True:
+        time.sleep(max(0.1, current().CONFIG_RELOAD_INTERVAL))
+        if current().CONFIG_RELOAD_INTERVAL <= 0:
+            continue
+        if config_path() != path:
+            path = config_path()
+            last_state = None  # CONFIG_FILE was changed, load the new file
+        last_state = _load_if_changed(path, last_state)
+
+def start_config_watcher():
+    """
+    Publish the settings of CONFIG_FILE right away and whenever it changes,
+    checking every CONFIG_RELOAD_INTERVAL seconds
+    """
+    global _watcher
+    if _watcher is None:
+        path = config_path()
+        last_state = _load_if_changed(path, None)
+        _watcher = threading.Thread(target=_watch, args=(path, last_state), name="config-watcher", daemon=True)
+        _watcher.start()
+
+def _collect_config_metrics():
+    config = _active
+    if config is None:
+        return []
+    return [("waf_config_version", (), config.version)]
+
+metrics.register_collector(_collect_config_metrics)
@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+
+class AttemptTracker:
+    """
+    Sliding-window counters of failed login attempts per (IP, domain) key.
+
+    Each key keeps at most `limit` timestamps - enough to tell whether the
+    limit was reached within the window - so recording an attempt is O(limit)
+    and the memory per key is fixed. Keys live in an LRU order: keys whose
+    newest attempt fell out of the window are evicted from the front, and the
+    least recently used keys are dropped once `max_keys` is exceeded.
+    """
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._attempts = OrderedDict()  # key -> list of timestamps, oldest first
+        self.evicted_expired = 0
+        self.evicted_lru = 0
+
+    def record(self, key, window, limit, now=None):
+        """
+        Record an attempt for the key
+        Returns the number of attempts within the window, capped at limit
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - window
+
+        timestamps = self._attempts.get(key)
+        if timestamps is None:
+            timestamps = self._attempts[key] = []
+        else:
+            self._attempts.move_to_end(key)
+            while timestamps and timestamps[0] <= cutoff:
+                del timestamps[0]
+        timestamps.append(now)
+        # Older attempts beyond the limit can never change the outcome; the
+        # newest is always kept, so a limit below 1 still leaves a timestamp
+        limit = max(1, limit)
+        if len(timestamps) > limit:
+            del timestamps[:len(timestamps) - limit]
+
+        self._evict(cutoff)
+        return len(timestamps)
+
+    def count(self, key, window, now=None):
+        """
+        Returns the number of recorded attempts within the window
+        """
+        timestamps = self._attempts.get(key)
+        if not timestamps:
+            return 0
+        cutoff = (time.time() if now is None else now) - window
+        return sum(1 for timestamp in timestamps if timestamp > cutoff)
+
+    def reset(self, key):
+        self._attempts.pop(key, None)
+
+    def clear(self):
+        self._attempts.clear()
+
+    def _evict(self, cutoff):
+        attempts = self._attempts
+        # Front of the LRU order holds the keys touched longest ago
+        while attempts:
+            key, timestamps = next(iter(attempts.items()))
+            if timestamps and timestamps[-1] > cutoff:
+                break
+            del attempts[key]
+            self.evicted_expired += 1
+        while len(attempts) > self.max_keys:
+            attempts.popitem(last=False)
+            self.evicted_lru += 1
+
+    def __len__(self):
+        return len(self._attempts)
+
+    def get_stats(self):
+        """
+        Returns the tracker's size and eviction counters
+        """
+        return {
+            "tracked_keys": len(self._attempts),
+            "max_keys": self.max_keys,
+            "evicted_expired": self.evicted_expired,
+            "evicted_lru": self.evicted_lru,
+        }
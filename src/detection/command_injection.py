@@ -1,46 +1,8 @@
-import re
-from urllib.parse import unquote
+from detection.rules import get_rules
+from request_view import InspectedText
 
-# Command Injection Patterns
-COMMAND_INJECTION_PATTERNS = [
-    r";\s*(cat|ls|pwd|rm|echo|bash|sh)\s",             # More specific command chaining with semicolon
-    r"\|\s*(cat|ls|pwd|rm|echo|bash|sh)\s",            # More specific pipe to dangerous command
-    r"&&\s*(cat|ls|pwd|rm|echo|bash|sh)\s",            # More specific command chaining with &&
-    r"`(cat|ls|pwd|rm|echo|bash).*`",               # More specific backtick execution
-    r"\$\((cat|ls|pwd|rm|echo|bash).*\)",           # More specific command substitution $(...)
-    r">\s*/[a-zA-Z0-9_/]+",                           # Output redirection to specific path
-    r">>\s*/[a-zA-Z0-9_/]+",                          # Output append to specific path
-    r"<\s*/[a-zA-Z0-9_/]+",                           # Input from file with specific path
-    r"cat\s+/[a-zA-Z0-9_/]+",                         # Reading specific files
-    r"wget\s+http",                                   # Specific download command
-    r"curl\s+http",                                   # Specific download with curl
-    r"ping\s+-[a-z]*c",                               # Network probing with count
-    r"nc\s+-[a-z]*v",                                 # Netcat with specific flags
-    r"nmap\s+-[a-z]*p",                               # Network scanning specific ports
-    r"rm\s+(-rf\s+)?/[a-zA-Z0-9_/]+",                 # More specific file deletion
-    r"chmod\s+[0-7]{3,4}\s+",                         # More specific chmod command
-    r"chown\s+[a-zA-Z0-9_]+:[a-zA-Z0-9_]+\s+",        # More specific chown command
-    r"cd\s+/[a-zA-Z0-9_/]+"                           # More specific directory traversal
-]
-
-# Add a list of common user agents to whitelist
-COMMON_USER_AGENTS = [
-    r"Mozilla/5\.0 \(Windows NT",
-    r"Mozilla/5\.0 \(Macintosh",
-    r"Mozilla/5\.0 \(X11",
-    r"Mozilla/5\.0 \(Linux",
-    r"Mozilla/5\.0 \(Android",
-    r"Mozilla/5\.0 \(iPhone",
-    r"Mozilla/5\.0 \(iPad",
-    r"Chrome/\d+",
-    r"Firefox/\d+",
-    r"Safari/\d+",
-    r"Edge/\d+",
-    r"Opera/\d+",
-    r"Trident/\d+",
-    r"MSIE \d+",
-    r"Gecko/\d+"
-]
+# The command injection patterns are the "cmd" signatures of the rule file
+# (RULES_FILE), the common user agents its "ua" signatures
 
 def is_common_user_agent(text):
     """
@@ -48,27 +10,37 @@ def is_common_user_agent(text):
     """
     if text is None:
         return False
-        
-    for pattern in COMMON_USER_AGENTS:
-        if re.search(pattern, text, re.IGNORECASE):
-            return True
-    return False
 
-def detect_command_injection(text, is_user_agent=False):
+    signatures = get_rules().signatures.get("ua")
+    return signatures is not None and signatures.match(text) is not None
+
+def match_command_injection_in(value, is_user_agent=False):
+    """
+    Check an InspectedText for command injection attacks
+    Returns the id of the rule that fired, or None
+    """
+    # Skip checks for common user agents
+    if is_user_agent and is_common_user_agent(value.raw):
+        return None
+
+    signatures = get_rules().signatures.get("cmd")
+    if signatures is None:
+        return None
+    # Match the URL-decoded text to catch encoded attacks
+    return signatures.match(value.decoded, value.folded)
+
+def match_command_injection(text, is_user_agent=False):
     """
     Check text for command injection attacks
+    Returns the id of the rule that fired, or None
     """
     if text is None:
-        return False
-    
-    # Skip checks for common user agents
-    if is_user_agent and is_common_user_agent(text):
-        return False
-    
-    # URL-decode the text to catch encoded attacks
-    decoded_text = unquote(text)
-    
-    for pattern in COMMAND_INJECTION_PATTERNS:
-        if re.search(pattern, decoded_text, re.IGNORECASE):
-            return True
-    return False
+        return None
+
+    return match_command_injection_in(InspectedText(text), is_user_agent)
+
+def detect_command_injection(text, is_user_agent=False):
+    """
+    Check text for command injection attacks
+    """
+    return match_command_injection(text, is_user_agent) is not None
@@ -0,0 +1,24 @@
+from detection.rules import get_rules, RuleFileError
+from request_view import InspectedText
+
+def match_injection_in(value):
+    """
+    Check an InspectedText for SQL and command injection in a single pass
+    Returns the id of the rule that fired, or None
+    """
+    try:
+        signatures = get_rules().signature_group(("sql", "cmd"))
+    except RuleFileError:
+        return None
+    # Match the URL-decoded text to catch encoded attacks
+    return signatures.match(value.decoded, value.folded)
+
+def match_injection(text):
+    """
+    Check text for SQL and command injection in a single pass
+    Returns the id of the rule that fired, or None
+    """
+    if text is None:
+        return None
+
+    return match_injection_in(InspectedText(text))
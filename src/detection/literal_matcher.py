@@ -0,0 +1,86 @@
+import re
+
+class LiteralMatcher:
+    """
+    Case-insensitive search for any of a list of literal strings.
+
+    The terms are folded into a trie and emitted as one regex whose
+    alternations branch on a single character, so the regex engine walks the
+    trie in C at each position of the text. The cost per position depends on
+    the trie's fan-out, not on the number of terms.
+    """
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self._folded_to_term = {}
+        trie = {}
+        for term in self.terms:
+            folded = term.lower()
+            self._folded_to_term.setdefault(folded, term)
+            node = trie
+            for char in folded:
+                node = node.setdefault(char, {})
+            node[None] = True  # End of a term
+        self._search = re.compile(_trie_to_regex(trie)).search if self.terms else None
+
+    def search_folded(self, folded_text):
+        """
+        Search text that has already been lowercased
+        Returns the first term found, or None
+        """
+        if self._search is None or folded_text is None:
+            return None
+        match = self._search(folded_text)
+        if match is None:
+            return None
+        return self._folded_to_term[match.group()]
+
+    def search(self, text):
+        """
+        Returns the first term found in the text (ignoring case), or None
+        """
+        if text is None:
+            return None
+        return self.search_folded(text.lower())
+
+    def __len__(self):
+        return len(self.terms)
+
+class TermListMatcher:
+    """
+    LiteralMatcher for a term list that can be replaced at runtime.
+    The list is fetched on every call and the matcher rebuilt only when a
+    different list object (or a list of a different length) comes back.
+    """
+    def __init__(self, get_terms):
+        self._get_terms = get_terms
+        self._source = None
+        self._size = -1
+        self._matcher = None
+        self.version = 0  # Bumped on every rebuild
+
+    def current(self):
+        terms = self._get_terms()
+        if terms is not self._source or len(terms) != self._size:
+            self._matcher = LiteralMatcher(terms)
+            self._source = terms
+            self._size = len(terms)
+            self.version += 1
+        return self._matcher
+
+    def search_folded(self, folded_text):
+        return self.current().search_folded(folded_text)
+
+    def search(self, text):
+        return self.current().search(text)
+
+def _trie_to_regex(node):
+    """
+    Turn a trie of characters into a regex that matches any of its terms
+    """
+    if None in node:
+        # A shorter term ends here; a longer one can never be needed for a hit
+        return ""
+    branches = [re.escape(char) + _trie_to_regex(child) for char, child in sorted(node.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return "(?:" + "|".join(branches) + ")"
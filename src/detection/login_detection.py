@@ -1,8 +1,14 @@
 import re
+import zlib
 from urllib.parse import urlparse
-from collections import defaultdict
-import time
-import variables  # Import the module instead of individual variables
+from mitmproxy.net import encoding
+from mitmproxy.net.http.headers import parse_content_type
+from config import current, get_flow_config
+from detection.literal_matcher import LiteralMatcher
+from persistence.state_backend import get_backend
+from waf_logger import get_logger
+
+_log = get_logger("login")
 
 # Patterns to identify login requests and failed logins
 LOGIN_URL_PATTERNS = [
@@ -33,32 +39,57 @@ FAILED_LOGIN_PATTERNS = [
     "login fehlgeschlagen"
 ]
 
-# Data structures to track login attempts
-login_attempts = defaultdict(list)  # (IP, domain) -> List of timestamp of login attempts
+# All login URL patterns as one regex, so a URL is searched once
+LOGIN_URL_REGEX = re.compile("|".join(f"(?:{pattern})" for pattern in LOGIN_URL_PATTERNS), re.IGNORECASE)
+
+FAILED_LOGIN_MATCHER = LiteralMatcher(FAILED_LOGIN_PATTERNS)
+
+# Key under which the LoginInfo of a flow is stored in flow.metadata
+LOGIN_INFO_KEY = "waf_login_info"
+
+# Number of response body bytes searched by the last is_failed_login call on a flow
+LOGIN_SCAN_BYTES_KEY = "waf_login_scan_bytes"
+
+class LoginInfo:
+    """
+    Client IP, domain and login classification of a request.
+    Worked out once per flow; every hook handling the flow reads them from here.
+    """
+    __slots__ = ("client_ip", "domain", "is_login")
+
+    def __init__(self, flow):
+        self.client_ip = flow.client_conn.address[0]
+        # Extract the domain from the request URL
+        self.domain = urlparse(flow.request.url).netloc
+        # A login attempt is a POST to a URL matching one of the login patterns
+        self.is_login = flow.request.method == "POST" and LOGIN_URL_REGEX.search(flow.request.url) is not None
+        if self.is_login:
+            _log.debug("LOGIN REQUEST DETECTED: %s", flow.request.url)
+
+def get_login_info(flow):
+    """
+    Returns the LoginInfo of the flow, creating it on first use
+    """
+    info = flow.metadata.get(LOGIN_INFO_KEY)
+    if info is None:
+        info = LoginInfo(flow)
+        flow.metadata[LOGIN_INFO_KEY] = info
+    return info
+
+def get_client_ip(flow):
+    return get_login_info(flow).client_ip
 
 def get_domain(flow):
     """
     Extract the domain from the request URL
     """
-    parsed_url = urlparse(flow.request.url)
-    return parsed_url.netloc
+    return get_login_info(flow).domain
 
 def is_login_request(flow):
     """
     Checks if the request is a login attempt based on URL patterns and HTTP method
     """
-    if flow.request.method != "POST":
-        return False
-    
-    url = flow.request.url.lower()
-    for pattern in LOGIN_URL_PATTERNS:
-        if re.search(pattern, url, re.IGNORECASE):
-            # Debug output for login detection with additional details
-            print(f"LOGIN REQUEST DETECTED: {flow.request.url}")
-            if flow.request.urlencoded_form:
-                print(f"LOGIN FORM DATA: {dict(flow.request.urlencoded_form)}")
-            return True
-    return False
+    return get_login_info(flow).is_login
 
 def is_failed_login(flow):
     """
@@ -70,13 +101,13 @@ def is_failed_login(flow):
         return False
     
     # Enhanced debugging
-    print(f"Analyzing login response: Status {flow.response.status_code}, URL: {flow.request.url}")
+    _log.debug("Analyzing login response: Status %s, URL: %s", flow.response.status_code, flow.request.url)
     
     # Generic detection method #1: Check for HTTP status codes
     # A successful login typically redirects (302, 303, 307) or returns 200
     # Failed logins often return 401, 403, or 200 with an error message
     if flow.response.status_code in [401, 403]:
-        print(f"FAILED LOGIN: Status code indicates failure: {flow.response.status_code}")
+        _log.debug("FAILED LOGIN: Status code indicates failure: %s", flow.response.status_code)
         return True
         
     # Generic detection method #2: Check for redirects back to login page
@@ -84,15 +115,20 @@ def is_failed_login(flow):
         location = flow.response.headers.get("location", "").lower()
         # If redirected back to login page, it's likely a failed login
         if any(pattern.strip('/') in location for pattern in ['/login', '/signin', '/auth']):
-            print(f"FAILED LOGIN: Redirected back to login page: {location}")
+            _log.debug("FAILED LOGIN: Redirected back to login page: %s", location)
             return True
     
     # Generic detection method #3: Check response content for common error messages
-    if flow.response.text:
-        response_text = flow.response.text.lower()
-        for pattern in FAILED_LOGIN_PATTERNS:
-            if pattern.lower() in response_text:
-                print(f"FAILED LOGIN: Error message detected: '{pattern}'")
+    # Redirects were decided by their location; only the start of the body is searched
+    flow.metadata[LOGIN_SCAN_BYTES_KEY] = 0
+    if flow.response.status_code not in [301, 302, 303, 307, 308]:
+        config = get_flow_config(flow)
+        text = response_text_prefix(flow.response, config.FAILED_LOGIN_SCAN_BYTES, config.FAILED_LOGIN_CONTENT_TYPES)
+        if text is not None:
+            flow.metadata[LOGIN_SCAN_BYTES_KEY] = len(text)
+            pattern = FAILED_LOGIN_MATCHER.search(text)
+            if pattern is not None:
+                _log.debug("FAILED LOGIN: Error message detected: '%s' (%s bytes scanned)", pattern, len(text))
                 return True
     
     # Generic detection method #4: Check for empty password submissions
@@ -102,28 +138,69 @@ def is_failed_login(flow):
         password = flow.request.urlencoded_form.get("password", "")
         
         if username and not password:
-            print(f"POTENTIAL FAILED LOGIN: Empty password for username/email '{username}'")
+            _log.debug("POTENTIAL FAILED LOGIN: Empty password for username/email '%s'", username)
             return True
     
     return False
 
+def response_text_prefix(response, budget, content_types):
+    """
+    Decode at most budget bytes from the start of a response body
+    Returns None if the body is empty or not of one of content_types
+    """
+    raw_content = response.raw_content
+    if not raw_content:
+        return None
+    charset = "utf-8"
+    content_type = response.headers.get("content-type")
+    if content_type:
+        parsed = parse_content_type(content_type)
+        if parsed is None or f"{parsed[0]}/{parsed[1]}".lower() not in content_types:
+            return None
+        charset = parsed[2].get("charset", charset)
+
+    content_encoding = response.headers.get("content-encoding", "identity").strip().lower()
+    try:
+        if content_encoding in ("gzip", "x-gzip", "deflate"):
+            # Only inflate as much as is searched; gzip headers are detected automatically
+            window_bits = 47 if content_encoding != "deflate" else zlib.MAX_WBITS
+            try:
+                data = zlib.decompressobj(window_bits).decompress(raw_content, budget)
+            except zlib.error:
+                # Deflate is also sent without the zlib header
+                data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(raw_content, budget)
+        elif content_encoding in ("", "identity", "none"):
+            data = raw_content[:budget]
+        else:
+            data = encoding.decode(raw_content, content_encoding)[:budget]
+    except (ValueError, zlib.error) as e:
+        _log.debug("Could not decode %s login response: %s", content_encoding, e)
+        return None
+
+    try:
+        return data.decode(charset, errors="ignore")
+    except LookupError:
+        return data.decode("utf-8", errors="ignore")
+
 def record_failed_login(flow):
     """
     Record a failed login attempt
     """
-    client_ip = flow.client_conn.address[0]
-    domain = get_domain(flow)
+    info = get_login_info(flow)
+    client_ip, domain = info.client_ip, info.domain
     ip_domain_key = (client_ip, domain)
     
-    # Record the timestamp of the failed login attempt
-    current_time = time.time()
-    login_attempts[ip_domain_key].append(current_time)
-    
-    # Clean up old login attempts - always use current value
-    login_attempts[ip_domain_key] = [t for t in login_attempts[ip_domain_key] 
-                                    if current_time - t < variables.LOGIN_ATTEMPT_TIMEOUT]
-    
-    recent_attempts = len(login_attempts[ip_domain_key])
-    print(f"FAILED LOGIN recorded for IP {client_ip} on domain {domain}. Total attempts: {recent_attempts}")
+    recent_attempts = count_failed_login(ip_domain_key, get_flow_config(flow))
+    _log.info("FAILED LOGIN recorded for IP %s on domain %s. Total attempts: %s", client_ip, domain, recent_attempts)
     
     return recent_attempts
+
+def count_failed_login(ip_domain_key, config=None):
+    """
+    Record a failed login for an (IP, domain) key with the state backend
+    Returns the number of recent failed attempts, capped at MAX_LOGIN_ATTEMPTS
+    of config (default: the active Config)
+    """
+    config = config or current()
+    return get_backend().count_failed_login(ip_domain_key, config.LOGIN_ATTEMPT_TIMEOUT,
+                                            config.MAX_LOGIN_ATTEMPTS)
@@ -0,0 +1,340 @@
+import json
+import os
+import re
+import threading
+import time
+
+import metrics
+from config import current
+from detection.signature_engine import SignatureSet
+from detection.literal_matcher import LiteralMatcher, TermListMatcher
+from waf_logger import get_logger
+
+_log = get_logger("rules")
+
+# Every place in a request a rule can inspect, in the order they are checked
+LOCATIONS = ("url", "path", "query", "user-agent", "cookie", "header", "body", "form")
+
+# Relative RULES_FILE paths are relative to src/
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_RELOADS_OK = metrics.series("waf_rule_reloads_total", (("result", "ok"),))
+_RELOADS_FAILED = metrics.series("waf_rule_reloads_total", (("result", "error"),))
+
+class RuleFileError(ValueError):
+    """
+    The rule file is not valid; the message says where
+    """
+
+class Rule:
+    """
+    One entry of the rule file, compiled.
+
+    match returns what fired (a signature rule id or a term) or None. A rule
+    with requires only fires on values that requires matches too; a rule
+    with unless never fires on values that unless matches.
+    """
+    __slots__ = ("name", "title", "locations", "match", "requires", "unless", "reports_term", "response")
+
+    def __init__(self, name, title, locations, match, requires, unless, reports_term, response):
+        self.name = name
+        self.title = title
+        self.locations = locations
+        self.match = match
+        self.requires = requires
+        self.unless = unless
+        self.reports_term = reports_term
+        self.response = response  # (status, body template, content type or None)
+
+    def check(self, value):
+        """
+        Returns what fired on the InspectedText, or None
+        """
+        if self.unless is not None and self.unless(value) is not None:
+            return None
+        if self.requires is not None and self.requires(value) is None:
+            return None
+        return self.match(value)
+
+class RuleSet:
+    """
+    A rule file compiled into one table of rules per location.
+
+    A location only runs the rules listed for it, in file order. Rule sets
+    are never changed once built: a reload builds a new one and swaps it in,
+    so a request always sees one complete set.
+    """
+    def __init__(self, version, path, data):
+        self.version = version
+        self.path = path
+        self.loaded_at = time.time()
+        self.skip_headers = frozenset(name.lower() for name in data.get("skip_headers", []))
+        self.where = dict(data.get("locations", {}))
+        self.signatures = {}
+        self.titles = {}
+        self.terms = {}
+        self._groups = {}
+        self._setting_terms = []
+
+        for name, entry in _get(data, "signatures", dict).items():
+            patterns = [pattern if isinstance(pattern, str) else _get(pattern, "pattern", str, f"signatures.{name}")
+                        for pattern in _get(entry, "patterns", list, f"signatures.{name}")]
+            try:
+                self.signatures[name] = SignatureSet(name, patterns)
+            except re.error as e:
+                raise RuleFileError(f"signatures.{name}: {e}")
+            self.titles[name] = entry.get("title", name)
+
+        for name, entry in data.get("terms", {}).items():
+            if isinstance(entry, dict) and "setting" in entry:
+                setting = _get(entry, "setting", str, f"terms.{name}")
+                if not setting.isupper() or not hasattr(current(), setting):
+                    raise RuleFileError(f"terms.{name}: unknown setting {setting}")
+                matcher = TermListMatcher(lambda setting=setting: getattr(current(), setting))
+                self._setting_terms.append(matcher)
+            else:
+                matcher = LiteralMatcher(_get(entry, "values", list, f"terms.{name}"))
+            self.terms[name] = matcher
+
+        self.rules = []
+        tables = {location: [] for location in LOCATIONS}
+        for index, entry in enumerate(_get(data, "rules", list)):
+            where = f"rules[{index}]"
+            rule = Rule(
+                name=_get(entry, "name", str, where),
+                title=entry.get("title", entry["name"]),
+                locations=tuple(_get(entry, "locations", list, where)),
+                match=self._matcher(_get(entry, "match", dict, where), f"{where}.match"),
+                requires=self._matcher(entry["requires"], f"{where}.requires") if "requires" in entry else None,
+                unless=self._matcher(entry["unless"], f"{where}.unless") if "unless" in entry else None,
+                reports_term="terms" in entry["match"],
+                response=self._response(entry.get("response", {}), where),
+            )
+            for location in rule.locations:
+                if location not in tables:
+                    raise RuleFileError(f"{where}: unknown location {location!r}, expected one of {', '.join(LOCATIONS)}")
+                tables[location].append(rule)
+            self.rules.append(rule)
+        self.tables = {location: tuple(rules) for location, rules in tables.items()}
+
+    def _matcher(self, spec, where):
+        """
+        Compile {"signatures": [names]} or {"terms": name}, with "field" "decoded"
+        (default: URL-decoded, lowercased for terms) or "raw", into a function
+        of an InspectedText
+        """
+        if not isinstance(spec, dict):
+            raise RuleFileError(f"{where}: expected dict")
+        raw = spec.get("field", "decoded") == "raw"
+        if "signatures" in spec:
+            names = tuple(_get(spec, "signatures", list, where))
+            if not all(isinstance(name, str) for name in names):
+                raise RuleFileError(f"{where}.signatures: expected a list of names")
+            signature_set = self.signature_group(names, where)
+            if raw:
+                return lambda value: signature_set.match(value.raw)
+            return lambda value: signature_set.match(value.decoded, value.folded)
+        if "terms" in spec:
+            matcher = self.terms.get(_get(spec, "terms", str, where))
+            if matcher is None:
+                raise RuleFileError(f"{where}: unknown terms {spec['terms']!r}")
+            if raw:
+                return lambda value: matcher.search(value.raw)
+            return lambda value: matcher.search_folded(value.folded)
+        raise RuleFileError(f"{where}: needs signatures or terms")
+
+    def _response(self, spec, where):
+        if not isinstance(spec, dict):
+            raise RuleFileError(f"{where}.response: expected dict")
+        body = spec.get("body", "Forbidden")
+        status = spec.get("status", 403)
+        content_type = spec.get("content_type")
+        if not isinstance(body, str):
+            raise RuleFileError(f"{where}.response.body: expected str")
+        if not isinstance(status, int) or isinstance(status, bool) or not 100 <= status <= 599:
+            raise RuleFileError(f"{where}.response.status: expected an HTTP status code")
+        if content_type is not None and not isinstance(content_type, str):
+            raise RuleFileError(f"{where}.response.content_type: expected str")
+        try:
+            body.format(attack="", where="", rule="")
+        except (KeyError, IndexError, ValueError) as e:
+            raise RuleFileError(f"{where}.response.body: {e!r}; placeholders are {{attack}}, {{where}} and {{rule}}")
+        return status, body, content_type
+
+    def signature_group(self, names, where="signature_group"):
+        """
+        The named signature sets merged into one, so a value is searched for
+        all of them in a single pass. Rule ids keep the name of their set.
+        """
+        group = self._groups.get(names)
+        if group is None:
+            missing = [name for name in names if name not in self.signatures]
+            if missing:
+                raise RuleFileError(f"{where}: unknown signatures {', '.join(missing)}")
+            if len(names) == 1:
+                group = self.signatures[names[0]]
+            else:
+                group = SignatureSet.merge("+".join(names), *(self.signatures[name] for name in names))
+            group = self._groups.setdefault(names, group)
+        return group
+
+    def check(self, location, value):
+        """
+        Run the rules of a location on an InspectedText
+        Returns (rule, what fired) for the first rule that fires, or None
+        """
+        for rule in self.tables[location]:
+            found = rule.check(value)
+            if found is not None:
+                return rule, found
+        return None
+
+    def reason(self, location, verdict):
+        """
+        The block reason of a verdict, "location/rule": the signature rule
+        id that fired, or the rule's name for term rules
+        """
+        rule, found = verdict
+        return f"{location}/{rule.name if rule.reports_term else found}"
+
+    def response_body(self, location, verdict):
+        rule, found = verdict
+        attack = self.titles.get(found.split(":")[0], rule.title) if not rule.reports_term else rule.title
+        return rule.response[1].format(attack=attack, where=self.where.get(location, location), rule=found)
+
+    def cache_version(self):
+        """
+        Changes whenever cached verdicts of these rules may be stale: on a
+        reload, or when a term list taken from a setting was replaced
+        """
+        versions = [self.version]
+        for matcher in self._setting_terms:
+            matcher.current()  # Rebuilds the matcher, and bumps its version, if the setting changed
+            versions.append(matcher.version)
+        return tuple(versions)
+
+    def get_stats(self):
+        return {
+            "version": self.version,
+            "path": self.path,
+            "loaded_at": self.loaded_at,
+            "rules": len(self.rules),
+            "signatures": sum(len(signature_set) for signature_set in self.signatures.values()),
+            "per_location": {location: len(rules) for location, rules in self.tables.items()},
+        }
+
+def _get(entry, key, kind, where="rule file"):
+    if not isinstance(entry, dict) or key not in entry:
+        raise RuleFileError(f"{where}: missing {key}")
+    value = entry[key]
+    if not isinstance(value, kind):
+        raise RuleFileError(f"{where}.{key}: expected {kind.__name__}")
+    return value
+
+_active = None
+_version = 0
+_load_lock = threading.Lock()  # One load at a time; readers never take it
+_watcher = None
+
+def rules_path():
+    return os.path.join(SRC_DIR, current().RULES_FILE)
+
+def load_rules(path=None):
+    """
+    Compile a rule file into a RuleSet without activating it
+    Raises OSError or RuleFileError
+    """
+    global _version
+    path = path or rules_path()
+    with open(path, encoding="utf-8") as rule_file:
+        try:
+            data = json.load(rule_file)
+        except ValueError as e:
+            raise RuleFileError(f"{path}: {e}")
+    if not isinstance(data, dict):
+        raise RuleFileError(f"{path}: expected an object")
+    _version += 1
+    try:
+        return RuleSet(_version, path, data)
+    except (TypeError, AttributeError, KeyError, ValueError) as e:
+        if isinstance(e, RuleFileError):
+            raise
+        # A value of the wrong type somewhere the checks above do not look
+        raise RuleFileError(f"{path}: malformed rule file: {e!r}")
+
+def reload_rules(path=None):
+    """
+    Load the rule file and make it the active rule set
+    The old set stays active when the file cannot be loaded
+    """
+    global _active
+    with _load_lock:
+        try:
+            rule_set = load_rules(path)
+        except (OSError, RuleFileError):
+            metrics.inc(_RELOADS_FAILED)
+            raise
+        # A single assignment: requests see either the old or the new set
+        _active = rule_set
+    metrics.inc(_RELOADS_OK)
+    _log.info("Loaded %s rules (%s signatures) from %s, version %s", len(rule_set.rules),
+              sum(len(signature_set) for signature_set in rule_set.signatures.values()), rule_set.path, rule_set.version)
+    return rule_set
+
+def get_rules():
+    """
+    The active RuleSet, loaded from RULES_FILE on first use
+    """
+    rule_set = _active
+    if rule_set is None:
+        rule_set = reload_rules()
+    return rule_set
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def _watch():
+    path = rules_path()
+    last_state = _file_state(path)
+    while True:
+        time.sleep(max(0.1, current().RULES_RELOAD_INTERVAL))
+        if current().RULES_RELOAD_INTERVAL <= 0:
+            continue
+        if rules_path() != path:
+            path = rules_path()
+            last_state = None  # RULES_FILE was changed, load the new file
+        state = _file_state(path)
+        if state is None or state == last_state:
+            continue
+        last_state = state
+        # Compiled here, off the request path; the proxy keeps using the old set meanwhile
+        try:
+            reload_rules(path)
+        except (OSError, RuleFileError) as e:
+            _log.error("Keeping the current rules, could not load %s: %s", path, e)
+        except Exception as e:
+            # Whatever the file holds, later edits must still be loaded
+            _log.error("Keeping the current rules, error loading %s: %r", path, e)
+
+def start_rule_watcher():
+    """
+    Reload the rules whenever RULES_FILE changes, checking every
+    RULES_RELOAD_INTERVAL seconds. The first rules are loaded right away.
+    """
+    global _watcher
+    get_rules()
+    if _watcher is None:
+        _watcher = threading.Thread(target=_watch, name="rule-watcher", daemon=True)
+        _watcher.start()
+
+def _collect_rule_metrics():
+    rule_set = _active
+    if rule_set is None:
+        return []
+    return [("waf_rules_version", (), rule_set.version)]
+
+metrics.register_collector(_collect_rule_metrics)
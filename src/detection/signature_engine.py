@@ -0,0 +1,283 @@
+import re
+import time
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+try:
+    import re2  # Optional: pip install google-re2
+except ImportError:
+    re2 = None
+
+from config import current
+import metrics
+from waf_logger import get_logger
+
+_log = get_logger("signatures")
+
+# Returned by _search_windows when the time budget ran out
+_OUT_OF_BUDGET = object()
+# Returned by _search_windows when no window matched: a match longer than a
+# window could still span several of them
+_UNDECIDED = object()
+
+_warned_no_re2 = False
+
+class SignatureSet:
+    """
+    A group of regex signatures checked together.
+
+    Every signature is compiled once into a single alternation with one named
+    group per rule, so a single search reports whether any rule fired and
+    which one. For ASCII input a literal prefilter runs first: each rule
+    carries the literals it cannot match without, and only rules whose
+    literals occur in the input are searched at all.
+
+    With REGEX_ENGINE = "re2", the default, the rules are compiled with RE2,
+    which matches in linear time. Rules RE2 cannot compile, and all rules
+    with the "re" engine, can backtrack badly on long input. If MAX_MATCH_WINDOW is
+    set, longer values are searched in overlapping windows; a rule no window
+    matched may still match across them, so such a value, like one that
+    took MATCH_TIME_BUDGET seconds, gets the verdict of MATCH_BUDGET_POLICY.
+    The engine is chosen when the set is compiled.
+    """
+    def __init__(self, name, patterns, flags=re.IGNORECASE):
+        self.name = name
+        self.flags = flags
+        self.rules = []  # List of (rule_id, pattern) in priority order
+        for index, pattern in enumerate(patterns):
+            self.rules.append((f"{name}:{index}", pattern))
+        self._compile()
+
+    def _compile(self):
+        self._fold_case = bool(self.flags & re.IGNORECASE)
+        use_re2 = _re2_enabled()
+        self._group_to_rule = {}
+        self._searches = []
+        self._unfiltered = []  # Rules without usable literals, always searched
+        atom_to_rules = {}
+        alternatives = []
+        for position, (rule_id, pattern) in enumerate(self.rules):
+            group_name = f"r{position}"
+            self._group_to_rule[group_name] = rule_id
+            alternatives.append(f"(?P<{group_name}>{pattern})")
+            linear_search = self._compile_re2(rule_id, pattern) if use_re2 else None
+            if linear_search is not None:
+                self._searches.append((rule_id, linear_search, True))
+            else:
+                self._searches.append((rule_id, re.compile(pattern, self.flags).search, False))
+
+            atoms = _required_literals(sre_parse.parse(pattern, self.flags))
+            if not atoms:
+                self._unfiltered.append(position)
+                continue
+            for atom in atoms:
+                if self._fold_case:
+                    atom = atom.lower()
+                atom_to_rules.setdefault(atom, []).append(position)
+        self._atoms = [(atom, tuple(positions)) for atom, positions in atom_to_rules.items()]
+        self._calls_metric = metrics.series("waf_detector_calls_total", (("detector", self.name),))
+        self._hits_metrics = {rule_id: metrics.series("waf_rule_hits_total", (("rule", rule_id),))
+                              for rule_id, _ in self.rules}
+        # Reported when MATCH_BUDGET_POLICY is "block" and a value ran out of time
+        self.budget_rule_id = f"{self.name}:budget"
+        self._hits_metrics[self.budget_rule_id] = metrics.series("waf_rule_hits_total", (("rule", self.budget_rule_id),))
+        self._budget_metric = metrics.series("waf_match_budget_exceeded_total", (("detector", self.name),))
+
+        self._search_all = None
+        if use_re2 and all(linear for _, _, linear in self._searches):
+            self._search_all = self._compile_re2(self.name, "|".join(alternatives))
+        self._search_all_linear = self._search_all is not None
+        if self._search_all is None:
+            self._search_all = re.compile("|".join(alternatives), self.flags).search
+
+    def _compile_re2(self, rule_id, pattern):
+        """
+        Returns the search function of pattern compiled with RE2, or None
+        if RE2 does not support the pattern or the flags
+        """
+        if self.flags & ~re.IGNORECASE:
+            return None
+        try:
+            return re2.compile(("(?i)" if self._fold_case else "") + pattern).search
+        except re2.error as e:
+            _log.warning("Rule %s cannot be compiled with re2, using re: %s", rule_id, e)
+            return None
+
+    @classmethod
+    def merge(cls, name, *signature_sets):
+        """
+        Build one set out of several, keeping the original rule ids
+        """
+        merged = cls(name, [])
+        for signature_set in signature_sets:
+            merged.rules.extend(signature_set.rules)
+        merged._compile()
+        return merged
+
+    def match(self, text, folded=None):
+        """
+        Returns the id of a rule that matches the text, or None
+        Pass the lowercased text as folded if the caller already has it
+        """
+        metrics.inc(self._calls_metric)
+        rule_id = self._match(text, folded)
+        if rule_id is not None:
+            metrics.inc(self._hits_metrics[rule_id])
+        return rule_id
+
+    def _match(self, text, folded):
+        if not self.rules:
+            return None
+        config = current()
+        window = config.MAX_MATCH_WINDOW
+        windowed = window > 0 and len(text) > window
+        deadline = None
+
+        # Case-insensitive matching of non-ASCII text can pair ASCII pattern
+        # letters with other code points (e.g. the Kelvin sign), which a
+        # lowercased prefilter would miss - use the full alternation instead
+        if self._fold_case and not text.isascii():
+            if windowed and not self._search_all_linear:
+                match = self._search_windows(self._search_all, text, config, time.perf_counter())
+                if match is _OUT_OF_BUDGET or match is _UNDECIDED:
+                    return self._out_of_budget(text, config, match)
+            else:
+                match = self._search_all(text)
+            if match is None:
+                return None
+            # The outer named group always closes last, so lastgroup names the rule
+            return self._group_to_rule[match.lastgroup]
+
+        if not self._fold_case:
+            haystack = text
+        elif folded is not None:
+            haystack = folded
+        else:
+            haystack = text.lower()
+        candidates = set(self._unfiltered)
+        for atom, positions in self._atoms:
+            if atom in haystack:
+                candidates.update(positions)
+
+        undecided = False
+        for position in sorted(candidates):
+            rule_id, search, linear = self._searches[position]
+            if linear or not windowed:
+                if search(text):
+                    return rule_id
+                continue
+            if deadline is None:
+                deadline = time.perf_counter()
+            match = self._search_windows(search, text, config, deadline)
+            if match is _OUT_OF_BUDGET:
+                return self._out_of_budget(text, config, match)
+            if match is _UNDECIDED:
+                # Another rule may still match outright
+                undecided = True
+            elif match:
+                return rule_id
+        if undecided:
+            return self._out_of_budget(text, config, _UNDECIDED)
+        return None
+
+    def _search_windows(self, search, text, config, start_time):
+        """
+        Search text MAX_MATCH_WINDOW characters at a time, the windows overlapping by
+        MATCH_WINDOW_OVERLAP, so one search never backtracks over more than
+        a window. A match is only found if it fits in a window; matches up to
+        the overlap long always do.
+        Returns the match, _UNDECIDED if no window matched, or _OUT_OF_BUDGET
+        once MATCH_TIME_BUDGET seconds passed since start_time
+        """
+        window = config.MAX_MATCH_WINDOW
+        overlap = min(config.MATCH_WINDOW_OVERLAP, window - 1)
+        deadline = start_time + config.MATCH_TIME_BUDGET
+        start = 0
+        while True:
+            # Unlike a slice, pos keeps \b and lookbehinds aware of the text before the window
+            match = search(text, start, start + window)
+            if match:
+                return match
+            if start + window >= len(text):
+                return _UNDECIDED
+            if time.perf_counter() > deadline:
+                return _OUT_OF_BUDGET
+            start += window - overlap
+
+    def _out_of_budget(self, text, config, cause):
+        """
+        The verdict of MATCH_BUDGET_POLICY for a value that ran out of time
+        (cause _OUT_OF_BUDGET) or was too long to rule out a match (_UNDECIDED)
+        """
+        metrics.inc(self._budget_metric)
+        action = "blocking" if config.MATCH_BUDGET_POLICY == "block" else "allowing"
+        if cause is _UNDECIDED:
+            _log.warning("A %s signature may match across the windows of a value of %s characters, %s it",
+                         self.name, len(text), action)
+        else:
+            _log.warning("Matching %s signatures on a value of %s characters took over %ss, %s it",
+                         self.name, len(text), config.MATCH_TIME_BUDGET, action)
+        if config.MATCH_BUDGET_POLICY == "block":
+            return self.budget_rule_id
+        return None
+
+    def __len__(self):
+        return len(self.rules)
+
+def _re2_enabled():
+    """
+    Whether REGEX_ENGINE asks for re2 and the package is installed
+    """
+    global _warned_no_re2
+    if current().REGEX_ENGINE != "re2":
+        return False
+    if re2 is None:
+        if not _warned_no_re2:
+            _log.warning("REGEX_ENGINE is re2 but the google-re2 package is not installed, using re: "
+                         "crafted values can make the signatures backtrack for seconds")
+            _warned_no_re2 = True
+        return False
+    return True
+
+def _required_literals(parsed):
+    """
+    Returns a set of literal strings at least one of which must occur in any
+    text the parsed pattern matches, or None if no such set could be derived
+    """
+    candidates = []
+    run = []
+
+    def end_run():
+        if run:
+            candidates.append({"".join(run)})
+            run.clear()
+
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        end_run()
+        if op is sre_constants.SUBPATTERN:
+            sub = _required_literals(av[-1])
+            if sub:
+                candidates.append(sub)
+        elif op is sre_constants.BRANCH:
+            branches = [_required_literals(branch) for branch in av[1]]
+            if all(branches):
+                candidates.append(set().union(*branches))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            sub = _required_literals(av[2])
+            if sub:
+                candidates.append(sub)
+    end_run()
+
+    # Non-ASCII literals could fold to ASCII text, so they are not safe to filter on
+    candidates = [c for c in candidates if all(literal.isascii() for literal in c)]
+    if not candidates:
+        return None
+    # Prefer the set whose shortest literal is longest, it is the most selective
+    return max(candidates, key=lambda c: min(len(literal) for literal in c))
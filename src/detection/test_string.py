@@ -1,4 +1,17 @@
-from urllib.parse import unquote
+from detection.rules import get_rules
+from request_view import InspectedText
+
+# The markers are the "test_string" terms of the rule file (RULES_FILE),
+# strings used to test that the WAF is in the request path
+
+def detect_test_string_in(value):
+    """
+    Check if an InspectedText contains the 'teststring' marker
+    Returns True if the test string is detected
+    """
+    matcher = get_rules().terms.get("test_string")
+    # Match the URL-decoded text to catch encoded test strings
+    return matcher is not None and matcher.search_folded(value.folded) is not None
 
 def detect_test_string(text):
     """
@@ -8,8 +21,4 @@ def detect_test_string(text):
     if text is None:
         return False
         
-    # URL-decode the text to catch encoded test strings
-    decoded_text = unquote(text).lower()
-    
-    # Simple check for 'teststring'
-    return 'teststring' in decoded_text
+    return detect_test_string_in(InspectedText(text))
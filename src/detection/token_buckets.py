@@ -0,0 +1,70 @@
+class TokenBuckets:
+    """
+    Token buckets of many keys, each stored as a single float.
+
+    Instead of a token count and a refill time, a key keeps the time at
+    which its bucket will be full again (the generic cell rate algorithm).
+    A request costs one interval (1 / rate) and is allowed while that time
+    is at most burst - 1 intervals (the tolerance) ahead, so a key may send
+    burst requests at once and then rate per second. Refilling is implied
+    by the clock: nothing runs per key between requests, and a key whose
+    time has passed holds a full bucket, the same as a key not stored.
+
+    Keys are kept in two generations. Keys that are used go to the current
+    one; once it holds max_keys / 2 keys it becomes the previous one, and
+    the keys left in the old previous generation, unused for a whole
+    generation, are dropped at once. A dropped key starts again with a
+    full bucket. Nothing is ever scanned.
+    """
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._current = {}  # key -> time at which the bucket is full again
+        self._previous = {}
+        self.limited = 0
+        self.evicted = 0
+
+    def take(self, key, now, interval, tolerance):
+        """
+        Take a token for the key; tolerance is (burst - 1) * interval
+        Returns 0 if there was one, or the seconds until there will be one
+        """
+        current = self._current
+        full_at = current.get(key)
+        if full_at is None:
+            full_at = self._previous.pop(key, now)
+            # Only a key new to this generation can make it grow
+            if len(current) >= self.max_keys // 2:
+                self._rotate()
+                current = self._current
+        if full_at < now:
+            full_at = now
+        elif full_at - now > tolerance:
+            self.limited += 1
+            # A limited request takes no token, the key keeps its time
+            current[key] = full_at
+            return full_at - now - tolerance
+        current[key] = full_at + interval
+        return 0
+
+    def _rotate(self):
+        self.evicted += len(self._previous)
+        self._previous = self._current
+        self._current = {}
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def get_stats(self):
+        """
+        Returns the number of keys, limited requests and evictions
+        """
+        return {
+            "tracked_keys": len(self),
+            "max_keys": self.max_keys,
+            "limited": self.limited,
+            "evicted": self.evicted,
+        }
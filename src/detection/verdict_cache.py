@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+# Returned by VerdictCache.get when the value has not been inspected yet
+MISS = object()
+
+class VerdictCache:
+    """
+    LRU cache of detector verdicts for values that repeat across requests,
+    such as User-Agent and Cookie headers.
+
+    Entries are keyed by (location, value) and belong to one ruleset version:
+    set_version() with a different version drops every entry, so a verdict is
+    never served for rules other than the ones that produced it. Values longer
+    than max_value_length are not cached, which bounds the memory used.
+    Only used from the proxy's event loop thread, so there is no locking.
+    """
+    def __init__(self, max_entries, max_value_length):
+        self.max_entries = max_entries
+        self.max_value_length = max_value_length
+        self.version = None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def set_version(self, version):
+        """
+        Switch to a ruleset version, dropping verdicts of any other version
+        """
+        if version != self.version:
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+            self.version = version
+
+    def get(self, location, value):
+        """
+        Returns the cached verdict, or MISS
+        """
+        key = (location, value)
+        verdict = self._entries.get(key, MISS)
+        if verdict is MISS:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return verdict
+
+    def put(self, location, value, verdict):
+        if len(value) > self.max_value_length or self.max_entries <= 0:
+            return
+        self._entries[(location, value)] = verdict
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -1,92 +1,289 @@
-import variables  # Import the module, not just the variable
-from security_utils import apply_blocking_rules
+import functools
+import time
+import metrics
+from config import current, get_flow_config
+from security_utils import apply_header_rules, apply_body_rules, BLOCK_REASON_KEY
+from body_inspector import BodyInspector, BODY_INSPECTOR_KEY
 from brute_force import handle_login_response, check_brute_force
-from detection.login_detection import is_login_request, get_domain
+from rate_limiting import check_rate_limit
+from detection.login_detection import is_login_request, get_login_info
 from persistence.ip_blocking import is_ip_blocked_for_domain
+from log_writer import log_writer
+from waf_logger import get_logger
 from mitmproxy import http
+from mitmproxy.net import encoding
 import os
 
+_startup_log = get_logger("startup")
+_request_log = get_logger("proxy.request")
+_blocked_log = get_logger("blocked")
+_login_log = get_logger("login")
+
 def clear_logs():
     """
     Clears the log files if `CLEAR_LOGS_ON_START` is set to True.
     """
+    config = current()
     # Only clear logs if CLEAR_LOGS_ON_START is True
-    if variables.CLEAR_LOGS_ON_START:
-        print("Clearing existing logs (CLEAR_LOGS_ON_START=True)...")
-        for log_path in [variables.REQUEST_LOG_PATH, variables.RESPONSE_LOG_PATH]:
+    if config.CLEAR_LOGS_ON_START:
+        _startup_log.info("Clearing existing logs (CLEAR_LOGS_ON_START=True)...")
+        for log_path in [config.REQUEST_LOG_PATH, config.RESPONSE_LOG_PATH]:
             try:
                 with open(log_path, "w") as log_file:
                     pass  # Create empty file
-                print(f"Cleared log file: {log_path}")
+                _startup_log.info("Cleared log file: %s", log_path)
             except Exception as e:
-                print(f"Error clearing log file {log_path}: {e}")
+                _startup_log.error("Error clearing log file %s: %s", log_path, e)
     else:
-        print("Skipping log clearing (CLEAR_LOGS_ON_START=False)")
+        _startup_log.info("Skipping log clearing (CLEAR_LOGS_ON_START=False)")
         # Ensure log files exist but don't clear them
-        for log_path in [variables.REQUEST_LOG_PATH, variables.RESPONSE_LOG_PATH]:
+        for log_path in [config.REQUEST_LOG_PATH, config.RESPONSE_LOG_PATH]:
             try:
                 if not os.path.exists(log_path):
                     os.makedirs(os.path.dirname(log_path), exist_ok=True)
                     with open(log_path, "a"):
                         pass  # Create empty file if it doesn't exist
-                    print(f"Created log file: {log_path}")
+                    _startup_log.info("Created log file: %s", log_path)
             except Exception as e:
-                print(f"Error creating log file {log_path}: {e}")
+                _startup_log.error("Error creating log file %s: %s", log_path, e)
+
+def _request_body_size(flow):
+    """
+    Size of the body following the request headers, infinite if unknown
+    """
+    headers = flow.request.headers
+    if "transfer-encoding" in headers:
+        return float("inf")
+    try:
+        return int(headers.get("content-length", "0"))
+    except ValueError:
+        return float("inf")
+
+def _content_text(headers, raw_content):
+    """
+    Decode a message body for the log file
+    """
+    if not raw_content:
+        return ""
+    content_encoding = headers.get("content-encoding")
+    if content_encoding:
+        try:
+            raw_content = encoding.decode(raw_content, content_encoding)
+        except ValueError:
+            pass
+    return raw_content.decode("utf-8", errors="replace")
+
+def format_request_record(method, url, header_fields, raw_content):
+    """
+    Format a request log entry. Runs on the log writer thread.
+    """
+    headers = http.Headers(header_fields)
+    return (f"Request: {method} {url}\n"
+            f"Header: {headers}\n"
+            f"Content: {_content_text(headers, raw_content)}\n\n")
+
+def format_response_record(status_code, url, header_fields, raw_content):
+    """
+    Format a response log entry. Runs on the log writer thread.
+    """
+    headers = http.Headers(header_fields)
+    return (f"Response: {status_code} {url}\n"
+            f"Header: {headers}\n"
+            f"Content: {_content_text(headers, raw_content)}\n\n")
+
+# Set once a block was counted in the metrics
+BLOCK_COUNTED_KEY = "waf_block_counted"
+
+REQUESTS_METRIC = metrics.series("waf_requests_total")
+HEADER_RULES_METRIC = metrics.series("waf_stage_duration_seconds", (("stage", "header_rules"),))
+BODY_RULES_METRIC = metrics.series("waf_stage_duration_seconds", (("stage", "body_rules"),))
+LOGIN_RESPONSE_METRIC = metrics.series("waf_stage_duration_seconds", (("stage", "login_response"),))
+
+def _count_block(flow):
+    """
+    Count the block of a flow in the metrics, once
+    """
+    reason = flow.metadata.get(BLOCK_REASON_KEY)
+    if reason is not None and BLOCK_COUNTED_KEY not in flow.metadata:
+        flow.metadata[BLOCK_COUNTED_KEY] = True
+        location, _, rule = reason.partition("/")
+        metrics.inc(metrics.series("waf_blocks_total", (("location", location), ("rule", rule))))
+
+def _timed(stage):
+    """
+    Record the duration of a hook as a stage, and count the block it decided
+    """
+    stage_metric = metrics.series("waf_stage_duration_seconds", (("stage", stage),))
+    def decorate(hook):
+        @functools.wraps(hook)
+        def timed_hook(self, flow):
+            start = time.perf_counter()
+            try:
+                return hook(self, flow)
+            finally:
+                metrics.observe(stage_metric, time.perf_counter() - start)
+                _count_block(flow)
+        return timed_hook
+    return decorate
 
 class ProxyAddOn:
     """
     Mitmproxy Add-on for logging requests and responses.
     """
-    def request(self, flow):
+    @_timed("requestheaders")
+    def requestheaders(self, flow):
         """
-        Process incoming requests.
-        Logs the request first and then blocks it if a rule applies.
+        Process incoming request headers, before the body is read.
+        Blocked clients and requests failing the header rules are rejected here.
         """
-        # Only log the request if logging is enabled - always check the current value
-        if variables.ENABLE_LOGGING:
-            with open(variables.REQUEST_LOG_PATH, "a") as log_file:
-                log_file.write(f"Request: {flow.request.method} {flow.request.url}\n")
-                log_file.write(f"Header: {flow.request.headers}\n")
-                log_file.write(f"Content: {flow.request.text}\n\n")
-        
+        metrics.inc(REQUESTS_METRIC)
+        # The settings this flow is handled with, until its response
+        config = get_flow_config(flow)
         # Always log to console for debugging
-        print(f"Request: {flow.request.method} {flow.request.url}")
+        _request_log.debug("Request headers: %s %s", flow.request.method, flow.request.url)
 
         # Check if IP is blocked for this domain (direct check)
-        client_ip = flow.client_conn.address[0]
-        domain = get_domain(flow)
+        info = get_login_info(flow)
+        client_ip, domain = info.client_ip, info.domain
         is_blocked, time_left = is_ip_blocked_for_domain(client_ip, domain)
         
+        if is_blocked and time_left is None:
+            _blocked_log.info("REQUEST BLOCKED - IP %s is in a blocked network for domain %s", client_ip, domain)
+            flow.metadata[BLOCK_REASON_KEY] = "client/blocked_network"
+            flow.response = http.Response.make(
+                403,
+                b"<html><body><h1>403 Forbidden</h1><p>Requests from your network are not allowed.</p></body></html>",
+                {"Content-Type": "text/html"}
+            )
+            self._reject_early(flow)
+            return
         if is_blocked:
-            print(f"REQUEST BLOCKED - IP {client_ip} is blocked for domain {domain}")
+            _blocked_log.info("REQUEST BLOCKED - IP %s is blocked for domain %s", client_ip, domain)
+            flow.metadata[BLOCK_REASON_KEY] = "client/blocked_ip"
             flow.response = http.Response.make(
                 429,
                 f"<html><body><h1>429 Too Many Requests</h1><p>Your IP has been blocked for this domain due to too many failed login attempts. Try again in {time_left} seconds.</p></body></html>".encode(),
                 {"Content-Type": "text/html"}
             )
+            self._reject_early(flow)
+            return
+
+        # Clients sending more than their share get 429 before any inspection
+        if check_rate_limit(flow):
+            self._reject_early(flow)
             return
 
         # Special handling for login requests
-        if is_login_request(flow):
-            print(f"LOGIN REQUEST DETECTED in handler: {flow.request.url}")
+        login_request = info.is_login
+        if login_request:
+            _login_log.debug("LOGIN REQUEST DETECTED in handler: %s", flow.request.url)
             # For login requests, we'll delay the brute force check until response
 
         # Then check if the request should be blocked
-        if apply_blocking_rules(flow):
-            print("REQUEST BLOCKED - Returning 403 response")
+        start = time.perf_counter()
+        blocked = apply_header_rules(flow)
+        metrics.observe(HEADER_RULES_METRIC, time.perf_counter() - start)
+        if blocked:
+            _blocked_log.info("REQUEST BLOCKED - Returning %s response", flow.response.status_code)
+            self._reject_early(flow)
+            return
+
+        # Large bodies are inspected while they are streamed upstream.
+        # Login bodies stay buffered, their form is needed for the response.
+        body_size = _request_body_size(flow)
+        if body_size > config.STREAM_BODY_THRESHOLD and not login_request:
+            if body_size != float("inf") and body_size > config.MAX_INSPECT_BODY_SIZE \
+                    and config.OVERSIZED_BODY_POLICY == "block":
+                _blocked_log.info("REQUEST BLOCKED - Body of %s bytes is larger than %s bytes",
+                                  body_size, config.MAX_INSPECT_BODY_SIZE)
+                flow.metadata[BLOCK_REASON_KEY] = "body/too_large"
+                flow.response = http.Response.make(
+                    413,
+                    b"<html><body><h1>413 Payload Too Large</h1><p>The request body is too large to be inspected.</p></body></html>",
+                    {"Content-Type": "text/html"}
+                )
+                self._reject_early(flow)
+                return
+            # The inspector scans the bytes as sent: compressed bodies stay
+            # buffered and are inspected decoded like small ones
+            if flow.request.headers.get("content-encoding", "identity").strip().lower() != "identity":
+                return
+            inspector = BodyInspector(flow)
+            flow.metadata[BODY_INSPECTOR_KEY] = inspector
+            flow.request.stream = inspector
+
+    def _reject_early(self, flow):
+        """
+        A response set now is only sent after mitmproxy has read the whole
+        request body. Drop the connection instead if a large body is coming.
+        """
+        config = get_flow_config(flow)
+        if _request_body_size(flow) <= config.BLOCKED_BODY_READ_LIMIT:
+            return
+        # The request is logged here as the request hook will never run
+        if config.ENABLE_LOGGING:
+            log_writer.submit(config.REQUEST_LOG_PATH, format_request_record,
+                              flow.request.method, flow.request.url,
+                              flow.request.headers.fields, None)
+        _blocked_log.info("REQUEST BLOCKED - Dropping connection instead of reading the request body")
+        flow.kill()
+
+    @_timed("request")
+    def request(self, flow):
+        """
+        Process incoming requests once the body was read.
+        Logs the request first and then blocks it if a rule applies.
+        """
+        # A streamed body was inspected and forwarded chunk by chunk, it is not kept
+        inspector = flow.metadata.get(BODY_INSPECTOR_KEY)
+        config = get_flow_config(flow)
+
+        # Only log the request if logging is enabled
+        # Only immutable snapshots are queued; formatting and disk I/O happen on the writer thread
+        if config.ENABLE_LOGGING:
+            log_writer.submit(config.REQUEST_LOG_PATH, format_request_record,
+                              flow.request.method, flow.request.url,
+                              flow.request.headers.fields,
+                              None if inspector is not None else flow.request.raw_content)
+        
+        # Always log to console for debugging
+        _request_log.debug("Request: %s %s", flow.request.method, flow.request.url)
+
+        # Already answered at the requestheaders stage
+        if flow.response is not None:
+            return
+
+        if inspector is not None:
+            if inspector.verdict is not None:
+                # Part of the body went upstream already, so no error page
+                # can be sent in place of the response. The client connection
+                # is dropped once the server gives up on the incomplete body.
+                _blocked_log.info("REQUEST BLOCKED - Dropping connection after %s of the streamed body", inspector.forwarded)
+                flow.metadata[BLOCK_REASON_KEY] = inspector.block_reason()
+                flow.kill()
+            return
+
+        # Then check if the body should get the request blocked
+        start = time.perf_counter()
+        blocked = apply_body_rules(flow)
+        metrics.observe(BODY_RULES_METRIC, time.perf_counter() - start)
+        if blocked:
+            _blocked_log.info("REQUEST BLOCKED - Returning 403 response")
             return  # The request was blocked and not forwarded
 
+    @_timed("response")
     def response(self, flow):
         """
         Process outgoing responses.
         """
         # Process the response for login attempt tracking
         if is_login_request(flow):
-            print("Processing login response...")
+            _login_log.debug("Processing login response...")
             # Check if we should block due to brute force BEFORE handling the login attempt
             should_block, message = check_brute_force(flow)
             if should_block:
-                print(f"BRUTE FORCE DETECTED - Blocking response")
+                _blocked_log.info("BRUTE FORCE DETECTED - Blocking response")
+                flow.metadata[BLOCK_REASON_KEY] = "client/brute_force"
                 flow.response = http.Response.make(
                     429,
                     f"<html><body><h1>429 Too Many Requests</h1><p>{message}</p></body></html>".encode(),
@@ -96,14 +293,16 @@ class ProxyAddOn:
                 return
                 
             # Process the login response normally
+            start = time.perf_counter()
             handle_login_response(flow)
+            metrics.observe(LOGIN_RESPONSE_METRIC, time.perf_counter() - start)
             
-        # Regular response logging only if enabled - always check the current value
-        if variables.ENABLE_LOGGING:
-            with open(variables.RESPONSE_LOG_PATH, "a") as log_file:
-                log_file.write(f"Response: {flow.response.status_code} {flow.request.url}\n")
-                log_file.write(f"Header: {flow.response.headers}\n")
-                log_file.write(f"Content: {flow.response.text}\n\n")
+        # Regular response logging only if enabled
+        config = get_flow_config(flow)
+        if config.ENABLE_LOGGING:
+            log_writer.submit(config.RESPONSE_LOG_PATH, format_response_record,
+                              flow.response.status_code, flow.request.url,
+                              flow.response.headers.fields, flow.response.raw_content)
         
         # Always log to console for debugging
-        print(f"Response: {flow.response.status_code} {flow.request.url}")
+        _request_log.debug("Response: %s %s", flow.response.status_code, flow.request.url)
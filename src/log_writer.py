@@ -0,0 +1,211 @@
+import atexit
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; only one process writes there
+    fcntl = None
+
+from config import current
+import metrics
+from waf_logger import get_logger
+
+_log = get_logger("log_writer")
+
+class LogWriter:
+    """
+    Background writer for the request and response logs.
+
+    Records are queued as (path, format_function, args) and only formatted
+    and written by the writer thread, in batches that are flushed once
+    LOG_BATCH_SIZE records are waiting or LOG_FLUSH_INTERVAL seconds have
+    passed. When the queue is full, LOG_QUEUE_FULL_POLICY decides whether new
+    records are dropped ("drop") or the caller waits for room ("block").
+
+    Proxy workers each run their own writer on the same files, so a file is
+    locked while a batch is written to it or while it is rotated.
+    """
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.written = 0  # Records written so far
+        self.dropped = 0  # Records dropped because the queue was full
+        self.rotations = 0
+        self._reported_drops = 0
+
+    def start(self):
+        """
+        Start the writer thread if it is not running yet
+        """
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._queue = queue.Queue(maxsize=max(1, current().LOG_QUEUE_SIZE))
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def submit(self, path, format_record, *args):
+        """
+        Queue a record for writing. Never touches the disk.
+        Returns False if the record was dropped.
+        """
+        if self._thread is None:
+            self.start()
+
+        record = (path, format_record, args)
+        if current().LOG_QUEUE_FULL_POLICY == "block":
+            self._queue.put(record)
+            return True
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout=5.0):
+        """
+        Write everything that is still queued and stop the writer thread
+        """
+        with self._start_lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._thread = None
+        try:
+            # Blocking put: the sentinel must not be lost when the queue is full
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def queue_size(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            batch = [record]
+            stop = False
+            config = current()
+            deadline = time.monotonic() + config.LOG_FLUSH_INTERVAL
+            while len(batch) < config.LOG_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        # Group by file, keeping the order of records within each file
+        chunks = {}
+        for path, format_record, args in batch:
+            try:
+                text = format_record(*args)
+            except Exception as e:
+                text = f"Error formatting log record: {e}\n\n"
+            chunks.setdefault(path, []).append(text)
+
+        dropped = self.dropped
+        if dropped != self._reported_drops:
+            _log.warning("Log writer queue full: %s log records dropped", dropped - self._reported_drops)
+            self._reported_drops = dropped
+
+        for path, texts in chunks.items():
+            try:
+                log_file = self._open_locked(path)
+                try:
+                    if self._rotate_if_needed(path, log_file):
+                        log_file.close()
+                        log_file = self._open_locked(path)
+                    log_file.write("".join(texts))
+                finally:
+                    log_file.close()  # Also releases the lock
+                self.written += len(texts)
+            except Exception as e:
+                _log.error("Error writing log file %s: %s", path, e)
+
+    def _open_locked(self, path):
+        """
+        Open the log file for appending, holding an exclusive lock on it
+        """
+        while True:
+            log_file = open(path, "a")
+            if fcntl is None:
+                return log_file
+            fcntl.flock(log_file, fcntl.LOCK_EX)
+            # Another process may have rotated the file while we waited
+            try:
+                if os.stat(path).st_ino == os.fstat(log_file.fileno()).st_ino:
+                    return log_file
+            except FileNotFoundError:
+                pass
+            log_file.close()
+
+    def _rotate_if_needed(self, path, log_file):
+        """
+        Rotate the locked log file once it is too big
+        Returns True if it was rotated
+        """
+        max_bytes = current().LOG_MAX_BYTES
+        if max_bytes <= 0 or os.fstat(log_file.fileno()).st_size < max_bytes:
+            return False
+
+        backups = max(0, current().LOG_BACKUP_COUNT)
+        if backups == 0:
+            # Nothing to keep, just start over
+            log_file.truncate(0)
+            self.rotations += 1
+            return False
+
+        # Shift path.1 -> path.2 and so on, dropping the oldest backup
+        for index in range(backups, 0, -1):
+            for suffix in ("", ".gz"):
+                source = f"{path}.{index}{suffix}"
+                if not os.path.exists(source):
+                    continue
+                if index == backups:
+                    os.remove(source)
+                else:
+                    os.replace(source, f"{path}.{index + 1}{suffix}")
+
+        os.replace(path, f"{path}.1")
+        open(path, "a").close()
+        self.rotations += 1
+
+        if current().LOG_COMPRESS_ROTATED:
+            with open(f"{path}.1", "rb") as source, gzip.open(f"{path}.1.gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(f"{path}.1")
+        return True
+
+# Shared writer used by the proxy add-on
+log_writer = LogWriter()
+
+def _collect_log_writer_metrics():
+    return [
+        ("waf_log_queue_size", (), log_writer.queue_size()),
+        ("waf_log_records_total", (("result", "written"),), log_writer.written),
+        ("waf_log_records_total", (("result", "dropped"),), log_writer.dropped),
+    ]
+
+metrics.register_collector(_collect_log_writer_metrics)
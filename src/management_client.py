@@ -0,0 +1,41 @@
+import json
+import socket
+
+# Seconds a management request may take
+REQUEST_TIMEOUT = 5.0
+
+class ManagementError(Exception):
+    """
+    The proxy refused a management request
+    """
+
+class ManagementClient:
+    """
+    Sends requests to the proxy's management server (see management_server)
+
+    Used by the web interface's process. Each request opens its own
+    connection: requests are rare, and the web server may serve several
+    browsers at once.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def request(self, op, **fields):
+        """
+        Returns the result of the request
+        Raises ManagementError if the proxy refused it, OSError if the
+        proxy cannot be reached
+        """
+        fields["op"] = op
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(REQUEST_TIMEOUT)
+            connection.connect(self.path)
+            connection.sendall(json.dumps(fields, separators=(',', ':')).encode() + b"\n")
+            with connection.makefile("rb") as reader:
+                line = reader.readline()
+        if not line:
+            raise ConnectionResetError("the management server closed the connection")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise ManagementError(reply["error"])
+        return reply["result"]
@@ -0,0 +1,391 @@
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from config import current, publish, parse_setting, ConfigError
+from persistence.ip_blocking import blocked_ips, unblock_key, clear_blocked_ips
+from persistence.ip_lists import get_ip_list_stats, reload_ip_lists
+from persistence.prefix_trie import IPV4_BITS, parse_prefix, parse_address
+from persistence.state_backend import get_backend
+from security_utils import HEADER_VERDICTS
+from detection.rules import get_rules, reload_rules, RuleFileError
+from rate_limiting import get_rate_limit_stats
+from metrics import render_prometheus
+from waf_logger import get_logger
+
+_log = get_logger("management")
+
+# Blocked IPs returned per page unless asked otherwise, and at most
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+class ManagementServer:
+    """
+    Serves the proxy's state and actions to the web interface, which runs
+    in its own process (see web_interface).
+
+    Runs in the proxy process, or in the supervisor with several workers,
+    and talks JSON lines over a Unix socket, one reply per request:
+
+        {"op": "status"}                          settings and stats
+        {"op": "blocked_ips", "offset": n, "limit": n, "ip": address or CIDR,
+         "domain": ..., "order": "newest" or "oldest"}  one page of blocks
+        {"op": "unblock", "key": ...}             remove a block
+        {"op": "clear_blocked_ips"}               remove all blocks
+        {"op": "update_settings", "values": {name: text}}
+        {"op": "reset_logs", "log_type": ...}     empty log files
+        {"op": "reload_rules"}, {"op": "reload_ip_lists"}
+        {"op": "metrics"}                         the Prometheus page
+
+    Replies are {"result": ...} or {"error": message}. Every request costs
+    the proxy a lookup or a page of blocks; rendering pages and serving
+    browsers is left to the web interface's process.
+
+    With several workers the supervisor inspects no traffic: the stats
+    shown are the ones the workers last reported, and reloads are checked
+    here, then passed on to every worker (see set_workers).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, _Handler)
+        self._server.daemon_threads = True
+        os.chmod(self.path, 0o600)
+        threading.Thread(target=self._server.serve_forever, name="management-server", daemon=True).start()
+        _log.info("Management server listening on %s", self.path)
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    reply = {"result": _OPS[message["op"]](message)}
+                except KeyError as e:
+                    reply = {"error": f"Unknown request or missing field: {e}"}
+                except (ValueError, TypeError, OSError, RuleFileError) as e:
+                    # ConfigError is a ValueError
+                    reply = {"error": str(e)}
+                self.connection.sendall(json.dumps(reply, separators=(',', ':')).encode() + b"\n")
+        except OSError:
+            pass
+
+# The supervisor's StateDaemon when the proxy runs as several workers
+_workers = None
+
+def set_workers(state_daemon):
+    """
+    Show the stats reported by the workers of state_daemon, and pass
+    reloads on to them
+    """
+    global _workers
+    _workers = state_daemon
+
+def get_proxy_stats():
+    """
+    Stats of the traffic inspected by this process
+    """
+    return {
+        "verdict_cache_stats": HEADER_VERDICTS.get_stats(),
+        "rule_stats": get_rules().get_stats(),
+        "rate_limit_stats": get_rate_limit_stats(),
+        "ip_list_stats": get_ip_list_stats(),
+    }
+
+def _sum_counts(stats_list):
+    """
+    Add up the numbers of several stats dicts, key by key
+    """
+    total = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                total[key] = _sum_counts([total.get(key, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+            else:
+                total.setdefault(key, value)
+    return total
+
+def _merge_worker_stats(worker_stats):
+    """
+    The stats of all workers: caches and rate limits add up, rules and IP
+    lists are each worker's own copy, so the first worker's are shown and
+    every worker's versions are listed
+    """
+    workers = sorted(worker_stats.items(), key=lambda item: int(item[0]) if item[0].isdigit() else item[0])
+    verdict_cache_stats = _sum_counts([stats["verdict_cache_stats"] for _, stats in workers])
+    lookups = verdict_cache_stats.get("hits", 0) + verdict_cache_stats.get("misses", 0)
+    verdict_cache_stats["hit_rate"] = verdict_cache_stats.get("hits", 0) / lookups if lookups else 0.0
+    return {
+        "verdict_cache_stats": verdict_cache_stats,
+        "rule_stats": workers[0][1]["rule_stats"],
+        "rate_limit_stats": _sum_counts([stats["rate_limit_stats"] for _, stats in workers]),
+        "ip_list_stats": workers[0][1]["ip_list_stats"],
+        "workers": [{"worker": worker,
+                     "rule_version": stats["rule_stats"]["version"],
+                     "rules": stats["rule_stats"]["rules"],
+                     "ip_lists": {name: list_stats["prefixes"]
+                                  for name, list_stats in stats["ip_list_stats"].items()}}
+                    for worker, stats in workers],
+    }
+
+def get_status(message=None):
+    """
+    Settings and stats shown on the web interface's main page
+    """
+    settings = current()
+    worker_stats = _workers.get_worker_stats() if _workers is not None else {}
+    if worker_stats:
+        proxy_stats = _merge_worker_stats(worker_stats)
+    else:
+        proxy_stats = dict(get_proxy_stats(), workers=[])
+    return dict(proxy_stats, **{
+        "config": {"version": settings.version, "source": settings.source},
+        "settings": settings.as_dict(),
+        "blocked_count": len(blocked_ips),
+        "state_stats": get_backend().get_stats(),
+        "log_sizes": {
+            'requests': get_file_size(settings.REQUEST_LOG_PATH),
+            'responses': get_file_size(settings.RESPONSE_LOG_PATH),
+            'pcap': get_file_size(getattr(settings, 'PCAP_LOG_PATH', '')),
+            'blocked_ips': get_file_size(settings.BLOCKED_IPS_FILE),
+        },
+    })
+
+def get_blocked_page(message):
+    """
+    One page of blocked IPs, newest first unless "order" is "oldest",
+    keeping those whose IP is "ip" or in the "ip" network (CIDR) and whose
+    domain contains "domain"
+    Returns the blocks of the page and how many match in total. A filtered
+    page stops counting one match past the page: "more" is then true and
+    the total is only a lower bound.
+    """
+    offset = max(0, int(message.get("offset", 0)))
+    limit = min(MAX_PAGE_SIZE, max(1, int(message.get("limit", DEFAULT_PAGE_SIZE))))
+    ip_filter = message.get("ip") or ""
+    domain_filter = message.get("domain") or ""
+    newest_first = message.get("order", "newest") != "oldest"
+    more = False
+
+    if not ip_filter and not domain_filter:
+        # A single C call, so no block changes in the middle of it, and
+        # only offset + limit entries are walked however many there are
+        items = blocked_ips.items()
+        page = list(itertools.islice(reversed(items) if newest_first else items, offset, offset + limit))
+        total = len(blocked_ips)
+    else:
+        # Raises ValueError, returned to the web interface
+        network, key_starts = _parse_ip_filter(ip_filter) if ip_filter else (None, "")
+        # Filtered on a copy of the keys: the loop lets the proxy's
+        # threads run, and blocks may come and go meanwhile. A big attack
+        # can leave millions of blocks, so the walk ends with the page, and
+        # cheap text tests rule out most keys before they are split
+        keys = list(blocked_ips)
+        if newest_first:
+            keys.reverse()
+        page = []
+        total = 0
+        for key in keys:
+            if not key.startswith(key_starts) or domain_filter not in key:
+                continue
+            ip, domain = _split_key(key)
+            if domain_filter not in domain or (network is not None and not _in_network(ip, network)):
+                continue
+            if total == offset + limit:
+                more = True
+                total += 1
+                break
+            if total >= offset:
+                block_time = blocked_ips.get(key)
+                if block_time is not None:
+                    page.append((key, block_time))
+            total += 1
+
+    current_time = time.time()
+    return {
+        "total": total,
+        "more": more,
+        "offset": offset,
+        "limit": limit,
+        "blocks": [{"key": key,
+                    "ip": _split_key(key)[0],
+                    "domain": _split_key(key)[1] or 'unknown',
+                    "until": block_time,
+                    "time_left": max(0, block_time - current_time)}
+                   for key, block_time in page],
+    }
+
+def _parse_ip_filter(ip_filter):
+    """
+    Returns the network of an address or CIDR, as parse_prefix does, and
+    the text that the keys of its addresses start with (a str or a tuple)
+    Raises ValueError
+    """
+    network = parse_prefix(ip_filter)
+    bits, value, length = network
+    if bits == IPV4_BITS:
+        octets = [str(octet) for octet in value.to_bytes(4, "big")[:length // 8]]
+        if not octets:
+            return network, ""
+        text = ".".join(octets) + ("." if len(octets) < 4 else ":")
+        # Dual-stack sockets report IPv4 clients as mapped IPv6 addresses
+        return network, (text, "::ffff:" + text)
+    if length == bits:
+        return network, socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, "big")) + ":"
+    # The canonical text shares the leading groups, up to the first zero
+    # one: zeros may be shortened to "::"
+    groups = []
+    for index in range(length // 16):
+        group = value >> (bits - 16 * (index + 1)) & 0xffff
+        if group == 0:
+            break
+        groups.append(f"{group:x}")
+    return network, ":".join(groups) + ":" if groups else ""
+
+def _in_network(ip, network):
+    """
+    Whether the address ip is in network, as returned by parse_prefix
+    """
+    bits, value, length = network
+    try:
+        ip_bits, ip_value = parse_address(ip)
+    except ValueError:
+        return False
+    return ip_bits == bits and ip_value >> (bits - length) == value >> (bits - length)
+
+def _split_key(key):
+    """
+    (ip, domain) of a block key "ip:domain", where the domain may carry a port
+    """
+    ip, _, domain = key.partition(':')
+    if '.' in ip:
+        return ip, domain
+    # IPv6 addresses hold colons too: the address is the longest valid start
+    end = len(key)
+    while True:
+        end = key.rfind(':', 0, end)
+        if end <= 0:
+            return ip, domain
+        try:
+            parse_address(key[:end])
+            return key[:end], key[end + 1:]
+        except ValueError:
+            pass
+
+def update_settings(message):
+    """
+    Parse the text of each setting and publish them all as one new version
+    """
+    changes = {}
+    errors = []
+    for key, text in message["values"].items():
+        try:
+            changes[key] = parse_setting(key, text)
+        except ConfigError as e:
+            errors.append(f'Error updating {key}: {str(e)}')
+    old_config = current()
+    new_config = publish(changes, source='web interface')
+    updated = {key: getattr(new_config, key) for key in changes
+               if getattr(new_config, key) != getattr(old_config, key)}
+    return {"updated": updated, "errors": errors, "settings": new_config.as_dict()}
+
+def reset_logs(message):
+    """
+    Empty the log files of "log_type" ("requests", "responses", "pcap" or "all")
+    """
+    log_type = message.get("log_type", "all")
+    settings = current()
+    paths = {
+        'requests': settings.REQUEST_LOG_PATH,
+        'responses': settings.RESPONSE_LOG_PATH,
+        'pcap': getattr(settings, 'PCAP_LOG_PATH', ''),
+    }
+    cleared = []
+    for name, path in paths.items():
+        if log_type == name or log_type == 'all':
+            clear_file(path)
+            cleared.append(name)
+    return {"cleared": cleared}
+
+def _reload_rules(message):
+    # Loaded here first, so a broken file is reported and never sent on
+    rule_set = reload_rules()
+    workers = _workers.broadcast_reload("rules") if _workers is not None else 0
+    return {"rules": len(rule_set.rules), "version": rule_set.version, "workers": workers}
+
+def _reload_ip_lists(message):
+    lists = reload_ip_lists()
+    workers = _workers.broadcast_reload("ip_lists") if _workers is not None else 0
+    return {"blocked": len(lists.blocked), "allowed": len(lists.allowed), "workers": workers}
+
+def _unblock(message):
+    return {"unblocked": unblock_key(message["key"])}
+
+def _clear_blocked_ips(message):
+    clear_blocked_ips()
+    return {}
+
+def _metrics(message):
+    return {"text": render_prometheus()}
+
+_OPS = {
+    "status": get_status,
+    "blocked_ips": get_blocked_page,
+    "unblock": _unblock,
+    "clear_blocked_ips": _clear_blocked_ips,
+    "update_settings": update_settings,
+    "reset_logs": reset_logs,
+    "reload_rules": _reload_rules,
+    "reload_ip_lists": _reload_ip_lists,
+    "metrics": _metrics,
+}
+
+def get_file_size(filepath):
+    """Get the size of a file in human-readable format"""
+    try:
+        if os.path.exists(filepath):
+            size_bytes = os.path.getsize(filepath)
+            # Convert to KB, MB, etc.
+            for unit in ['B', 'KB', 'MB', 'GB']:
+                if size_bytes < 1024.0:
+                    return f"{size_bytes:.2f} {unit}"
+                size_bytes /= 1024.0
+            return f"{size_bytes:.2f} TB"
+        return "0 B"
+    except Exception:
+        return "Error"
+
+def clear_file(filepath):
+    """Clear the contents of a file"""
+    with open(filepath, 'w') as f:
+        pass
+
+_server = None
+
+def start_management_server():
+    """
+    Serve the management requests on MANAGEMENT_SOCKET_PATH
+    """
+    global _server
+    if _server is None:
+        _server = ManagementServer(current().MANAGEMENT_SOCKET_PATH)
+        _server.start()
+    return _server
@@ -0,0 +1,189 @@
+import threading
+from bisect import bisect_left
+
+import variables
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Every metric with its Prometheus type and help text
+METRICS = {
+    "waf_requests_total": ("counter", "Requests seen by the proxy"),
+    "waf_stage_duration_seconds": ("histogram", "Time spent per request in each processing stage"),
+    "waf_blocks_total": ("counter", "Requests blocked, by where the rule fired and which rule"),
+    "waf_detector_calls_total": ("counter", "Values inspected by each signature set"),
+    "waf_rule_hits_total": ("counter", "Matches per signature rule"),
+    "waf_match_budget_exceeded_total": ("counter", "Values whose signature search ran out of time"),
+    "waf_failed_logins_total": ("counter", "Failed login attempts recognized in responses"),
+    "waf_verdict_cache_entries": ("gauge", "Header verdicts currently cached"),
+    "waf_verdict_cache_lookups_total": ("counter", "Header verdict cache lookups, by result"),
+    "waf_verdict_cache_evictions_total": ("counter", "Header verdicts evicted from the cache"),
+    "waf_log_queue_size": ("gauge", "Log records waiting for the writer thread"),
+    "waf_log_records_total": ("counter", "Log records written or dropped because the queue was full"),
+    "waf_rule_reloads_total": ("counter", "Rule file loads, by result"),
+    "waf_rules_version": ("gauge", "Version of the active rule set, bumped on every reload"),
+    "waf_config_version": ("gauge", "Version of the active settings, bumped on every publish"),
+    "waf_rate_limit_keys": ("gauge", "Keys with a token bucket, by kind of bucket"),
+    "waf_ip_list_prefixes": ("gauge", "Network prefixes on the block and allow lists"),
+    "waf_blocked_ips": ("gauge", "IP and domain pairs currently blocked"),
+    "waf_failed_login_keys": ("gauge", "IP and domain pairs with tracked failed logins"),
+}
+
+class Series:
+    """
+    One metric with one set of label values. Get it from series() once and
+    keep it: counting by series is a dict update keyed by the object itself,
+    so the name and labels are not hashed on every call.
+    """
+    __slots__ = ("name", "labels")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+class _Shard:
+    """
+    Counters and histograms written by one thread only
+    """
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters = {}  # Series -> value
+        self.histograms = {}  # Series -> [bucket counts, sum]
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()  # Only taken when a thread writes its first metric
+_collectors = []
+_remote_sources = []
+_series = {}  # (name, labels) -> Series
+
+def series(name, labels=()):
+    """
+    The Series of a metric and a tuple of (label, value) pairs
+    """
+    key = (name, labels)
+    found = _series.get(key)
+    if found is None:
+        # setdefault keeps one Series per key when two threads race here
+        found = _series.setdefault(key, Series(name, labels))
+    return found
+
+def _new_shard():
+    shard = _Shard()
+    _local.counters = shard.counters
+    _local.histograms = shard.histograms
+    with _shards_lock:
+        _shards.append(shard)
+    return shard
+
+def inc(counter, value=1):
+    """
+    Add to the counter of a Series
+    Each thread counts into its own shard, so no lock is taken.
+    """
+    if not variables.ENABLE_METRICS:
+        return
+    try:
+        counters = _local.counters
+    except AttributeError:
+        counters = _new_shard().counters
+    counters[counter] = counters.get(counter, 0) + value
+
+def observe(histogram_series, seconds):
+    """
+    Record a duration in the latency histogram of a Series
+    """
+    if not variables.ENABLE_METRICS:
+        return
+    try:
+        histograms = _local.histograms
+    except AttributeError:
+        histograms = _new_shard().histograms
+    histogram = histograms.get(histogram_series)
+    if histogram is None:
+        histogram = histograms[histogram_series] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+    histogram[0][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram[1] += seconds
+
+def register_collector(collect):
+    """
+    Add a function returning [(name, labels, value), ...], called on every
+    scrape for values that are read rather than counted (cache sizes, queues)
+    """
+    _collectors.append(collect)
+
+def add_remote_source(get_snapshots):
+    """
+    Add a function returning {worker id: snapshot} of other processes
+    """
+    _remote_sources.append(get_snapshots)
+
+def snapshot():
+    """
+    Sum of all shards plus the collected values, in a JSON friendly form
+    """
+    counters = {}
+    histograms = {}
+    with _shards_lock:
+        shards = list(_shards)
+    for shard in shards:
+        # Copying a dict does not let other threads in, so the copy is consistent
+        for counter, value in dict(shard.counters).items():
+            key = (counter.name, counter.labels)
+            counters[key] = counters.get(key, 0) + value
+        for histogram_series, (counts, total) in dict(shard.histograms).items():
+            key = (histogram_series.name, histogram_series.labels)
+            merged = histograms.get(key)
+            if merged is None:
+                merged = histograms[key] = [[0] * len(counts), 0.0]
+            for index, count in enumerate(list(counts)):
+                merged[0][index] += count
+            merged[1] += total
+    gauges = []
+    for collect in _collectors:
+        gauges.extend([name, list(labels), value] for name, labels, value in collect())
+    return {
+        "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+        "histograms": [[name, list(labels), counts, total] for (name, labels), (counts, total) in histograms.items()],
+        "gauges": gauges,
+    }
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+def render_prometheus():
+    """
+    All metrics of this process and the remote sources in the Prometheus text format
+    Series of other processes carry a worker label
+    """
+    sources = [((), snapshot())]
+    for get_snapshots in _remote_sources:
+        for worker, remote in sorted(get_snapshots().items()):
+            sources.append(((("worker", worker),), remote))
+
+    lines_by_name = {}
+    for extra, data in sources:
+        for name, labels, value in data["counters"] + data["gauges"]:
+            lines_by_name.setdefault(name, []).append(f"{name}{_format_labels(labels, extra)} {value}")
+        for name, labels, counts, total in data["histograms"]:
+            lines = lines_by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, tuple(extra) + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels, extra)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels, extra)} {cumulative}")
+
+    output = []
+    for name in sorted(lines_by_name):
+        metric_type, help_text = METRICS.get(name, ("untyped", ""))
+        output.append(f"# HELP {name} {help_text}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(lines_by_name[name])
+    return "\n".join(output) + "\n"
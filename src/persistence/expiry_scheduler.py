@@ -0,0 +1,72 @@
+import heapq
+import threading
+import time
+
+from waf_logger import get_logger
+
+_log = get_logger("expiry")
+
+class ExpiryScheduler:
+    """
+    Min-heap of (deadline, key) entries with a sweeper thread that calls
+    expire(key, deadline) once a deadline has passed.
+
+    Scheduling is O(log n) and the sweeper sleeps until the earliest deadline,
+    so expired entries are evicted promptly without ever scanning the whole
+    store. Entries are never removed from the heap early: when a key is
+    re-scheduled or removed, expire() gets the old deadline and has to check
+    it against the store (see lock).
+    """
+    def __init__(self, name, expire):
+        self.name = name
+        self._expire = expire
+        self._heap = []
+        # Held while expire() runs; callers take it around their own updates of
+        # the store so a deadline is never checked against a half-made change
+        self.lock = threading.RLock()
+        self._wakeup = threading.Condition(self.lock)
+        self._thread = None
+        self.expired = 0  # Number of expire() calls so far
+
+    def schedule(self, key, deadline):
+        """
+        Call expire(key, deadline) once the deadline (a time.time() value) has passed
+        """
+        with self.lock:
+            heapq.heappush(self._heap, (deadline, key))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"{self.name}-expiry", daemon=True)
+                self._thread.start()
+            elif self._heap[0][0] == deadline:
+                # New earliest deadline, the sweeper has to wake up sooner
+                self._wakeup.notify()
+
+    def clear(self):
+        with self.lock:
+            self._heap.clear()
+
+    def next_deadline(self):
+        with self.lock:
+            return self._heap[0][0] if self._heap else None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _run(self):
+        with self.lock:
+            while True:
+                if not self._heap:
+                    self._wakeup.wait()
+                    continue
+                now = time.time()
+                delay = self._heap[0][0] - now
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, key = heapq.heappop(self._heap)
+                    try:
+                        self._expire(key, deadline)
+                    except Exception as e:
+                        _log.error("Error expiring %s entry %s: %s", self.name, key, e)
+                    self.expired += 1
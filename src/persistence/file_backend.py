@@ -0,0 +1,213 @@
+import json
+import os
+import threading
+import time
+
+from config import current
+from persistence.state_backend import StateBackend
+from waf_logger import get_logger
+
+_log = get_logger("ip_blocking")
+
+class FileBackend(StateBackend):
+    """
+    Blocks kept in a JSON snapshot plus an append-only journal of the changes
+    made since that snapshot; failed logins are counted in memory.
+
+    Blocking an IP only appends one line to the journal. Once the journal grows
+    past BLOCKED_IPS_COMPACT_EVERY records it is folded into a new snapshot in
+    the background. Snapshots are written to a temporary file and renamed into
+    place, so a crash can never leave a half-written snapshot behind.
+    """
+    name = "file"
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.journal_path = path + ".journal"
+        # Journal being folded into a snapshot by a running (or interrupted) compaction
+        self.compacting_journal_path = path + ".journal.compacting"
+        self._blocks = {}  # What the snapshot plus journal add up to
+        self._lock = threading.RLock()  # Guards the files and compaction hand-over
+        self._journal = None  # Open journal file, or None
+        self._journal_records = 0  # Records appended since the last compaction
+        self._compacting = False
+        self._snapshot_generation = 0  # Bumped by every synchronous save
+
+    def load(self, clear=False):
+        with self._lock:
+            self._close_journal()
+            self._blocks = {}
+
+            # Start with an empty store instead of loading
+            if clear:
+                _log.info("Clearing blocked IPs list due to CLEAR_LOGS_ON_START=True")
+                self.save()  # Save empty dict to clear the files
+                return {}
+
+            try:
+                if os.path.exists(self.path):
+                    with open(self.path, 'r') as f:
+                        self._blocks.update(json.load(f))
+            except Exception as e:
+                _log.error("Error loading blocked IPs file: %s", e)
+                self._blocks = {}
+
+            replayed = 0
+            for journal_path in (self.compacting_journal_path, self.journal_path):
+                replayed += self._replay_journal(journal_path)
+
+            # Expired blocks are not worth keeping
+            current_time = time.time()
+            self._blocks = {key: block_time for key, block_time in self._blocks.items() if block_time > current_time}
+
+            _log.info("Loaded %s blocked IPs (%s journal records replayed)", len(self._blocks), replayed)
+            # Start from a fresh snapshot and an empty journal
+            if os.path.exists(self.journal_path) or os.path.exists(self.compacting_journal_path):
+                self.save()
+            return dict(self._blocks)
+
+    def _replay_journal(self, journal_path):
+        """
+        Apply the records of a journal file
+        Returns the number of records applied
+        """
+        if not os.path.exists(journal_path):
+            return 0
+        applied = 0
+        try:
+            with open(journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-append
+                        continue
+                    self._apply_record(record)
+                    applied += 1
+        except Exception as e:
+            _log.error("Error replaying blocked IPs journal %s: %s", journal_path, e)
+        return applied
+
+    def _apply_record(self, record):
+        op = record.get("op")
+        if op == "block":
+            self._blocks[record["key"]] = record["until"]
+        elif op == "unblock":
+            self._blocks.pop(record["key"], None)
+        elif op == "clear":
+            self._blocks.clear()
+
+    def record_change(self, record):
+        """
+        Append one change to the journal and start a compaction when it is due
+        """
+        with self._lock:
+            self._apply_record(record)
+            try:
+                if self._journal is None:
+                    self._journal = open(self.journal_path, 'a')
+                self._journal.write(json.dumps(record, separators=(',', ':')) + "\n")
+                self._journal.flush()
+                self._journal_records += 1
+            except Exception as e:
+                _log.error("Error writing blocked IPs journal: %s", e)
+                self._close_journal()
+                return
+            if self._journal_records >= current().BLOCKED_IPS_COMPACT_EVERY and not self._compacting:
+                self._start_compaction()
+
+    def _close_journal(self):
+        if self._journal is not None:
+            try:
+                self._journal.close()
+            except OSError:
+                pass
+            self._journal = None
+
+    def _start_compaction(self):
+        """
+        Hand the current journal over to a background compaction
+        Must be called with _lock held
+        """
+        if os.path.exists(self.compacting_journal_path):
+            # A failed compaction left its journal behind, and it is not in
+            # the snapshot yet: fold both journals into a snapshot right away
+            # rather than overwrite it with the current one
+            self.save()
+            return
+        self._close_journal()
+        try:
+            os.replace(self.journal_path, self.compacting_journal_path)
+        except OSError as e:
+            _log.error("Error rotating blocked IPs journal: %s", e)
+            return
+        self._journal_records = 0
+        self._compacting = True
+        # The snapshot must reflect everything in the handed-over journal;
+        # expired blocks are dropped here so _blocks does not keep growing
+        current_time = time.time()
+        self._blocks = {key: block_time for key, block_time in self._blocks.items() if block_time > current_time}
+        snapshot = dict(self._blocks)
+        threading.Thread(target=self._compact, args=(snapshot, self._snapshot_generation),
+                         name="blocked-ips-compaction", daemon=True).start()
+
+    def _compact(self, snapshot, generation):
+        temp_file = None
+        try:
+            # The slow part happens without holding the lock
+            temp_file = self._write_temp_snapshot(snapshot)
+            with self._lock:
+                # A synchronous save in the meantime already wrote a newer snapshot
+                # and removed the handed-over journal
+                if generation == self._snapshot_generation:
+                    os.replace(temp_file, self.path)
+                    os.remove(self.compacting_journal_path)
+                    temp_file = None
+        except Exception as e:
+            _log.error("Error compacting blocked IPs journal: %s", e)
+        finally:
+            if temp_file is not None and os.path.exists(temp_file):
+                os.remove(temp_file)
+            with self._lock:
+                self._compacting = False
+
+    def _write_temp_snapshot(self, snapshot):
+        """
+        Write the live blocks to a temporary file next to the snapshot, synced to disk
+        Returns the temporary file name
+        """
+        current_time = time.time()
+        live = {key: block_time for key, block_time in snapshot.items() if block_time > current_time}
+        temp_file = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(live, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return temp_file
+
+    def save(self):
+        """
+        Save the blocks to a new snapshot right away and empty the journal
+        """
+        with self._lock:
+            try:
+                self._close_journal()
+                os.replace(self._write_temp_snapshot(dict(self._blocks)), self.path)
+                self._snapshot_generation += 1
+                # The new snapshot covers every journal, including one being compacted
+                for journal_path in (self.journal_path, self.compacting_journal_path):
+                    if os.path.exists(journal_path):
+                        os.remove(journal_path)
+                self._journal_records = 0
+            except Exception as e:
+                _log.error("Error saving blocked IPs file: %s", e)
+
+    def close(self):
+        with self._lock:
+            self._close_journal()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats["journal_records"] = self._journal_records
+        return stats
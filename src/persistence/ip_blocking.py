@@ -1,75 +1,171 @@
 import time
-import json
 import os
 
-# Import configuration
-from variables import LOGIN_BLOCK_DURATION, BLOCKED_IPS_FILE, CLEAR_LOGS_ON_START
+import metrics
+from config import current
+from persistence.expiry_scheduler import ExpiryScheduler
+from persistence.ip_lists import check_ip_lists
+from persistence.state_backend import get_backend
+from waf_logger import get_logger
 
-# In-memory cache of blocked IPs
+_log = get_logger("ip_blocking")
+
+# Set in proxy worker processes. Workers do not load the configured backend:
+# the supervisor gives them one that talks to the state daemon.
+WORKER_ENV = "WAF_PROXY_WORKER"
+
+# In-memory cache of blocked IPs: "ip:domain" -> time.time() at which the block ends
+# The state backend (see state_backend) stores the blocks; this dict mirrors
+# it so lookups never leave the process. Only live blocks are kept: the expiry
+# scheduler removes each block as soon as its time is up. Lookups therefore
+# never modify the dict.
 blocked_ips = {}
 
+def _expire_block(key, block_time):
+    # Called with _expiry.lock held; the key may have been re-blocked or removed since
+    if blocked_ips.get(key) == block_time:
+        del blocked_ips[key]
+
+_expiry = ExpiryScheduler("blocked-ips", _expire_block)
+
+_listeners = []  # Called with each change after it was applied
+
 def load_blocked_ips():
     """
-    Load the blocked IPs from the JSON file
-    """
-    global blocked_ips
-    
-    # If CLEAR_LOGS_ON_START is True, initialize with empty dict instead of loading
-    if CLEAR_LOGS_ON_START:
-        print("Clearing blocked IPs list due to CLEAR_LOGS_ON_START=True")
-        blocked_ips = {}
-        save_blocked_ips()  # Save empty dict to clear the file
-        return
-    
-    try:
-        if os.path.exists(BLOCKED_IPS_FILE):
-            with open(BLOCKED_IPS_FILE, 'r') as f:
-                blocked_ips = json.load(f)
-    except Exception as e:
-        print(f"Error loading blocked IPs file: {e}")
-        blocked_ips = {}
+    Load the blocked IPs from the state backend and follow its changes
+    """
+    backend = get_backend()
+    blocks = backend.load(clear=current().CLEAR_LOGS_ON_START)
+    with _expiry.lock:
+        blocked_ips.clear()
+        _expiry.clear()
+        current_time = time.time()
+        for key, block_time in blocks.items():
+            if block_time > current_time:
+                blocked_ips[key] = block_time
+                _expiry.schedule(key, block_time)
+    backend.start(apply_remote_change)
 
 def save_blocked_ips():
     """
-    Save the blocked IPs to the JSON file
+    Persist the blocked IPs right away
+    """
+    get_backend().save()
+
+def add_listener(listener):
+    """
+    Call listener(record) after every change, local or remote, e.g. to
+    broadcast it to the workers
+    """
+    _listeners.append(listener)
+
+def _apply_record(record):
+    op = record.get("op")
+    if op == "block":
+        blocked_ips[record["key"]] = record["until"]
+        _expiry.schedule(record["key"], record["until"])
+    elif op == "unblock":
+        blocked_ips.pop(record["key"], None)
+    elif op == "clear":
+        blocked_ips.clear()
+        _expiry.clear()
+
+def apply_remote_change(record):
+    """
+    Mirror a change that was made and recorded elsewhere
     """
-    try:
-        with open(BLOCKED_IPS_FILE, 'w') as f:
-            json.dump(blocked_ips, f)
-    except Exception as e:
-        print(f"Error saving blocked IPs file: {e}")
+    with _expiry.lock:
+        _apply_record(record)
+    for listener in _listeners:
+        try:
+            listener(record)
+        except Exception as e:
+            _log.error("Error notifying blocked IPs listener: %s", e)
+
+def apply_change(record):
+    """
+    Apply a change and record it with the state backend
+    """
+    apply_remote_change(record)
+    get_backend().record_change(record)
 
 # Load blocked IPs on module import
-load_blocked_ips()
+if not os.environ.get(WORKER_ENV):
+    load_blocked_ips()
 
 def is_ip_blocked_for_domain(ip, domain):
     """
     Check if an IP is blocked for a specific domain
-    Returns: (is_blocked, time_left_in_seconds)
+    The allow list wins over every block; the block list blocks for good
+    Returns: (is_blocked, time_left_in_seconds), time_left None for a
+    network on the block list
     """
-    key = f"{ip}:{domain}"
-    if key in blocked_ips:
-        block_time = blocked_ips[key]
-        current_time = time.time()
-        time_left = block_time - current_time
-        
+    listed = check_ip_lists(ip, domain)
+    if listed == "allow":
+        return False, 0
+    if listed == "block":
+        return True, None
+
+    block_time = blocked_ips.get(f"{ip}:{domain}")
+    if block_time is not None:
+        # A block can outlive its time by the few milliseconds until the
+        # expiry scheduler removes it
+        time_left = block_time - time.time()
         if time_left > 0:
             return True, int(time_left)
-        else:
-            # Block expired, remove it
-            del blocked_ips[key]
-            save_blocked_ips()
-            
+
     return False, 0
 
 def block_ip_for_domain(ip, domain, duration=None):
     """
-    Block an IP for a specific domain
+    Block an IP for a specific domain, for LOGIN_BLOCK_DURATION seconds by default
     """
     if duration is None:
-        duration = LOGIN_BLOCK_DURATION
-        
+        duration = current().LOGIN_BLOCK_DURATION
+
     key = f"{ip}:{domain}"
-    blocked_ips[key] = time.time() + duration
-    print(f"IP {ip} blocked for domain {domain} for {duration} seconds")
-    save_blocked_ips()
+    apply_change({"op": "block", "key": key, "until": time.time() + duration})
+    _log.info("IP %s blocked for domain %s for %s seconds", ip, domain, duration)
+
+def unblock_key(key):
+    """
+    Remove a block by its "ip:domain" key
+    Returns True if the key was blocked
+    """
+    if key not in blocked_ips:
+        return False
+    apply_change({"op": "unblock", "key": key})
+    return True
+
+def clear_blocked_ips():
+    """
+    Remove all blocks
+    """
+    apply_change({"op": "clear"})
+
+def get_active_blocks():
+    """
+    Returns a list of ("ip:domain", block_end_time) for every live block
+    """
+    current_time = time.time()
+    return [(key, block_time) for key, block_time in list(blocked_ips.items()) if block_time > current_time]
+
+def get_block_stats():
+    """
+    Returns counters describing the blocked IP store
+    """
+    stats = {
+        "blocked": len(blocked_ips),
+        "scheduled_expiries": len(_expiry),
+        "expired": _expiry.expired,
+    }
+    stats.update(get_backend().get_stats())
+    return stats
+
+def _collect_block_metrics():
+    return [
+        ("waf_blocked_ips", (), len(blocked_ips)),
+        ("waf_failed_login_keys", (), get_backend().get_stats().get("tracked_keys", 0)),
+    ]
+
+metrics.register_collector(_collect_block_metrics)
@@ -0,0 +1,221 @@
+import os
+import threading
+import time
+
+import metrics
+from config import current
+from persistence.prefix_trie import PrefixTrie, parse_prefix, parse_address, IPV4_BITS, IPV6_BITS
+from waf_logger import get_logger
+
+_log = get_logger("ip_lists")
+
+# Relative list file paths are relative to src/
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Scope of a prefix that applies to every domain
+ALL_DOMAINS = None
+
+# Invalid lines reported per file; the rest are only counted
+MAX_REPORTED_ERRORS = 5
+
+class IpList:
+    """
+    Networks of both address families with the domains each applies to.
+
+    Every prefix is stored once in a PrefixTrie, its value the set of
+    domains it is scoped to (ALL_DOMAINS for any domain), so a feed of
+    n prefixes takes memory in proportion to n whatever the prefix lengths.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._tries = {IPV4_BITS: PrefixTrie(IPV4_BITS), IPV6_BITS: PrefixTrie(IPV6_BITS)}
+        self.files = []
+        self.errors = 0
+
+    def add(self, prefix, domain=ALL_DOMAINS):
+        """
+        Add a prefix ("192.0.2.0/24", "2001:db8::/32" or a single address)
+        Raises ValueError
+        """
+        bits, network, length = parse_prefix(prefix)
+        self._tries[bits].setdefault(network, length, set()).add(domain)
+
+    def import_lines(self, lines, source):
+        """
+        Add the prefixes of a feed, one "prefix [domain]" per line, the
+        domain written as the request's host[:port] like in blocked IP keys.
+        Blank lines and comments (# or ;) are skipped.
+        Returns the number of prefixes added
+        """
+        added = 0
+        for number, line in enumerate(lines, 1):
+            line = line.split("#", 1)[0].split(";", 1)[0].strip()
+            if not line:
+                continue
+            fields = line.split()
+            try:
+                if len(fields) > 2:
+                    raise ValueError(f"expected \"prefix [domain]\", got {line!r}")
+                self.add(fields[0], fields[1] if len(fields) == 2 else ALL_DOMAINS)
+                added += 1
+            except ValueError as e:
+                self.errors += 1
+                if self.errors <= MAX_REPORTED_ERRORS:
+                    _log.warning("Skipping line %s of %s: %s", number, source, e)
+        return added
+
+    def contains(self, ip, domain):
+        """
+        Whether a prefix scoped to the domain, or to every domain, contains the IP
+        """
+        try:
+            bits, address = parse_address(ip)
+        except ValueError:
+            return False
+        for domains in self._tries[bits].matches(address):
+            if ALL_DOMAINS in domains or domain in domains:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(len(trie) for trie in self._tries.values())
+
+    def get_stats(self):
+        return {
+            "prefixes": len(self),
+            "ipv4": len(self._tries[IPV4_BITS]),
+            "ipv6": len(self._tries[IPV6_BITS]),
+            "nodes": sum(trie.nodes for trie in self._tries.values()),
+            "errors": self.errors,
+            "files": list(self.files),
+        }
+
+class IpLists:
+    """
+    The block list and allow list loaded together. Never changed once
+    loaded: a reload builds new lists and swaps them in.
+    """
+    def __init__(self, blocked, allowed):
+        self.blocked = blocked
+        self.allowed = allowed
+        self.empty = not blocked and not allowed
+        self.loaded_at = time.time()
+
+def list_paths(files):
+    return [os.path.join(SRC_DIR, path) for path in files]
+
+def load_ip_list(name, paths):
+    """
+    Build an IpList from feed files
+    Raises OSError
+    """
+    ip_list = IpList(name)
+    for path in paths:
+        start = time.perf_counter()
+        with open(path, encoding="utf-8", errors="replace") as feed:
+            added = ip_list.import_lines(feed, path)
+        ip_list.files.append(path)
+        _log.info("Imported %s prefixes into the %s list from %s in %.2fs",
+                  added, name, path, time.perf_counter() - start)
+    return ip_list
+
+_active = IpLists(IpList("block"), IpList("allow"))
+_loaded = False
+_load_lock = threading.Lock()  # One load at a time; lookups never take it
+_watcher = None
+
+def reload_ip_lists():
+    """
+    Load IP_BLOCKLIST_FILES and IP_ALLOWLIST_FILES and make them the
+    active lists. The old lists stay active when a file cannot be read.
+    Raises OSError
+    """
+    global _active, _loaded
+    config = current()
+    with _load_lock:
+        lists = IpLists(load_ip_list("block", list_paths(config.IP_BLOCKLIST_FILES)),
+                        load_ip_list("allow", list_paths(config.IP_ALLOWLIST_FILES)))
+        # A single assignment: lookups see either the old or the new lists
+        _active = lists
+        _loaded = True
+    return lists
+
+def get_ip_lists():
+    """
+    The active IpLists, loaded on first use
+    """
+    if not _loaded:
+        try:
+            reload_ip_lists()
+        except OSError as e:
+            _log.error("Could not load the IP lists: %s", e)
+    return _active
+
+def check_ip_lists(ip, domain):
+    """
+    Returns "allow" if the IP is on the allow list for the domain, "block"
+    if it is on the block list, or None
+    """
+    lists = _active
+    if lists.empty:
+        return None
+    if lists.allowed.contains(ip, domain):
+        return "allow"
+    if lists.blocked.contains(ip, domain):
+        return "block"
+    return None
+
+def _files_state(paths):
+    states = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            states.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            states.append((path, None, None))
+    return states
+
+def _all_paths():
+    config = current()
+    return list_paths(config.IP_BLOCKLIST_FILES) + list_paths(config.IP_ALLOWLIST_FILES)
+
+def _watch():
+    last_state = _files_state(_all_paths())
+    while True:
+        time.sleep(max(0.1, current().IP_LISTS_RELOAD_INTERVAL))
+        if current().IP_LISTS_RELOAD_INTERVAL <= 0:
+            continue
+        state = _files_state(_all_paths())
+        if state == last_state:
+            continue
+        last_state = state
+        # Imported here, off the request path; lookups use the old lists meanwhile
+        try:
+            reload_ip_lists()
+        except OSError as e:
+            _log.error("Keeping the current IP lists, could not load them: %s", e)
+
+def start_ip_list_watcher():
+    """
+    Load the IP lists now and again whenever one of their files (or the
+    settings naming them) changes, checking every IP_LISTS_RELOAD_INTERVAL
+    seconds
+    """
+    global _watcher
+    get_ip_lists()
+    if _watcher is None:
+        _watcher = threading.Thread(target=_watch, name="ip-list-watcher", daemon=True)
+        _watcher.start()
+
+def get_ip_list_stats():
+    lists = _active
+    return {"block": lists.blocked.get_stats(), "allow": lists.allowed.get_stats()}
+
+def _collect_ip_list_metrics():
+    lists = _active
+    return [
+        ("waf_ip_list_prefixes", (("list", "block"),), len(lists.blocked)),
+        ("waf_ip_list_prefixes", (("list", "allow"),), len(lists.allowed)),
+    ]
+
+metrics.register_collector(_collect_ip_list_metrics)
@@ -0,0 +1,124 @@
+import socket
+
+# Address bits of each family
+IPV4_BITS = 32
+IPV6_BITS = 128
+
+def parse_prefix(text):
+    """
+    Parse "address" or "address/length" of either family; host bits beyond
+    the length are ignored
+    Returns (bits, network as an int, length), raises ValueError
+    """
+    address, separator, length = text.partition("/")
+    bits, value = parse_address(address)
+    if separator:
+        if not length.isdigit() or int(length) > bits:
+            raise ValueError(f"invalid prefix length in {text!r}")
+        length = int(length)
+    else:
+        length = bits
+    return bits, value >> (bits - length) << (bits - length), length
+
+def parse_address(address):
+    """
+    Returns (bits, address as an int), raises ValueError
+    IPv4-mapped IPv6 addresses (::ffff:192.0.2.1) are read as IPv4
+    """
+    try:
+        if ":" not in address:
+            # inet_pton, unlike inet_aton, rejects shorthands such as "10.1"
+            return IPV4_BITS, int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+        if address.startswith("::ffff:") and "." in address:
+            return IPV4_BITS, int.from_bytes(socket.inet_pton(socket.AF_INET, address[7:]), "big")
+        return IPV6_BITS, int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big")
+    except OSError:
+        raise ValueError(f"invalid IP address {address!r}")
+
+class _Node:
+    __slots__ = ("prefix", "length", "value", "zero", "one")
+
+    def __init__(self, prefix, length, value=None):
+        self.prefix = prefix
+        self.length = length
+        self.value = value
+        self.zero = None
+        self.one = None
+
+def _attach(parent, one, child):
+    if one:
+        parent.one = child
+    else:
+        parent.zero = child
+
+class PrefixTrie:
+    """
+    Path-compressed binary trie (radix trie) of address prefixes of one
+    family, each with a value.
+
+    A node only exists where a prefix ends or where two prefixes part, so
+    the trie holds fewer than two nodes per prefix whatever their lengths,
+    and a lookup visits at most one node per prefix on the address's path.
+    """
+    def __init__(self, bits):
+        self.bits = bits
+        self._root = _Node(0, 0)
+        self.prefixes = 0
+        self.nodes = 1
+
+    def setdefault(self, prefix, length, default):
+        """
+        The value of a prefix, set to default if the prefix is new
+        """
+        bits = self.bits
+        node = self._root
+        while True:
+            if node.length == length:
+                if node.value is None:
+                    node.value = default
+                    self.prefixes += 1
+                return node.value
+            one = (prefix >> (bits - node.length - 1)) & 1
+            child = node.one if one else node.zero
+            if child is None:
+                _attach(node, one, _Node(prefix, length, default))
+                self.nodes += 1
+                self.prefixes += 1
+                return default
+            if child.length <= length and not (prefix ^ child.prefix) >> (bits - child.length):
+                node = child
+                continue
+            # Bits the prefix shares with the child's
+            common = min(length, child.length, bits - (prefix ^ child.prefix).bit_length())
+            # The prefix parts from the child (or ends) above it: split the edge
+            fork = _Node(prefix >> (bits - common) << (bits - common), common)
+            _attach(node, one, fork)
+            _attach(fork, (child.prefix >> (bits - common - 1)) & 1, child)
+            self.nodes += 1
+            if common == length:
+                fork.value = default
+            else:
+                _attach(fork, (prefix >> (bits - common - 1)) & 1, _Node(prefix, length, default))
+                self.nodes += 1
+            self.prefixes += 1
+            return default
+
+    def matches(self, address):
+        """
+        Returns the values of every prefix containing the address, shortest first
+        """
+        bits = self.bits
+        node = self._root
+        found = []
+        while node is not None:
+            if (address ^ node.prefix) >> (bits - node.length):
+                break
+            if node.value is not None:
+                found.append(node.value)
+            if node.length == bits:
+                break
+            node = node.one if (address >> (bits - node.length - 1)) & 1 else node.zero
+        return found
+
+    def __len__(self):
+        return self.prefixes
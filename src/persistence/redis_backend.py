@@ -0,0 +1,363 @@
+import json
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from config import current
+from persistence.state_backend import StateBackend
+from waf_logger import get_logger
+
+_log = get_logger("state_backend")
+
+# Seconds a request to the Redis server may take
+REQUEST_TIMEOUT = 2.0
+# Longest wait between attempts to reconnect the subscription
+MAX_RECONNECT_DELAY = 5.0
+# Failed login windows are counted in this many buckets
+COUNTER_BUCKETS = 10
+
+class RespError(Exception):
+    """
+    Error reply from the Redis server
+    """
+
+class RespConnection:
+    """
+    Minimal client for the Redis protocol (RESP), enough for pipelined
+    commands and a subscription. Works with any Redis compatible server.
+    """
+    def __init__(self, host, port, timeout=REQUEST_TIMEOUT):
+        self._socket = socket.create_connection((host, port), timeout=timeout)
+        self._reader = self._socket.makefile("rb")
+
+    def close(self):
+        self._reader.close()
+        self._socket.close()
+
+    def set_timeout(self, timeout):
+        self._socket.settimeout(timeout)
+
+    def pipeline(self, commands):
+        """
+        Send all commands at once and return their replies in order
+        Error replies are returned as RespError instances
+        """
+        self._socket.sendall(b"".join(_encode_command(command) for command in commands))
+        return [self.read_reply() for _ in commands]
+
+    def execute(self, *command):
+        reply = self.pipeline([command])[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def read_reply(self):
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionResetError("Redis server closed the connection")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b"+":
+            return body.decode()
+        if prefix == b"-":
+            return RespError(body.decode())
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            return self._reader.read(length + 2)[:-2]
+        if prefix == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise ConnectionResetError(f"Unexpected Redis reply: {line[:50]!r}")
+
+def _drop_old_buckets(buckets, oldest):
+    for bucket in [bucket for bucket in buckets if bucket < oldest]:
+        del buckets[bucket]
+
+def _encode_command(command):
+    parts = [b"*%d\r\n" % len(command)]
+    for argument in command:
+        if not isinstance(argument, bytes):
+            argument = str(argument).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(argument), argument))
+    return b"".join(parts)
+
+class RedisBackend(StateBackend):
+    """
+    Blocks and failed login counts shared by several WAF nodes through a
+    Redis (protocol compatible) server.
+
+    Blocks are kept in a sorted set scored by their end time, and every change
+    is published on a channel that each node subscribes to, so the local
+    blocked_ips of all nodes stay in sync and lookups never wait on Redis.
+
+    Failed logins are counted locally and written by a background thread every
+    STATE_FLUSH_INTERVAL seconds as one pipeline. Each bucket of a key is a
+    hash holding every node's own count under the node's id; a node sets its
+    whole count with HSET rather than adding to a shared counter, so a
+    pipeline that failed half way can be sent again without counting
+    anything twice. The same pipeline reads back the other nodes' counts. A
+    node therefore sees the failures of the other nodes one flush later, and
+    its own right away. The window is counted in COUNTER_BUCKETS buckets, so it
+    can reach back up to one bucket further than LOGIN_ATTEMPT_TIMEOUT. Like
+    AttemptTracker, the node's counts are kept in LRU order: keys whose
+    failures left the window expire from the front, and the least recently
+    used are dropped past LOGIN_TRACKER_MAX_KEYS.
+    """
+    name = "redis"
+
+    def __init__(self, host, port, prefix):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self._blocks_key = prefix + "blocks"
+        self._channel = prefix + "block-changes"
+        self._counter_prefix = prefix + "fails:"
+        self._connection = None  # Used by load and the flush thread only
+        self._connection_lock = threading.Lock()
+        self._lock = threading.Lock()  # Guards the pending writes and known counts
+        self._node_id = uuid.uuid4().hex  # Field of this node's counts in the bucket hashes
+        self._pending_changes = []
+        self._own_counts = OrderedDict()  # (ip, domain) -> [window, {bucket: count}], this node's failures, least recently used first
+        self._dirty = set()  # Keys of _own_counts not written since they last changed
+        self._shared_counts = OrderedDict()  # (ip, domain) -> (other nodes' count, time read), least recently used first
+        self._flush_now = threading.Event()
+        self._threads = None
+        self.subscribed = False
+        self.flushes = 0
+        self.flush_errors = 0
+        self.evicted_expired = 0
+        self.evicted_lru = 0
+
+    def load(self, clear=False):
+        if clear:
+            _log.info("CLEAR_LOGS_ON_START does not clear blocks shared through Redis")
+        try:
+            return self._read_blocks()
+        except (OSError, RespError) as e:
+            _log.error("Error loading blocked IPs from Redis at %s:%s: %s", self.host, self.port, e)
+            return {}
+
+    def _read_blocks(self):
+        current_time = time.time()
+        with self._connection_lock:
+            replies = self._pipeline([
+                ("ZREMRANGEBYSCORE", self._blocks_key, "-inf", current_time),
+                ("ZRANGEBYSCORE", self._blocks_key, f"({current_time}", "+inf", "WITHSCORES"),
+            ])
+        members = replies[1]
+        return {members[i].decode(): float(members[i + 1]) for i in range(0, len(members), 2)}
+
+    def start(self, apply_remote_change):
+        if self._threads is not None:
+            return
+        self._threads = [
+            threading.Thread(target=self._run_flusher, name="redis-flush", daemon=True),
+            threading.Thread(target=self._subscribe, args=(apply_remote_change,), name="redis-subscriber", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def record_change(self, record):
+        with self._lock:
+            self._pending_changes.append(record)
+        # Blocks should reach the other nodes right away
+        self._flush_now.set()
+
+    def count_failed_login(self, ip_domain_key, window, limit):
+        current_time = time.time()
+        bucket = int(current_time // self._bucket_seconds(window))
+        with self._lock:
+            own = self._own_counts.get(ip_domain_key)
+            if own is None:
+                own = self._own_counts[ip_domain_key] = [window, {}]
+                # Many keys at once push out the least recently used ones,
+                # never the key being counted
+                while len(self._own_counts) > current().LOGIN_TRACKER_MAX_KEYS:
+                    key, _ = self._own_counts.popitem(last=False)
+                    self._dirty.discard(key)
+                    self.evicted_lru += 1
+            else:
+                self._own_counts.move_to_end(ip_domain_key)
+                own[0] = window
+                _drop_old_buckets(own[1], bucket - COUNTER_BUCKETS)
+            own[1][bucket] = own[1].get(bucket, 0) + 1
+            self._dirty.add(ip_domain_key)
+            count = self._shared_count(ip_domain_key, window, current_time) + sum(own[1].values())
+        return min(limit, count)
+
+    def _shared_count(self, ip_domain_key, window, current_time):
+        shared = self._shared_counts.get(ip_domain_key)
+        if shared is None or shared[1] <= current_time - window:
+            return 0
+        return shared[0]
+
+    def _bucket_seconds(self, window):
+        return max(window / COUNTER_BUCKETS, 1.0)
+
+    def save(self):
+        self._flush()
+
+    def close(self):
+        self._flush()
+
+    def _run_flusher(self):
+        while True:
+            self._flush_now.wait(current().STATE_FLUSH_INTERVAL)
+            self._flush_now.clear()
+            self._flush()
+
+    def _flush(self):
+        """
+        Write pending block changes and failed login counts in one pipeline
+        """
+        current_time = time.time()
+        with self._lock:
+            changes = self._pending_changes
+            self._pending_changes = []
+            self._expire_own_counts(current_time)
+            dirty = self._dirty
+            self._dirty = set()
+            counts = [(key, self._own_counts[key][0], dict(self._own_counts[key][1]))
+                      for key in dirty if key in self._own_counts]
+        if not changes and not counts:
+            return
+
+        commands = []
+        for record in changes:
+            op = record.get("op")
+            if op == "block":
+                commands.append(("ZADD", self._blocks_key, record["until"], record["key"]))
+            elif op == "unblock":
+                commands.append(("ZREM", self._blocks_key, record["key"]))
+            elif op == "clear":
+                commands.append(("DEL", self._blocks_key))
+            commands.append(("PUBLISH", self._channel, json.dumps(record, separators=(',', ':'))))
+
+        reads = []  # (key, index of the first HGETALL reply, number of them)
+        for key, window, buckets in counts:
+            bucket_seconds = self._bucket_seconds(window)
+            prefix = f"{self._counter_prefix}{key[0]}|{key[1]}:"
+            for bucket, count in buckets.items():
+                # The node's whole count: sending it again changes nothing
+                commands.append(("HSET", prefix + str(bucket), self._node_id, count))
+                commands.append(("EXPIRE", prefix + str(bucket), int(window + 2 * bucket_seconds)))
+            current_bucket = int(current_time // bucket_seconds)
+            reads.append((key, len(commands), COUNTER_BUCKETS + 1))
+            for bucket in range(current_bucket - COUNTER_BUCKETS, current_bucket + 1):
+                commands.append(("HGETALL", prefix + str(bucket)))
+
+        try:
+            with self._connection_lock:
+                replies = self._pipeline(commands)
+        except (OSError, RespError) as e:
+            self.flush_errors += 1
+            _log.error("Error writing to Redis at %s:%s: %s", self.host, self.port, e)
+            with self._lock:
+                # Keep the changes for the next attempt; the counts are sent
+                # again whole, whether or not some of them were written
+                self._pending_changes[:0] = changes
+                self._dirty.update(key for key, _, _ in counts)
+            return
+
+        self.flushes += 1
+        node_id = self._node_id.encode()
+        with self._lock:
+            for key, first, length in reads:
+                total = 0
+                for fields in replies[first:first + length]:
+                    for index in range(0, len(fields or ()), 2):
+                        if fields[index] != node_id:
+                            total += int(fields[index + 1])
+                self._shared_counts[key] = (total, current_time)
+                self._shared_counts.move_to_end(key)
+            while len(self._shared_counts) > current().LOGIN_TRACKER_MAX_KEYS:
+                self._shared_counts.popitem(last=False)
+
+    def _expire_own_counts(self, current_time):
+        """
+        Forget the keys whose failures all left the window, once written
+        Must be called with _lock held
+        """
+        # Front of the LRU order holds the keys counted longest ago, so the
+        # walk stops at the first key still in its window
+        own_counts = self._own_counts
+        while own_counts:
+            key, (window, buckets) = next(iter(own_counts.items()))
+            oldest = int(current_time // self._bucket_seconds(window)) - COUNTER_BUCKETS
+            if key in self._dirty or any(bucket >= oldest for bucket in buckets):
+                break
+            del own_counts[key]
+            self.evicted_expired += 1
+
+    def _pipeline(self, commands):
+        """
+        Run commands on the shared connection, connecting first if needed
+        Must be called with _connection_lock held
+        """
+        try:
+            if self._connection is None:
+                self._connection = RespConnection(self.host, self.port)
+            replies = self._connection.pipeline(commands)
+        except OSError:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            raise
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def _subscribe(self, apply_remote_change):
+        delay = 0.1
+        reconnect = False
+        while True:
+            connection = None
+            try:
+                connection = RespConnection(self.host, self.port)
+                connection.execute("SUBSCRIBE", self._channel)
+                # Changes only arrive while subscribed, so catch up after a gap.
+                # Unblocks made in the meantime take effect when the block ends.
+                if reconnect:
+                    for key, block_time in self._read_blocks().items():
+                        apply_remote_change({"op": "block", "key": key, "until": block_time})
+                _log.info("Subscribed to blocked IP changes on Redis at %s:%s", self.host, self.port)
+                self.subscribed = True
+                delay = 0.1
+                connection.set_timeout(None)
+                while True:
+                    message = connection.read_reply()
+                    if isinstance(message, list) and len(message) == 3 and message[0] == b"message":
+                        apply_remote_change(json.loads(message[2]))
+            except (OSError, RespError, ValueError) as e:
+                _log.warning("Redis subscription failed: %s", e)
+            finally:
+                if connection is not None:
+                    connection.close()
+            self.subscribed = False
+            reconnect = True
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "backend": self.name,
+                "tracked_keys": len(self._own_counts),
+                "shared_keys": len(self._shared_counts),
+                "max_keys": current().LOGIN_TRACKER_MAX_KEYS,
+                "pending_counts": len(self._dirty),
+                "evicted_expired": self.evicted_expired,
+                "evicted_lru": self.evicted_lru,
+                "pending_changes": len(self._pending_changes),
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+                "subscribed": self.subscribed,
+            }
@@ -0,0 +1,96 @@
+from config import current
+from detection.attempt_tracker import AttemptTracker
+from waf_logger import get_logger
+
+_log = get_logger("state_backend")
+
+class StateBackend:
+    """
+    Where the blocked IPs and failed login counters are kept.
+
+    ip_blocking keeps every live block in a local dictionary, so block lookups
+    never reach the backend. The backend is told about each change made on
+    this node (record_change) and pushes changes made elsewhere back through
+    the apply function passed to start(). Failed logins are counted by the
+    backend because the count decides whether to block.
+
+    This base class is the in-memory backend: nothing is persisted or shared.
+    """
+    name = "memory"
+
+    def __init__(self):
+        self.attempts = AttemptTracker(current().LOGIN_TRACKER_MAX_KEYS)
+
+    def load(self, clear=False):
+        """
+        Returns the stored blocks as a dict of "ip:domain" -> block end time
+        clear asks a node-local store to start empty
+        """
+        return {}
+
+    def start(self, apply_remote_change):
+        """
+        Start pushing changes made elsewhere to apply_remote_change(record)
+        """
+
+    def record_change(self, record):
+        """
+        Store a change made on this node: {"op": "block", "key", "until"},
+        {"op": "unblock", "key"} or {"op": "clear"}
+        """
+
+    def count_failed_login(self, ip_domain_key, window, limit):
+        """
+        Record a failed login for an (IP, domain) key
+        Returns the number of failed logins within the window, capped at limit
+        """
+        self.attempts.max_keys = current().LOGIN_TRACKER_MAX_KEYS
+        return self.attempts.record(ip_domain_key, window, limit)
+
+    def save(self):
+        """
+        Persist everything right away, if the backend persists anything
+        """
+
+    def close(self):
+        pass
+
+    def get_stats(self):
+        stats = {"backend": self.name}
+        stats.update(self.attempts.get_stats())
+        return stats
+
+MemoryBackend = StateBackend
+
+def create_backend(name):
+    """
+    Create the backend selected by STATE_BACKEND
+    """
+    if name == "file":
+        from persistence.file_backend import FileBackend
+        return FileBackend(current().BLOCKED_IPS_FILE)
+    if name == "redis":
+        from persistence.redis_backend import RedisBackend
+        config = current()
+        return RedisBackend(config.STATE_REDIS_HOST, config.STATE_REDIS_PORT, config.STATE_REDIS_PREFIX)
+    if name != "memory":
+        _log.error("Unknown STATE_BACKEND %r, keeping state in memory", name)
+    return MemoryBackend()
+
+_backend = None
+
+def get_backend():
+    """
+    Returns the backend of this process, created from STATE_BACKEND on first use
+    """
+    global _backend
+    if _backend is None:
+        _backend = create_backend(current().STATE_BACKEND)
+    return _backend
+
+def set_backend(backend):
+    """
+    Replace the backend of this process (e.g. with the state daemon's in a worker)
+    """
+    global _backend
+    _backend = backend
@@ -0,0 +1,249 @@
+import json
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from config import current, publish, ConfigError
+from persistence.state_backend import StateBackend
+from waf_logger import get_logger
+
+_log = get_logger("state_client")
+
+# Seconds a request to the state daemon may take
+REQUEST_TIMEOUT = 1.0
+# Longest wait between attempts to reconnect the subscription
+MAX_RECONNECT_DELAY = 5.0
+# Changes and failed logins waiting to be sent; beyond this the daemon is not keeping up
+MAX_QUEUED_REQUESTS = 10000
+
+class StateClient(StateBackend):
+    """
+    State backend of a proxy worker: the state daemon (see state_daemon).
+
+    A background thread subscribes to the daemon and mirrors every block into
+    the local blocked_ips, so block lookups stay local dictionary reads. The
+    settings published in the supervisor are published here as well, and
+    the rule file or IP lists are reloaded when the supervisor asks.
+
+    Nothing waits on the daemon while a request is handled. Changes made by
+    the worker and its failed logins are queued and sent by a sender thread
+    over a connection of its own; metrics reports use a third connection.
+    Failed logins are counted locally right away, like in the memory
+    backend, and the daemon's reply to each one - the count of all workers -
+    is kept, so a key's count is the larger of the local count and the
+    shared count plus the failures still on their way. The failures of the
+    other workers are therefore seen one round trip later. While the daemon
+    cannot be reached, the local count is all there is.
+    """
+    name = "daemon"
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._outbox = queue.Queue(MAX_QUEUED_REQUESTS)
+        self._lock = threading.Lock()  # Guards the shared and in-flight counts
+        self._shared_counts = OrderedDict()  # (ip, domain) -> (count, time read), least recently used first
+        self._in_flight = {}  # (ip, domain) -> failed logins sent without a reply yet
+        self._metrics_connection = None  # Used by the metrics reporter only
+        self._metrics_lock = threading.Lock()
+        self._thread = None
+        self._sender = None
+        self.subscribed = False
+        self.dropped = 0
+
+    def start(self, apply_remote_change):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._subscribe, args=(apply_remote_change,),
+                                        name="state-subscriber", daemon=True)
+        self._thread.start()
+        self._start_sender()
+
+    def _start_sender(self):
+        if self._sender is None:
+            self._sender = threading.Thread(target=self._send_loop, name="state-sender", daemon=True)
+            self._sender.start()
+
+    def _queue(self, message):
+        """
+        Returns False if the queue is full: the daemon is not keeping up
+        """
+        self._start_sender()
+        try:
+            self._outbox.put_nowait(message)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def record_change(self, record):
+        """
+        Queue a block change for the daemon, which records and broadcasts it
+        """
+        if not self._queue(record):
+            # The change is kept locally; other workers will not see it
+            _log.error("Could not forward %s to the state daemon: too many requests queued", record.get("op"))
+
+    def count_failed_login(self, ip_domain_key, window, limit):
+        """
+        Record a failed login locally and queue it for the daemon
+        Returns the larger of the local and the shared count, capped at limit
+        """
+        local_count = super().count_failed_login(ip_domain_key, window, limit)
+        current_time = time.time()
+        with self._lock:
+            shared = self._shared_counts.get(ip_domain_key)
+            shared_count = shared[0] if shared is not None and shared[1] > current_time - window else 0
+            in_flight = self._in_flight.get(ip_domain_key, 0)
+            if self._queue({"op": "failed_login", "key": list(ip_domain_key)}):
+                in_flight += 1
+                self._in_flight[ip_domain_key] = in_flight
+        return min(limit, max(local_count, shared_count + in_flight))
+
+    def report_metrics(self, worker_id, snapshot=None, stats=None):
+        """
+        Send this worker's metrics and stats, those given, to the daemon,
+        which keeps the latest ones
+        """
+        data = b""
+        if snapshot is not None:
+            data += _encode({"op": "metrics", "worker": worker_id, "snapshot": snapshot})
+        if stats is not None:
+            data += _encode({"op": "stats", "worker": worker_id, "stats": stats})
+        with self._metrics_lock:
+            try:
+                if self._metrics_connection is None:
+                    self._metrics_connection = self._connect()
+                self._metrics_connection[0].sendall(data)
+            except OSError:
+                _disconnect(self._metrics_connection)
+                self._metrics_connection = None
+                raise
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats["subscribed"] = self.subscribed
+        stats["queued_requests"] = self._outbox.qsize()
+        stats["dropped_requests"] = self.dropped
+        return stats
+
+    def _send_loop(self):
+        connection = None
+        while True:
+            message = self._outbox.get()
+            login_key = tuple(message["key"]) if message.get("op") == "failed_login" else None
+            reply = None
+            # A connection that went stale since the last request gets one retry,
+            # but only while the daemon cannot have read the message: after a
+            # timeout or a garbled reply it may have counted the failed login
+            # already, and sending it again would count it twice
+            for attempt in (1, 2):
+                try:
+                    if connection is None:
+                        connection = self._connect()
+                    connection[0].sendall(_encode(message))
+                    if login_key is not None:
+                        line = connection[1].readline()
+                        if not line:
+                            raise ConnectionResetError("state daemon closed the connection")
+                        reply = json.loads(line)
+                    break
+                except (OSError, ValueError) as e:
+                    _disconnect(connection)
+                    connection = None
+                    if attempt == 2 or isinstance(e, (socket.timeout, ValueError)):
+                        if login_key is None:
+                            _log.error("Could not forward %s to the state daemon: %s", message.get("op"), e)
+                        else:
+                            _log.warning("Shared login counters unavailable, counting locally: %s", e)
+                        break
+            if login_key is not None:
+                self._login_sent(login_key, reply)
+
+    def _login_sent(self, key, reply):
+        with self._lock:
+            in_flight = self._in_flight.get(key, 0) - 1
+            if in_flight > 0:
+                self._in_flight[key] = in_flight
+            else:
+                self._in_flight.pop(key, None)
+            if reply is None:
+                return
+            count = reply.get("count") if isinstance(reply, dict) else None
+            if not isinstance(count, int) or isinstance(count, bool):
+                _log.warning("Unexpected reply from the state daemon to a failed login: %.200r", reply)
+            else:
+                self._shared_counts[key] = (count, time.time())
+                self._shared_counts.move_to_end(key)
+                while len(self._shared_counts) > current().LOGIN_TRACKER_MAX_KEYS:
+                    self._shared_counts.popitem(last=False)
+
+    def _connect(self):
+        """
+        Returns (socket, reader) connected to the daemon
+        """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(REQUEST_TIMEOUT)
+        try:
+            connection.connect(self.path)
+        except OSError:
+            connection.close()
+            raise
+        return connection, connection.makefile("rb")
+
+    def _apply_config(self, record):
+        try:
+            publish(record["values"], source=f"supervisor (version {record.get('version')})")
+        except ConfigError as e:
+            _log.error("Could not apply the supervisor's settings: %s", e)
+
+    def _apply_reload(self, record):
+        # Compiled here, off the request path, like the watchers do
+        from detection.rules import reload_rules, RuleFileError
+        from persistence.ip_lists import reload_ip_lists
+        what = record.get("what")
+        try:
+            if what == "rules":
+                reload_rules()
+            elif what == "ip_lists":
+                reload_ip_lists()
+            else:
+                _log.warning("Unknown reload request from the supervisor: %s", what)
+        except (OSError, RuleFileError) as e:
+            _log.error("Could not reload %s as the supervisor asked: %s", what, e)
+
+    def _subscribe(self, apply_remote_change):
+        delay = 0.1
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                    connection.connect(self.path)
+                    connection.sendall(b'{"op":"subscribe"}\n')
+                    _log.info("Subscribed to state daemon at %s", self.path)
+                    self.subscribed = True
+                    delay = 0.1
+                    with connection.makefile("rb") as reader:
+                        for line in reader:
+                            record = json.loads(line)
+                            if record.get("op") == "config":
+                                self._apply_config(record)
+                            elif record.get("op") == "reload":
+                                self._apply_reload(record)
+                            else:
+                                apply_remote_change(record)
+                _log.warning("State daemon closed the subscription")
+            except (OSError, ValueError) as e:
+                _log.warning("State daemon subscription failed: %s", e)
+            self.subscribed = False
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+def _encode(message):
+    return json.dumps(message, separators=(',', ':')).encode() + b"\n"
+
+def _disconnect(connection):
+    if connection is not None:
+        connection[1].close()
+        connection[0].close()
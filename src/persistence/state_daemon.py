@@ -0,0 +1,165 @@
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+import config
+from persistence.ip_blocking import add_listener, apply_change, get_active_blocks
+from detection.login_detection import count_failed_login
+from waf_logger import get_logger
+
+_log = get_logger("state_daemon")
+
+# Seconds a subscriber may stall a broadcast before it is dropped
+SEND_TIMEOUT = 1.0
+
+class StateDaemon:
+    """
+    Shares the supervisor's state backend with the proxy workers.
+
+    Runs in the supervisor process and talks JSON lines over a Unix socket:
+
+        {"op": "block", "key": ..., "until": ...}   record a block
+        {"op": "unblock", "key": ...}               remove a block
+        {"op": "clear"}                             remove all blocks
+        {"op": "failed_login", "key": [ip, domain]} -> {"count": n}
+        {"op": "subscribe"}                         stream every change
+        {"op": "metrics", "worker": id, "snapshot": ...}  a worker's metrics
+        {"op": "stats", "worker": id, "stats": ...}        a worker's stats
+
+    A subscriber first gets the settings ({"op": "config", "values": ...}),
+    a "clear" and every live block, then each change as it happens, so a
+    block decided by one worker reaches all of them after a single local
+    socket hop. Settings published in the supervisor (web interface,
+    CONFIG_FILE) are streamed the same way, and so are requests to reload
+    the rule file or the IP lists ({"op": "reload", "what": ...}). The
+    metrics and stats each worker reports are kept until its next report,
+    for the supervisor's /metrics and web interface.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._server = None
+        self._subscribers = []
+        self._worker_metrics = {}  # Worker id -> last metrics snapshot
+        self._worker_stats = {}  # Worker id -> last stats (see management_server)
+        self._lock = threading.Lock()  # Guards _subscribers and orders broadcasts
+        add_listener(self._broadcast)
+        config.add_listener(self._broadcast_config)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, _Handler)
+        self._server.daemon_threads = True
+        self._server.state_daemon = self
+        os.chmod(self.path, 0o600)
+        threading.Thread(target=self._server.serve_forever, name="state-daemon", daemon=True).start()
+        _log.info("State daemon listening on %s", self.path)
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def subscribe(self, connection):
+        with self._lock:
+            # Under the lock, so no change slips in between the state and the stream
+            lines = [_config_record(config.current()), {"op": "clear"}]
+            lines.extend({"op": "block", "key": key, "until": block_time}
+                         for key, block_time in get_active_blocks())
+            connection.sendall(b"".join(_encode(line) for line in lines))
+            self._subscribers.append(connection)
+
+    def unsubscribe(self, connection):
+        with self._lock:
+            if connection in self._subscribers:
+                self._subscribers.remove(connection)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def set_worker_metrics(self, worker, snapshot):
+        self._worker_metrics[str(worker)] = snapshot
+
+    def get_worker_metrics(self):
+        return dict(self._worker_metrics)
+
+    def set_worker_stats(self, worker, stats):
+        self._worker_stats[str(worker)] = stats
+
+    def get_worker_stats(self):
+        return dict(self._worker_stats)
+
+    def broadcast_reload(self, what):
+        """
+        Ask every worker to reload "rules" or "ip_lists"
+        Returns the number of workers asked
+        """
+        self._broadcast({"op": "reload", "what": what})
+        return self.subscriber_count()
+
+    def _broadcast_config(self, new_config, changed):
+        self._broadcast(_config_record(new_config, changed))
+
+    def _broadcast(self, record):
+        data = _encode(record)
+        with self._lock:
+            for connection in list(self._subscribers):
+                try:
+                    connection.sendall(data)
+                except OSError as e:
+                    _log.warning("Dropping state subscriber: %s", e)
+                    self._subscribers.remove(connection)
+                    connection.close()
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        state_daemon = self.server.state_daemon
+        # Only bounds sends: reads keep blocking, subscribers stay quiet for hours
+        seconds = int(SEND_TIMEOUT)
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                                   struct.pack("ll", seconds, int((SEND_TIMEOUT - seconds) * 1000000)))
+        subscribed = False
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                try:
+                    message = json.loads(line)
+                    op = message["op"]
+                    if op == "failed_login":
+                        count = count_failed_login(tuple(message["key"]))
+                        self.connection.sendall(_encode({"count": count}))
+                    elif op == "subscribe":
+                        state_daemon.subscribe(self.connection)
+                        subscribed = True
+                    elif op in ("block", "unblock", "clear"):
+                        apply_change(message)
+                    elif op == "metrics":
+                        state_daemon.set_worker_metrics(message["worker"], message["snapshot"])
+                    elif op == "stats":
+                        state_daemon.set_worker_stats(message["worker"], message["stats"])
+                    else:
+                        _log.warning("Unknown state daemon request: %s", op)
+                except (ValueError, KeyError, TypeError) as e:
+                    _log.warning("Invalid state daemon request: %s", e)
+        except OSError:
+            pass
+        finally:
+            if subscribed:
+                state_daemon.unsubscribe(self.connection)
+
+def _config_record(current_config, names=None):
+    values = current_config.as_dict()
+    if names is not None:
+        values = {name: values[name] for name in names}
+    return {"op": "config", "version": current_config.version, "values": values}
+
+def _encode(message):
+    return json.dumps(message, separators=(',', ':')).encode() + b"\n"
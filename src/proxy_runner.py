@@ -3,14 +3,39 @@ import os
 from mitmproxy import options
 from mitmproxy.tools.dump import DumpMaster
 from log_handler import clear_logs, ProxyAddOn
+from log_writer import log_writer
+from detection.rules import start_rule_watcher
+from persistence.ip_lists import start_ip_list_watcher
+from waf_logger import get_logger
 
-async def start_proxy():
+_log = get_logger("startup")
+
+class ReusePortEventLoop(asyncio.SelectorEventLoop):
     """
-    Starts the Mitmproxy with the appropriate settings.
+    Event loop whose listening sockets set SO_REUSEPORT, so several worker
+    processes can listen on port 8080 and the kernel spreads the connections
     """
+    async def create_server(self, *args, **kwargs):
+        kwargs["reuse_port"] = True
+        return await super().create_server(*args, **kwargs)
+
+class ReusePortEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    _loop_factory = ReusePortEventLoop
 
-    clear_logs()
+async def start_proxy(worker_id=None):
+    """
+    Starts the Mitmproxy with the appropriate settings.
+    worker_id is set when running as one of several workers (see supervisor)
+    """
 
+    # Workers share the log files the supervisor already prepared
+    if worker_id is None:
+        clear_logs()
+    log_writer.start()
+    # Loads the rules now rather than on the first request, then follows RULES_FILE
+    start_rule_watcher()
+    # Same for the network block and allow lists, imported before listening
+    start_ip_list_watcher()
 
     opts = options.Options(
         listen_host="0.0.0.0",
@@ -22,8 +47,14 @@ async def start_proxy():
     proxy.addons.add(ProxyAddOn())
 
     try:
-        print("Starting proxy on port 8080...")
+        if worker_id is None:
+            _log.info("Starting proxy on port 8080...")
+        else:
+            _log.info("Starting proxy worker %s (pid %s) on port 8080...", worker_id, os.getpid())
         await proxy.run()
     except KeyboardInterrupt:
-        print("Shutting down proxy...")
+        _log.info("Shutting down proxy...")
         proxy.shutdown()
+    finally:
+        # Write out whatever is still queued
+        log_writer.close()
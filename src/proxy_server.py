@@ -1,20 +1,38 @@
 import asyncio
+import config
+
+if __name__ == "__main__":
+    # Apply CONFIG_FILE before the other modules are imported, some of
+    # them (state backend, blocked IPs) read their settings at import
+    config.start_config_watcher()
+
 from proxy_runner import start_proxy
+from supervisor import run_supervisor
 import sys
 import os
-import variables
+from waf_logger import get_logger
+from management_server import start_management_server
 from web_interface import run_web_interface
 
 # Ensure that the module path is correct
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+_log = get_logger("startup")
+
 if __name__ == "__main__":
+    settings = config.current()
     # Start the web interface only if enabled
-    if variables.ENABLE_WEBINTERFACE:
-        print("Starting web interface on port 80 (ENABLE_WEBINTERFACE=True)")
-        web_thread = run_web_interface()
+    if settings.ENABLE_WEBINTERFACE:
+        _log.info("Starting web interface on port 80 (ENABLE_WEBINTERFACE=True)")
+        # The web interface runs in its own process and reaches the proxy
+        # (the supervisor with several workers) through this socket
+        start_management_server()
+        web_process = run_web_interface(settings.MANAGEMENT_SOCKET_PATH)
     else:
-        print("Web interface disabled (ENABLE_WEBINTERFACE=False)")
+        _log.info("Web interface disabled (ENABLE_WEBINTERFACE=False)")
     
-    # Start the proxy in the main thread
-    asyncio.run(start_proxy())
+    # Start the proxy in the main thread, or the workers and their state daemon
+    if settings.PROXY_WORKERS > 1:
+        run_supervisor(settings.PROXY_WORKERS)
+    else:
+        asyncio.run(start_proxy())
@@ -0,0 +1,134 @@
+import math
+import time
+from mitmproxy import http
+
+import metrics
+from config import current, get_flow_config
+from detection.login_detection import get_login_info
+from detection.token_buckets import TokenBuckets
+from request_view import get_request_view, BLOCK_REASON_KEY
+from waf_logger import get_logger
+
+_log = get_logger("rate_limit")
+_blocked_log = get_logger("blocked")
+
+# One set of buckets per client IP, per client IP and domain, and per
+# client IP and path class. Buckets of a path class are kept while the
+# class stays configured, even if its rate is changed.
+IP_BUCKETS = TokenBuckets(current().RATE_LIMIT_MAX_KEYS)
+DOMAIN_BUCKETS = TokenBuckets(current().RATE_LIMIT_MAX_KEYS)
+PATH_BUCKETS = {}  # Path prefix -> TokenBuckets
+
+class PathClass:
+    """
+    A RATE_LIMIT_PATH_CLASSES entry, "prefix=rate/burst"
+    """
+    __slots__ = ("prefix", "interval", "tolerance", "buckets", "reason")
+
+    def __init__(self, entry, max_keys):
+        prefix, separator, limit = entry.rpartition("=")
+        rate, _, burst = limit.partition("/")
+        if not separator or not prefix.startswith("/"):
+            raise ValueError(f"expected \"/prefix=rate/burst\", got {entry!r}")
+        if float(rate) <= 0:
+            raise ValueError(f"the rate of {entry!r} must be above 0")
+        self.prefix = prefix
+        self.interval = 1 / float(rate)
+        self.tolerance = (max(1, int(burst or 1)) - 1) * self.interval
+        self.buckets = PATH_BUCKETS.get(prefix)
+        if self.buckets is None:
+            self.buckets = PATH_BUCKETS[prefix] = TokenBuckets(max_keys)
+        self.buckets.max_keys = max_keys
+        self.reason = f"client/rate_limit:{prefix}"
+
+# The settings the limits below were worked out from
+_limits_config = None
+_ip_limit = None  # (interval, tolerance) of TokenBuckets.take, or None when there is no limit
+_domain_limit = None
+_path_classes = ()
+
+def _limit(rate, burst):
+    if rate <= 0:
+        return None
+    interval = 1 / rate
+    return interval, (max(1, int(burst)) - 1) * interval
+
+def _sync_limits(config):
+    """
+    Work out the limits from the settings, only when they were replaced
+    """
+    global _limits_config, _ip_limit, _domain_limit, _path_classes
+    if _limits_config is config:
+        return
+    IP_BUCKETS.max_keys = DOMAIN_BUCKETS.max_keys = config.RATE_LIMIT_MAX_KEYS
+    _ip_limit = _limit(config.RATE_LIMIT_IP, config.RATE_LIMIT_IP_BURST)
+    _domain_limit = _limit(config.RATE_LIMIT_DOMAIN, config.RATE_LIMIT_DOMAIN_BURST)
+    path_classes = []
+    for entry in config.RATE_LIMIT_PATH_CLASSES:
+        try:
+            path_classes.append(PathClass(entry, config.RATE_LIMIT_MAX_KEYS))
+        except ValueError as e:
+            _log.error("Ignoring rate limit path class: %s", e)
+    # Longest prefix first, so the most specific class applies
+    path_classes.sort(key=lambda path_class: len(path_class.prefix), reverse=True)
+    prefixes = {path_class.prefix for path_class in path_classes}
+    for prefix in [prefix for prefix in PATH_BUCKETS if prefix not in prefixes]:
+        del PATH_BUCKETS[prefix]
+    _path_classes = tuple(path_classes)
+    _limits_config = config
+
+def check_rate_limit(flow):
+    """
+    Take a token from each bucket of the request, in order: its client IP,
+    its client IP and domain, and its client IP and path class.
+    Returns True, with a 429 response set, at the first empty one.
+    """
+    config = get_flow_config(flow)
+    if not config.ENABLE_RATE_LIMITING:
+        return False
+    _sync_limits(config)
+
+    info = get_login_info(flow)
+    now = time.monotonic()
+    wait = 0
+    if _ip_limit is not None:
+        wait = IP_BUCKETS.take(info.client_ip, now, *_ip_limit)
+        reason = "client/rate_limit:ip"
+    if not wait and _domain_limit is not None:
+        wait = DOMAIN_BUCKETS.take((info.client_ip, info.domain), now, *_domain_limit)
+        reason = "client/rate_limit:domain"
+    if not wait and _path_classes:
+        path = get_request_view(flow).path.raw
+        for path_class in _path_classes:
+            if path.startswith(path_class.prefix):
+                wait = path_class.buckets.take(info.client_ip, now, path_class.interval, path_class.tolerance)
+                reason = path_class.reason
+                break
+    if not wait:
+        return False
+
+    retry_after = math.ceil(wait)
+    flow.metadata[BLOCK_REASON_KEY] = reason
+    flow.response = http.Response.make(
+        429,
+        f"<html><body><h1>429 Too Many Requests</h1><p>Too many requests. Try again in {retry_after} seconds.</p></body></html>".encode(),
+        {"Content-Type": "text/html", "Retry-After": str(retry_after)}
+    )
+    _blocked_log.info("RATE LIMITED: %s from IP %s on %s, retry after %ss", reason.partition(":")[2],
+                      info.client_ip, info.domain, retry_after)
+    return True
+
+def get_rate_limit_stats():
+    """
+    Returns the stats of every set of buckets
+    """
+    stats = {"ip": IP_BUCKETS.get_stats(), "domain": DOMAIN_BUCKETS.get_stats()}
+    for prefix, buckets in list(PATH_BUCKETS.items()):
+        stats[prefix] = buckets.get_stats()
+    return stats
+
+def _collect_rate_limit_metrics():
+    return [("waf_rate_limit_keys", (("bucket", name),), stats["tracked_keys"])
+            for name, stats in get_rate_limit_stats().items()]
+
+metrics.register_collector(_collect_rate_limit_metrics)
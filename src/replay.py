@@ -0,0 +1,290 @@
+"""
+Offline replay of recorded requests through the blocking rules.
+
+    python src/replay.py log/log_requests.txt capture.har flows.mitm --save run.jsonl
+    python src/replay.py log/log_requests.txt --diff run.jsonl
+
+Reads request log files (log_requests.txt), mitmproxy flow dumps and HAR
+files, runs every request through apply_blocking_rules in a process pool
+and prints how often each rule fired. --save writes the blocked requests
+to a JSON lines file; --diff compares the run with such a file, which
+shows what a rule change would block differently before it is rolled out.
+"""
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import sys
+import time
+from ast import literal_eval
+from collections import Counter, deque
+from itertools import islice
+
+from mitmproxy import connection, http
+
+# Recorded requests carry no client address; they are all replayed from this one
+REPLAY_CLIENT_IP = "192.0.2.1"
+
+# Requests handed to a worker process at a time
+BATCH_SIZE = 500
+
+def split_request_log(path):
+    """
+    Yields the text of each record in a request log file
+
+    Records are separated by a blank line followed by "Request: ". A body
+    that itself contains such a line splits its record in two.
+    """
+    with open(path, encoding="utf-8", errors="replace") as log_file:
+        lines = []
+        previous_blank = True
+        for line in log_file:
+            if line.startswith("Request: ") and previous_blank:
+                if lines:
+                    yield "".join(lines)
+                lines = []
+            if lines or line.startswith("Request: "):
+                lines.append(line)
+            previous_blank = line == "\n"
+        if lines:
+            yield "".join(lines)
+
+def parse_log_record(text):
+    """
+    Returns (method, url, header_fields, content) of a request log record
+    """
+    request_line, _, rest = text.partition("\n")
+    method, _, url = request_line[len("Request: "):].partition(" ")
+    header_fields = []
+    if rest.startswith("Header: Headers["):
+        header_line, _, rest = rest.partition("\n")
+        header_fields = literal_eval(header_line[len("Header: Headers"):])
+    content = rest[len("Content: "):] if rest.startswith("Content: ") else ""
+    # The logged body is already decoded; only the record separator follows it
+    if content.endswith("\n\n"):
+        content = content[:-2]
+    header_fields = [(name, value) for name, value in header_fields if name.lower() != b"content-encoding"]
+    return method, url, header_fields, content.encode("utf-8")
+
+def read_flow_dump(path):
+    """
+    Yields (method, url, header_fields, content) from a mitmproxy flow dump
+    """
+    from mitmproxy.io import FlowReader
+
+    with open(path, "rb") as dump_file:
+        for flow in FlowReader(dump_file).stream():
+            request = getattr(flow, "request", None)
+            if request is None:
+                continue
+            yield request.method, request.url, list(request.headers.fields), request.raw_content or b""
+
+def read_har(path):
+    """
+    Yields (method, url, header_fields, content) from a HAR file
+    """
+    with open(path, encoding="utf-8") as har_file:
+        har = json.load(har_file)
+    for entry in har.get("log", {}).get("entries", []):
+        request = entry.get("request", {})
+        header_fields = [(header["name"].encode(), header["value"].encode())
+                         for header in request.get("headers", [])
+                         if not header["name"].startswith(":")]  # HTTP/2 pseudo headers
+        post_data = request.get("postData") or {}
+        text = post_data.get("text") or ""
+        if post_data.get("encoding") == "base64":
+            content = base64.b64decode(text)
+        else:
+            content = text.encode("utf-8")
+        yield request.get("method", "GET"), request.get("url", ""), header_fields, content
+
+def read_requests(path):
+    """
+    Pick the reader for a file from its extension or first bytes
+    Request log records are yielded as text and parsed by the workers
+    """
+    if path.lower().endswith(".har"):
+        return read_har(path)
+    with open(path, "rb") as f:
+        start = f.read(16)
+    if start.startswith(b"Request: "):
+        return split_request_log(path)
+    if start.lstrip().startswith(b"{"):
+        return read_har(path)
+    return read_flow_dump(path)
+
+def _init_worker():
+    """
+    Worker process setup: no files, no persisted blocks and no console output
+    """
+    import config
+    config.publish({"STATE_BACKEND": "memory", "ENABLE_LOGGING": False, "LOG_LEVEL": "ERROR"}, source="replay")
+    import security_utils  # Compiles the signatures once per worker
+
+def make_flow(method, url, header_fields, content):
+    client = connection.Client(peername=(REPLAY_CLIENT_IP, 0), sockname=("0.0.0.0", 0))
+    server = connection.Server(address=None)
+    flow = http.HTTPFlow(client, server)
+    flow.request = http.Request.make(method, url, content, header_fields)
+    return flow
+
+def scan_batch(batch):
+    """
+    Run the blocking rules on a list of (key, record) pairs
+    Returns (key, method, url, reason) for the blocked ones and the number scanned
+    """
+    from security_utils import apply_blocking_rules, BLOCK_REASON_KEY
+
+    blocked = []
+    for key, record in batch:
+        try:
+            if isinstance(record, str):
+                record = parse_log_record(record)
+            method, url, header_fields, content = record
+            flow = make_flow(method, url, header_fields, content)
+        except (ValueError, TypeError, SyntaxError):
+            # e.g. a URL or header the recording mangled
+            line = record.partition("\n")[0] if isinstance(record, str) else f"{record[0]} {record[1]}"
+            blocked.append((key, "", line[:200], "error/unparsable"))
+            continue
+        try:
+            if apply_blocking_rules(flow):
+                blocked.append((key, method, url, flow.metadata.get(BLOCK_REASON_KEY, "unknown")))
+        except Exception:
+            # One request the rules cannot handle must not end the replay;
+            # in the proxy it would have gone through uninspected
+            blocked.append((key, method, url, "error/scan_failed"))
+    return blocked, len(batch)
+
+def _batches(paths, limit):
+    """
+    Yields lists of (key, record) pairs, the key being "file name:index"
+    """
+    def records():
+        for path in paths:
+            name = os.path.basename(path)
+            for index, record in enumerate(read_requests(path)):
+                yield f"{name}:{index}", record
+
+    source = records() if limit is None else islice(records(), limit)
+    while True:
+        batch = list(islice(source, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+def replay(paths, workers, limit=None):
+    """
+    Returns the number of requests scanned and a dict of key -> (method, url, reason)
+    for the blocked ones
+    """
+    total = 0
+    blocked = {}
+
+    def collect(result):
+        nonlocal total
+        batch_blocked, scanned = result
+        total += scanned
+        for key, method, url, reason in batch_blocked:
+            blocked[key] = (method, url, reason)
+
+    if workers <= 1:
+        _init_worker()
+        for batch in _batches(paths, limit):
+            collect(scan_batch(batch))
+        return total, blocked
+
+    pool = multiprocessing.get_context("spawn").Pool(workers, initializer=_init_worker)
+    try:
+        # A few batches per worker in flight, so the input is never read far ahead
+        pending = deque()
+        for batch in _batches(paths, limit):
+            pending.append(pool.apply_async(scan_batch, (batch,)))
+            if len(pending) >= workers * 4:
+                collect(pending.popleft().get())
+        while pending:
+            collect(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return total, blocked
+
+def save_results(path, inputs, total, blocked):
+    with open(path, "w") as f:
+        f.write(json.dumps({"inputs": inputs, "total": total}) + "\n")
+        for key in sorted(blocked):
+            method, url, reason = blocked[key]
+            f.write(json.dumps({"key": key, "method": method, "url": url, "reason": reason}) + "\n")
+
+def load_results(path):
+    with open(path) as f:
+        meta = json.loads(f.readline())
+        blocked = {}
+        for line in f:
+            record = json.loads(line)
+            blocked[record["key"]] = (record["method"], record["url"], record["reason"])
+    return meta, blocked
+
+def print_summary(total, blocked, elapsed):
+    rate = total / elapsed if elapsed else 0.0
+    print(f"Scanned {total} requests in {elapsed:.1f}s ({rate:.0f}/s), blocked {len(blocked)}")
+    if not blocked:
+        return
+    print(f"\n{'rule':<40} {'hits':>10}")
+    for reason, count in Counter(reason for _, _, reason in blocked.values()).most_common():
+        print(f"{reason:<40} {count:>10}")
+
+def print_diff(previous_meta, previous, total, blocked, examples):
+    """
+    Print what is blocked differently than in the previous run
+    Returns True if there are differences
+    """
+    if previous_meta.get("total") != total:
+        print(f"\nWarning: the previous run scanned {previous_meta.get('total')} requests, this one {total}")
+    newly_blocked = sorted(key for key in blocked if key not in previous)
+    unblocked = sorted(key for key in previous if key not in blocked)
+    changed = sorted(key for key in blocked if key in previous and blocked[key][2] != previous[key][2])
+
+    print(f"\nCompared to the previous run: {len(newly_blocked)} newly blocked, "
+          f"{len(unblocked)} no longer blocked, {len(changed)} blocked by a different rule")
+    sections = [
+        ("Newly blocked", newly_blocked, lambda key: blocked[key][2]),
+        ("No longer blocked", unblocked, lambda key: f"was {previous[key][2]}"),
+        ("Different rule", changed, lambda key: f"{previous[key][2]} -> {blocked[key][2]}"),
+    ]
+    for title, keys, describe in sections:
+        if not keys:
+            continue
+        print(f"\n{title}:")
+        for reason, count in Counter(describe(key) for key in keys).most_common():
+            print(f"  {reason:<50} {count:>8}")
+        for key in keys[:examples]:
+            method, url, _ = blocked.get(key) or previous[key]
+            print(f"    {key}  {method} {url[:120]}")
+    return bool(newly_blocked or unblocked or changed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded requests through the WAF rules")
+    parser.add_argument("inputs", nargs="+", help="request logs, mitmproxy flow dumps or HAR files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--limit", type=int, help="only replay this many requests")
+    parser.add_argument("--save", help="write the blocked requests to this JSON lines file")
+    parser.add_argument("--diff", help="compare with the blocked requests of an earlier run")
+    parser.add_argument("--examples", type=int, default=5, help="requests listed per kind of difference")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    total, blocked = replay(args.inputs, args.workers, args.limit)
+    print_summary(total, blocked, time.monotonic() - start)
+
+    if args.save:
+        save_results(args.save, args.inputs, total, blocked)
+        print(f"\nBlocked requests written to {args.save}")
+    if args.diff:
+        previous_meta, previous = load_results(args.diff)
+        if print_diff(previous_meta, previous, total, blocked, args.examples):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+from functools import cached_property
+from urllib.parse import unquote, parse_qsl
+
+# Key under which the view is stored in flow.metadata
+REQUEST_VIEW_KEY = "waf_request_view"
+
+# Key under which the rule that blocked a request is stored in flow.metadata,
+# as "location/rule", e.g. "query/sql:3" or "header/cookie_command"
+BLOCK_REASON_KEY = "waf_block_reason"
+
+class InspectedText:
+    """
+    A single input value together with its URL-decoded and lowercased forms.
+    Each form is computed at most once, the first time a detector asks for it.
+    """
+    __slots__ = ("raw", "_decoded", "_folded")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._decoded = None
+        self._folded = None
+
+    @property
+    def decoded(self):
+        if self._decoded is None:
+            self._decoded = unquote(self.raw)
+        return self._decoded
+
+    @property
+    def folded(self):
+        if self._folded is None:
+            self._folded = self.decoded.lower()
+        return self._folded
+
+    def __str__(self):
+        return self.raw
+
+class RequestView:
+    """
+    Normalized view of everything in a request that the detectors inspect.
+    Every location is decoded and split once per flow; the body is only read
+    when one of the body properties is first used.
+    """
+    def __init__(self, flow):
+        self._request = flow.request
+
+    @cached_property
+    def method(self):
+        return self._request.method
+
+    @cached_property
+    def url(self):
+        return InspectedText(self._request.url)
+
+    @cached_property
+    def path(self):
+        return InspectedText(self._request.path)
+
+    @cached_property
+    def query(self):
+        """List of (name, InspectedText) for every query parameter"""
+        return [(name, InspectedText(value)) for name, value in self._request.query.items(multi=True)]
+
+    @cached_property
+    def headers(self):
+        """List of (lowercased name, name, InspectedText) for every header"""
+        # Same result as headers.items() - repeated headers joined with ", " -
+        # without its lookup of every name in all fields
+        grouped = {}
+        for name, value in self._request.headers.fields:
+            name = name.decode("utf-8", "surrogateescape")
+            value = value.decode("utf-8", "surrogateescape")
+            key = name.lower()
+            entry = grouped.get(key)
+            if entry is None:
+                grouped[key] = (name, [value])
+            else:
+                entry[1].append(value)
+        return [(key, name, InspectedText(values[0] if len(values) == 1 else ", ".join(values)))
+                for key, (name, values) in grouped.items()]
+
+    @cached_property
+    def content_type(self):
+        return self._request.headers.get("content-type", "").lower()
+
+    @cached_property
+    def body(self):
+        """The raw request body as text, or None if there is no body"""
+        # A body that fails to decode as its Content-Encoding says is
+        # inspected as sent rather than skipped
+        content = self._request.get_content(strict=False)
+        if not content:
+            return None
+        return InspectedText(content.decode('utf-8', errors='ignore'))
+
+    @cached_property
+    def form(self):
+        """List of (name, InspectedText) for every url-encoded form field"""
+        if self.body is None or not self.content_type.startswith("application/x-www-form-urlencoded"):
+            return []
+        return [(name, InspectedText(value)) for name, value in parse_qsl(self.body.raw, keep_blank_values=True)]
+
+def get_request_view(flow):
+    """
+    Returns the RequestView for the flow, creating it on first use
+    """
+    view = flow.metadata.get(REQUEST_VIEW_KEY)
+    if view is None:
+        view = RequestView(flow)
+        flow.metadata[REQUEST_VIEW_KEY] = view
+    return view
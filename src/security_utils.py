@@ -1,153 +1,161 @@
 from mitmproxy import http
-from urllib.parse import parse_qs
 
-from detection.sql_injection import detect_sql_injection
-from detection.command_injection import detect_command_injection, is_common_user_agent
-from detection.test_string import detect_test_string
-from brute_force import check_brute_force, is_standard_cookie_format
-from variables import SUSPICIOUS_COOKIE_TERMS
+import metrics
+from config import current, get_flow_config
+from detection.rules import get_rules
+from detection.verdict_cache import VerdictCache, MISS
+from brute_force import check_brute_force
+from detection.login_detection import get_client_ip
+from request_view import get_request_view, BLOCK_REASON_KEY
+from waf_logger import get_logger
+
+_log = get_logger("proxy.inspect")
+_blocked_log = get_logger("blocked")
+
+# Header values repeat across requests, so their verdicts are cached.
+# User-Agent and Cookie have their own rules; all other headers share one table.
+HEADER_VERDICTS = VerdictCache(current().VERDICT_CACHE_SIZE, current().VERDICT_CACHE_MAX_VALUE_LENGTH)
+
+def _collect_verdict_cache_metrics():
+    stats = HEADER_VERDICTS.get_stats()
+    return [
+        ("waf_verdict_cache_entries", (), stats["entries"]),
+        ("waf_verdict_cache_lookups_total", (("result", "hit"),), stats["hits"]),
+        ("waf_verdict_cache_lookups_total", (("result", "miss"),), stats["misses"]),
+        ("waf_verdict_cache_evictions_total", (), stats["evictions"]),
+    ]
+
+metrics.register_collector(_collect_verdict_cache_metrics)
+
+def ruleset_version(rules, config):
+    """
+    Version of the rules behind the header verdicts
+    The rule file can be reloaded; term lists taken from settings and the
+    match windows, and the verdict of values they cannot decide, can be
+    changed at runtime
+    """
+    return (rules.cache_version(), config.MAX_MATCH_WINDOW, config.MATCH_WINDOW_OVERLAP,
+            config.MATCH_BUDGET_POLICY)
+
+# The rules and settings the header verdict cache was last set up for
+_cache_inputs = (None, None)
+
+def _sync_header_verdicts(rules, config):
+    """
+    Resize the header verdict cache and drop stale verdicts, only when the
+    rules or the settings were replaced since the last request
+    """
+    global _cache_inputs
+    if _cache_inputs[0] is rules and _cache_inputs[1] is config:
+        return
+    HEADER_VERDICTS.max_entries = config.VERDICT_CACHE_SIZE
+    HEADER_VERDICTS.max_value_length = config.VERDICT_CACHE_MAX_VALUE_LENGTH
+    HEADER_VERDICTS.set_version(ruleset_version(rules, config))
+    _cache_inputs = (rules, config)
+
+def block_request(flow, rules, location, name, value, verdict):
+    """
+    Answer the flow with the response of the rule that fired
+    """
+    rule, found = verdict
+    status, _, content_type = rule.response
+    headers = {"Content-Type": content_type} if content_type else {}
+    flow.response = http.Response.make(status, rules.response_body(location, verdict).encode(), headers)
+    _blocked_log.info("BLOCKED: %s (%s) in %s%s: %s", rule.title, found, location,
+                      f" '{name}'" if name else "", value.raw[:200])
+    flow.metadata[BLOCK_REASON_KEY] = rules.reason(location, verdict)
+
+def _check(flow, rules, location, name, value):
+    verdict = rules.check(location, value)
+    if verdict is None:
+        return False
+    block_request(flow, rules, location, name, value, verdict)
+    return True
 
 def apply_blocking_rules(flow):
     """
     Applies blocking rules to the request and returns True if the request should be blocked.
     """
-    # First check raw URL for teststring (highest priority check)
-    if detect_test_string(flow.request.url):
-        flow.response = http.Response.make(
-            403,
-            b"<html><body><h1>403 Forbidden</h1><p>Test string detected in URL.</p></body></html>",
-            {"Content-Type": "text/html"}
-        )
-        print(f"BLOCKED: Test string detected in URL: {flow.request.url}")
+    return apply_header_rules(flow) or apply_body_rules(flow)
+
+def apply_header_rules(flow):
+    """
+    Applies the rules that only need the request line and headers.
+    Runs before the body is read; returns True if the request should be blocked.
+    """
+    # Every location is decoded once and shared by all rules
+    view = get_request_view(flow)
+    # The active rule set, used for the whole request even if a reload swaps it meanwhile
+    rules = get_rules()
+
+    # First check the raw URL (highest priority check)
+    # The path is part of the URL, so this also covers the path
+    if _check(flow, rules, "url", None, view.url):
         return True
-        
-    # Check raw content string for teststring
-    if flow.request.content:
-        try:
-            raw_content = flow.request.content.decode('utf-8', errors='ignore')
-            if detect_test_string(raw_content):
-                flow.response = http.Response.make(
-                    403,
-                    b"<html><body><h1>403 Forbidden</h1><p>Test string detected in request body.</p></body></html>",
-                    {"Content-Type": "text/html"}
-                )
-                print(f"BLOCKED: Test string detected in raw content")
-                return True
-                
-            # Parse form data if it's url-encoded
-            if flow.request.headers.get("content-type", "") == "application/x-www-form-urlencoded":
-                try:
-                    form_data = parse_qs(raw_content)
-                    for key, values in form_data.items():
-                        for value in values:
-                            if detect_test_string(value):
-                                flow.response = http.Response.make(
-                                    403,
-                                    b"<html><body><h1>403 Forbidden</h1><p>Test string detected in form field.</p></body></html>",
-                                    {"Content-Type": "text/html"}
-                                )
-                                print(f"BLOCKED: Test string detected in form field '{key}': {value}")
-                                return True
-                except Exception as e:
-                    print(f"Error parsing form data: {e}")
-        except Exception as e:
-            print(f"Error decoding request content: {e}")
 
     # Debug output
-    print(f"Checking request: {flow.request.method} {flow.request.url}")
-    
+    _log.debug("Checking request: %s %s", view.method, view.url)
+
     # First check for brute force attempts
-    client_ip = flow.client_conn.address[0]
+    client_ip = get_client_ip(flow)
     should_block, message = check_brute_force(flow)
     if should_block:
         flow.response = http.Response.make(
-            429, 
+            429,
             f"<html><body><h1>429 Too Many Requests</h1><p>{message}</p></body></html>".encode(),
             {"Content-Type": "text/html"}
         )
-        print(f"BLOCKED: Brute force attempt from IP: {client_ip}")
+        _blocked_log.info("BLOCKED: Brute force attempt from IP: %s", client_ip)
+        flow.metadata[BLOCK_REASON_KEY] = "client/brute_force"
         return True
-    
-    # Check form data more reliably
-    if hasattr(flow.request, 'urlencoded_form') and flow.request.urlencoded_form:
-        for form_name, form_value in flow.request.urlencoded_form.items():
-            if detect_sql_injection(form_value) or detect_command_injection(form_value):
-                flow.response = http.Response.make(403, b"Forbidden: Possible injection attack detected in form data")
-                print(f"BLOCKED: Injection attempt detected in form field '{form_name}': {form_value}")
-                return True
-            
-            if detect_test_string(form_value):
-                flow.response = http.Response.make(403, b"Forbidden: Test string detected in form data")
-                print(f"BLOCKED: Test string detected in form field '{form_name}': {form_value}")
-                return True
 
     # Check URL path
-    url_path = flow.request.path
-    if detect_sql_injection(url_path) or detect_command_injection(url_path):
-        flow.response = http.Response.make(403, b"Forbidden: Possible injection attack detected in URL")
-        print(f"BLOCKED: Injection attempt detected in URL: {url_path}")
-        return True
-    if detect_test_string(url_path):
-        flow.response = http.Response.make(403, b"Forbidden: Test string detected in URL")
-        print(f"BLOCKED: Test string detected in URL: {url_path}")
+    if _check(flow, rules, "path", None, view.path):
         return True
-    
+
     # Check query parameters
-    for param_name, param_value in flow.request.query.items():
-        if detect_sql_injection(param_value) or detect_command_injection(param_value):
-            flow.response = http.Response.make(403, b"Forbidden: Possible injection attack detected in query parameters")
-            print(f"BLOCKED: Injection attempt detected in parameter '{param_name}': {param_value}")
-            return True
-        if detect_test_string(param_value):
-            flow.response = http.Response.make(403, b"Forbidden: Test string detected in query parameters")
-            print(f"BLOCKED: Test string detected in parameter '{param_name}': {param_value}")
-            return True
-    
-    # Check headers with special handling for cookies and User-Agent
-    for header, value in flow.request.headers.items():
-        # Skip common headers that don't typically contain user input
-        if header.lower() in ["accept", "accept-encoding", "accept-language", "connection", "cache-control"]:
-            continue
-            
-        # Special handling for User-Agent
-        if header.lower() == "user-agent":
-            # Apply command injection check with user-agent flag
-            if detect_command_injection(value, is_user_agent=True):
-                flow.response = http.Response.make(403, b"Forbidden: Possible command injection in User-Agent")
-                print(f"BLOCKED: Command injection in User-Agent: {value}")
+    if rules.tables["query"]:
+        for param_name, param_value in view.query:
+            if _check(flow, rules, "query", param_name, param_value):
                 return True
+
+    # Check headers, User-Agent and cookies with their own rules
+    _sync_header_verdicts(rules, get_flow_config(flow))
+    for header_key, header, value in view.headers:
+        if header_key in rules.skip_headers:
             continue
-            
-        # Special handling for cookies
-        if header.lower() == "cookie":
-            if not is_standard_cookie_format(value):
-                if detect_sql_injection(value):
-                    flow.response = http.Response.make(403, b"Forbidden: Suspicious SQL pattern in cookies")
-                    print(f"BLOCKED: Suspicious SQL pattern in cookies: {value[:100]}")
-                    return True
-                    
-                for pattern in SUSPICIOUS_COOKIE_TERMS:
-                    if pattern in value.lower():
-                        flow.response = http.Response.make(403, b"Forbidden: Suspicious command in cookies")
-                        print(f"BLOCKED: Suspicious command in cookies: {value[:100]}")
-                        return True
-            continue
-        
-        # Check remaining headers normally
-        if detect_sql_injection(value):
-            flow.response = http.Response.make(403, b"Forbidden: Possible SQL injection in headers")
-            print(f"BLOCKED: SQL Injection in header '{header}': {value}")
-            return True
-            
-        if detect_command_injection(value, is_user_agent=False):
-            flow.response = http.Response.make(403, b"Forbidden: Possible command injection in headers")
-            print(f"BLOCKED: Command Injection in header '{header}': {value}")
-            return True
-            
-        if detect_test_string(value):
-            flow.response = http.Response.make(403, b"Forbidden: Test string detected in headers")
-            print(f"BLOCKED: Test string in header '{header}': {value}")
+
+        location = header_key if header_key in ("user-agent", "cookie") else "header"
+        verdict = HEADER_VERDICTS.get(location, value.raw)
+        if verdict is MISS:
+            verdict = rules.check(location, value)
+            HEADER_VERDICTS.put(location, value.raw, verdict)
+
+        if verdict is not None:
+            block_request(flow, rules, location, header, value, verdict)
             return True
-    
+
     # No injection detected, request not blocked
     return False
+
+def apply_body_rules(flow):
+    """
+    Applies the rules that need the request body.
+    Runs once the body was read; returns True if the request should be blocked.
+    """
+    view = get_request_view(flow)
+    if view.body is None:
+        return False
+    rules = get_rules()
+
+    # Check the raw content string
+    if _check(flow, rules, "body", None, view.body):
+        return True
+
+    # Check form fields if it's url-encoded
+    if rules.tables["form"]:
+        for form_name, form_value in view.form:
+            if _check(flow, rules, "form", form_name, form_value):
+                return True
+
+    return False
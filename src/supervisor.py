@@ -0,0 +1,107 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import metrics
+import config
+from log_handler import clear_logs
+from persistence.ip_blocking import WORKER_ENV, load_blocked_ips
+from persistence.state_backend import set_backend
+from persistence.state_daemon import StateDaemon
+from management_server import set_workers
+from waf_logger import get_logger
+
+_log = get_logger("supervisor")
+
+# Seconds between checks for workers that died
+CHECK_INTERVAL = 1.0
+
+def _interrupt(signum, frame):
+    # Stop on SIGTERM (docker stop, terminate()) the same way as on Ctrl+C
+    raise KeyboardInterrupt
+
+def _report_metrics(state_client, worker_id):
+    """
+    Send the worker's metrics and stats to the state daemon every
+    METRICS_REPORT_INTERVAL
+    """
+    from management_server import get_proxy_stats
+    while True:
+        time.sleep(max(0.5, config.current().METRICS_REPORT_INTERVAL))
+        snapshot = metrics.snapshot() if config.current().ENABLE_METRICS else None
+        try:
+            state_client.report_metrics(worker_id, snapshot, get_proxy_stats())
+        except OSError as e:
+            _log.debug("Could not report metrics to the state daemon: %s", e)
+
+def run_worker(worker_id, socket_path, settings):
+    """
+    Entry point of a worker process: one proxy on the shared port, with its
+    blocks and failed login counters kept by the state daemon. settings are
+    the supervisor's when it started the worker; later changes come from
+    the state daemon.
+    """
+    config.publish(settings, source="supervisor")
+    from persistence.state_client import StateClient
+    from proxy_runner import start_proxy, ReusePortEventLoopPolicy
+
+    state_client = StateClient(socket_path)
+    set_backend(state_client)
+    load_blocked_ips()
+    threading.Thread(target=_report_metrics, args=(state_client, worker_id),
+                     name="metrics-reporter", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    asyncio.set_event_loop_policy(ReusePortEventLoopPolicy())
+    try:
+        asyncio.run(start_proxy(worker_id))
+    except KeyboardInterrupt:
+        pass
+
+def _start_worker(context, worker_id):
+    process = context.Process(target=run_worker,
+                              args=(worker_id, config.current().STATE_SOCKET_PATH, config.current().as_dict()),
+                              name=f"proxy-worker-{worker_id}", daemon=True)
+    process.start()
+    return process
+
+def run_supervisor(worker_count):
+    """
+    Run worker_count proxy processes on port 8080 next to the state daemon,
+    restarting workers that die. Blocks until interrupted.
+    """
+    signal.signal(signal.SIGTERM, _interrupt)
+    clear_logs()
+
+    state_daemon = StateDaemon(config.current().STATE_SOCKET_PATH)
+    state_daemon.start()
+    # The web interface's /metrics includes the series reported by each worker
+    metrics.add_remote_source(state_daemon.get_worker_metrics)
+    # Its stats and reloads are the workers', not the supervisor's
+    set_workers(state_daemon)
+
+    # Workers must not load or write the blocked IPs files (see ip_blocking)
+    os.environ[WORKER_ENV] = "1"
+    # Fresh interpreters: forking would copy the web interface and daemon threads' locks
+    context = multiprocessing.get_context("spawn")
+    workers = {worker_id: _start_worker(context, worker_id) for worker_id in range(1, worker_count + 1)}
+    _log.info("Started %s proxy workers", worker_count)
+
+    try:
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            for worker_id, process in list(workers.items()):
+                if not process.is_alive():
+                    _log.warning("Proxy worker %s exited with code %s, restarting", worker_id, process.exitcode)
+                    workers[worker_id] = _start_worker(context, worker_id)
+    except KeyboardInterrupt:
+        _log.info("Shutting down proxy workers...")
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join(5)
+        state_daemon.close()
@@ -8,12 +8,86 @@ CLEAR_LOGS_ON_START = True
 ENABLE_LOGGING = False  # By default, don't write log files
 ENABLE_IP_BLOCKING = True  # By default, block IPs for brute force attacks
 ENABLE_WEBINTERFACE = False  # By default, start the web interface
+MANAGEMENT_SOCKET_PATH = "/tmp/waf-management.sock"  # Unix socket through which the web interface's process reaches the proxy
+ENABLE_METRICS = True  # Count requests, blocks and stage latencies for the /metrics page
+BLOCKED_BODY_READ_LIMIT = 64 * 1024  # Requests blocked at their headers with a larger body get their connection closed instead of an error page
+
+# Request Body Settings
+STREAM_BODY_THRESHOLD = 1024 * 1024  # Larger request bodies are inspected chunk by chunk while streamed upstream
+MAX_INSPECT_BODY_SIZE = 10 * 1024 * 1024  # Bytes of a streamed request body that are inspected
+OVERSIZED_BODY_POLICY = "allow"  # Beyond MAX_INSPECT_BODY_SIZE: "allow" forwards the rest uninspected, "block" rejects the request
+STREAM_FIELD_LIMIT = 64 * 1024  # Longer form fields of a streamed body are inspected in parts
+
+# Config Settings
+CONFIG_FILE = ""  # JSON file of settings applied over these, e.g. "settings.json" (relative to src/, empty disables)
+CONFIG_RELOAD_INTERVAL = 2.0  # Seconds between checks of CONFIG_FILE for changes (0 disables reloading)
+
+# Worker Settings
+PROXY_WORKERS = 1  # Proxy processes sharing port 8080 (more than 1 starts the supervisor)
+STATE_SOCKET_PATH = "/tmp/waf-state.sock"  # Unix socket of the state daemon shared by the workers
+METRICS_REPORT_INTERVAL = 5.0  # Seconds between metrics reports of each worker to the supervisor
+
+# State Backend Settings
+STATE_BACKEND = "file"  # "memory", "file" (BLOCKED_IPS_FILE) or "redis" to share blocks between WAF nodes
+STATE_REDIS_HOST = "127.0.0.1"  # Redis (or compatible) server for STATE_BACKEND = "redis"
+STATE_REDIS_PORT = 6379
+STATE_REDIS_PREFIX = "waf:"  # Prefix of every Redis key, nodes sharing state use the same prefix
+STATE_FLUSH_INTERVAL = 0.05  # Seconds between pipelined writes of blocks and failed login counts
+
+# Console Logging Settings
+LOG_LEVEL = "INFO"  # DEBUG, INFO, WARNING or ERROR - DEBUG prints every request
+LOG_SAMPLE_RATE = 1.0  # Fraction of DEBUG/INFO messages printed per message type
+LOG_RATE_LIMIT = 50  # Maximum messages per second per message type (0 disables the limit)
+LOG_TYPE_LEVELS = []  # Per message type levels, e.g. ["login=DEBUG"]
+LOG_TYPE_SAMPLE_RATES = []  # Per message type sample rates, e.g. ["proxy.request=0.01"]
+
+# Log Writer Settings
+LOG_QUEUE_SIZE = 10000  # Log records buffered in memory for the writer thread
+LOG_QUEUE_FULL_POLICY = "drop"  # "drop" new records or "block" the proxy when the queue is full
+LOG_BATCH_SIZE = 500  # Maximum number of records written in one batch
+LOG_FLUSH_INTERVAL = 1.0  # Seconds before a partial batch is written
+LOG_MAX_BYTES = 50 * 1024 * 1024  # Rotate a log file at this size (0 disables rotation)
+LOG_BACKUP_COUNT = 5  # Number of rotated files kept per log
+LOG_COMPRESS_ROTATED = True  # gzip rotated log files
 
 # Security Settings
 # Brute Force Protection
 MAX_LOGIN_ATTEMPTS = 5  # Number of failed attempts before blocking
 LOGIN_ATTEMPT_TIMEOUT = 600  # 5 minutes - window for counting attempts
 LOGIN_BLOCK_DURATION = 30  # 30 seconds - how long IPs stay blocked
+LOGIN_TRACKER_MAX_KEYS = 100000  # Maximum (IP, domain) pairs tracked for failed logins, least recently used are dropped
+FAILED_LOGIN_SCAN_BYTES = 64 * 1024  # Bytes of a decoded login response searched for error messages
+FAILED_LOGIN_CONTENT_TYPES = ['text/html', 'text/plain', 'application/json', 'application/xhtml+xml', 'application/problem+json']  # Login responses of other types are not searched
+BLOCKED_IPS_COMPACT_EVERY = 1000  # Journal records before the blocked IPs file is rewritten in the background
+
+# IP List Settings
+IP_BLOCKLIST_FILES = []  # Feeds of networks to block, one "prefix [domain]" per line, e.g. "203.0.113.0/24" or "2001:db8::/32 example.com:443" (relative to src/)
+IP_ALLOWLIST_FILES = []  # Networks that are never blocked, same format; they win over the block list and failed login blocks
+IP_LISTS_RELOAD_INTERVAL = 5.0  # Seconds between checks of the list files for changes (0 disables reloading)
+
+# Rate Limiting Settings
+ENABLE_RATE_LIMITING = False  # Answer clients over the rates below with 429 Too Many Requests and Retry-After
+RATE_LIMIT_IP = 50.0  # Requests per second per client IP (0 disables)
+RATE_LIMIT_IP_BURST = 200  # Requests a client IP may send at once before RATE_LIMIT_IP applies
+RATE_LIMIT_DOMAIN = 20.0  # Requests per second per client IP and domain (0 disables)
+RATE_LIMIT_DOMAIN_BURST = 100  # Requests a client IP may send at once to one domain
+RATE_LIMIT_PATH_CLASSES = []  # Per client IP and path prefix, "prefix=requests per second/burst", e.g. ["/login=0.5/10", "/api/=10/50"]
+RATE_LIMIT_MAX_KEYS = 1000000  # Keys tracked per kind of bucket, idle ones are dropped first (limits apply per proxy worker)
+
+# Verdict Cache Settings
+VERDICT_CACHE_SIZE = 10000  # Header values whose verdict is remembered (0 disables the cache)
+VERDICT_CACHE_MAX_VALUE_LENGTH = 2048  # Longer header values are always inspected
+
+# Rule Settings
+RULES_FILE = "rules.json"  # Signatures and the rules run on each part of a request (relative to src/)
+RULES_RELOAD_INTERVAL = 2.0  # Seconds between checks of RULES_FILE for changes (0 disables reloading)
+
+# Pattern Matching Settings
+REGEX_ENGINE = "re2"  # "re2" matches in linear time (google-re2 package); "re" can backtrack for seconds on a crafted value. Rules RE2 rejects use re. Read when the signatures are compiled
+MAX_MATCH_WINDOW = 0  # With re, longer values are searched in overlapping windows of this many characters (0 disables). Bounds backtracking, but a match longer than a window is missed, so values no window matched get MATCH_BUDGET_POLICY
+MATCH_WINDOW_OVERLAP = 128  # Characters shared by neighbouring windows, matches this long are always found
+MATCH_TIME_BUDGET = 0.05  # Seconds the windowed search of one value may take
+MATCH_BUDGET_POLICY = "block"  # When a windowed value runs out of time, or a signature could match across its windows: "block" the request or "allow" it
 
 # Detection Patterns
 SUSPICIOUS_COOKIE_TERMS = ['cat ', 'rm -', 'wget ', 'curl ', 'bash ', '/etc/', '/bin/', '/tmp/']
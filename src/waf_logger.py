@@ -0,0 +1,160 @@
+import logging
+import sys
+import time
+
+import variables
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+_LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+# All WAF messages end up on this standard logger, printed to stdout
+_output = logging.getLogger("waf")
+_output.propagate = False
+if not _output.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(message)s"))
+    _output.addHandler(_handler)
+_output.setLevel(DEBUG)
+
+def _parse_level(name, default=INFO):
+    return _LEVELS.get(str(name).strip().upper(), default)
+
+def _parse_type_level(value):
+    level = _LEVELS.get(value.strip().upper())
+    if level is None:
+        raise ValueError(f"Unknown log level: {value}")
+    return level
+
+def _parse_overrides(entries, convert):
+    """
+    Parse ["type=value", ...] settings into a dict
+    """
+    overrides = {}
+    for entry in entries:
+        name, sep, value = str(entry).partition("=")
+        if not sep:
+            continue
+        try:
+            overrides[name.strip()] = convert(value)
+        except ValueError:
+            continue
+    return overrides
+
+class _Settings:
+    """
+    Logging settings parsed from the variables module
+    """
+    def __init__(self):
+        self.level = _parse_level(variables.LOG_LEVEL)
+        self.sample_rate = float(variables.LOG_SAMPLE_RATE)
+        self.rate_limit = int(variables.LOG_RATE_LIMIT)
+        self.type_levels = _parse_overrides(variables.LOG_TYPE_LEVELS, _parse_type_level)
+        self.type_sample_rates = _parse_overrides(variables.LOG_TYPE_SAMPLE_RATES, float)
+
+_settings = _Settings()
+
+def reload_settings():
+    """
+    Re-read the logging settings after they were changed at runtime
+    """
+    global _settings
+    _settings = _Settings()
+
+class WafLogger:
+    """
+    Logger for one type of message (e.g. "proxy.request" or "blocked").
+
+    Messages use %-style arguments that are only formatted when the message is
+    actually written, so a disabled call costs two compares.
+    DEBUG and INFO messages can be sampled (LOG_SAMPLE_RATE, or per type via
+    LOG_TYPE_SAMPLE_RATES), and every type is limited to LOG_RATE_LIMIT
+    messages per second; suppressed messages are counted and reported.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._settings = None
+        self._level = INFO
+        self._sample_every = 1
+        self._rate_limit = 0
+        self._seen = 0
+        self._window = 0
+        self._window_count = 0
+        self._suppressed = 0
+
+    def _refresh(self):
+        settings = _settings
+        if settings is self._settings:
+            return
+        self._settings = settings
+        self._level = settings.type_levels.get(self.name, settings.level)
+        rate = settings.type_sample_rates.get(self.name, settings.sample_rate)
+        # Keep every n-th message; a rate of 0 drops all sampled messages
+        self._sample_every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._rate_limit = max(0, settings.rate_limit)
+
+    def is_enabled_for(self, level):
+        self._refresh()
+        return level >= self._level
+
+    def debug(self, msg, *args):
+        # Fast path for the common case of debug output being switched off
+        if self._level > DEBUG and self._settings is _settings:
+            return
+        self._refresh()
+        if self._level <= DEBUG:
+            self._log(DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        if self._level > INFO and self._settings is _settings:
+            return
+        self._refresh()
+        if self._level <= INFO:
+            self._log(INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self._refresh()
+        if self._level <= WARNING:
+            self._log(WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self._refresh()
+        if self._level <= ERROR:
+            self._log(ERROR, msg, args)
+
+    def _log(self, level, msg, args):
+        if level < WARNING:
+            if self._sample_every == 0:
+                return
+            self._seen += 1
+            if self._seen % self._sample_every:
+                return
+
+        if self._rate_limit:
+            window = int(time.monotonic())
+            if window != self._window:
+                if self._suppressed:
+                    _output.warning("%s: %d messages suppressed by rate limit", self.name, self._suppressed)
+                self._window = window
+                self._window_count = 0
+                self._suppressed = 0
+            self._window_count += 1
+            if self._window_count > self._rate_limit:
+                self._suppressed += 1
+                return
+
+        _output.log(level, msg, *args)
+
+_loggers = {}
+
+def get_logger(name):
+    """
+    Returns the logger for a message type, creating it on first use
+    """
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers.setdefault(name, WafLogger(name))
+    return logger
@@ -1,202 +1,225 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify
+import atexit
 import os
-import json
-import importlib
+import subprocess
+import sys
 import threading
 import time
 
-# Import the variables module which contains all the settings
-import variables
+from management_client import ManagementClient, ManagementError
+from waf_logger import get_logger
 
-# For IP blocking management
-from persistence.ip_blocking import blocked_ips, save_blocked_ips
+# The web interface runs in its own process: it only reaches the proxy
+# through the management server's socket (see management_server), so
+# serving browsers never competes with the proxy for its interpreter.
+
+_log = get_logger("web")
 
 app = Flask(__name__, template_folder='templates')
 app.secret_key = 'waf_secret_key'  # Required for flash messages
 
+# Set by start_web_server
+management = None
+
 # Keep track of the original values to highlight changes
-original_values = {}
-for var in dir(variables):
-    if not var.startswith('__'):
-        original_values[var] = getattr(variables, var)
+original_values = None
+
+# Seconds between checks that the process that started the web interface is alive
+PARENT_CHECK_INTERVAL = 1.0
+
+@app.errorhandler(OSError)
+def proxy_unreachable(error):
+    """The proxy is not running or not answering"""
+    return Response(f'The proxy cannot be reached: {error}', status=503, mimetype='text/plain')
 
 @app.route('/')
 def index():
     """Main page showing current settings and options"""
-    # Get current values of all variables
-    settings = {}
-    for var in dir(variables):
-        if not var.startswith('__'):
-            settings[var] = getattr(variables, var)
-    
-    # Count number of blocked IPs
-    blocked_count = len(blocked_ips)
-    
-    # Get log file sizes
-    log_sizes = {
-        'requests': get_file_size(variables.REQUEST_LOG_PATH),
-        'responses': get_file_size(variables.RESPONSE_LOG_PATH),
-        'pcap': get_file_size(variables.PCAP_LOG_PATH),
-        'blocked_ips': get_file_size(variables.BLOCKED_IPS_FILE)
-    }
-    
-    return render_template('index.html', 
-                          settings=settings, 
+    global original_values
+    status = management.request('status')
+    settings = status['settings']
+    if original_values is None:
+        original_values = settings
+
+    return render_template('index.html',
+                          settings=settings,
+                          config=dict(settings, **status['config']),
                           original_values=original_values,
-                          blocked_count=blocked_count,
-                          log_sizes=log_sizes)
+                          blocked_count=status['blocked_count'],
+                          state_stats=status['state_stats'],
+                          verdict_cache_stats=status['verdict_cache_stats'],
+                          rule_stats=status['rule_stats'],
+                          rate_limit_stats=status['rate_limit_stats'],
+                          ip_list_stats=status['ip_list_stats'],
+                          workers=status['workers'],
+                          log_sizes=status['log_sizes'])
 
 @app.route('/update_settings', methods=['POST'])
 def update_settings():
-    """Update WAF settings"""
-    changes = []
-    
-    for key, value in request.form.items():
-        if hasattr(variables, key):
-            try:
-                old_value = getattr(variables, key)
-                # Determine the type of the original value and convert accordingly
-                orig_type = type(old_value)
-                if orig_type == int:
-                    new_value = int(value)
-                elif orig_type == float:
-                    new_value = float(value)
-                elif orig_type == bool:
-                    new_value = value.lower() == 'true'
-                elif orig_type == list:
-                    # For simplicity, assume comma-separated values for lists
-                    new_value = [item.strip() for item in value.split(',')]
-                else:
-                    new_value = value
-                
-                setattr(variables, key, new_value)
-                changes.append(f"{key}: {old_value} → {new_value}")
-                flash(f'Successfully updated {key} to {new_value}', 'success')
-            except Exception as e:
-                flash(f'Error updating {key}: {str(e)}', 'error')
-    
-    # Update the original values dictionary
-    for var in dir(variables):
-        if not var.startswith('__'):
-            original_values[var] = getattr(variables, var)
-    
-    # Log the changes for debugging
-    if changes:
-        print("Settings updated:")
-        for change in changes:
-            print(f"  {change}")
-            
+    """Update WAF settings, all at once as a new config version"""
+    global original_values
+    try:
+        result = management.request('update_settings', values=dict(request.form.items()))
+        for message in result['errors']:
+            flash(message, 'error')
+        for key, value in result['updated'].items():
+            flash(f'Successfully updated {key} to {value}', 'success')
+        # Update the original values dictionary
+        original_values = result['settings']
+    except ManagementError as e:
+        flash(f'Error updating settings: {str(e)}', 'error')
+
     return redirect(url_for('index'))
 
 @app.route('/reset_logs', methods=['POST'])
 def reset_logs():
     """Reset log files"""
     try:
-        log_type = request.form.get('log_type', 'all')
-        
-        if log_type == 'requests' or log_type == 'all':
-            clear_file(variables.REQUEST_LOG_PATH)
-            flash('Request logs cleared successfully', 'success')
-            
-        if log_type == 'responses' or log_type == 'all':
-            clear_file(variables.RESPONSE_LOG_PATH)
-            flash('Response logs cleared successfully', 'success')
-            
-        if log_type == 'pcap' or log_type == 'all':
-            clear_file(variables.PCAP_LOG_PATH)
-            flash('PCAP logs cleared successfully', 'success')
-    except Exception as e:
+        result = management.request('reset_logs', log_type=request.form.get('log_type', 'all'))
+        for log_type in result['cleared']:
+            flash(f'{log_type.capitalize()} logs cleared successfully', 'success')
+    except ManagementError as e:
         flash(f'Error clearing logs: {str(e)}', 'error')
-        
+
+    return redirect(url_for('index'))
+
+def _sent_to(result):
+    """How many workers a reload was passed on to, if there are workers"""
+    if result.get('workers'):
+        return f', reloading in {result["workers"]} workers'
+    return ''
+
+@app.route('/reload_rules', methods=['POST'])
+def reload_rule_file():
+    """Load the rule file again without waiting for the watcher"""
+    try:
+        result = management.request('reload_rules')
+        flash(f'Loaded {result["rules"]} rules, version {result["version"]}{_sent_to(result)}', 'success')
+    except ManagementError as e:
+        flash(f'Error loading the rules, keeping the current ones: {str(e)}', 'error')
+    return redirect(url_for('index'))
+
+@app.route('/reload_ip_lists', methods=['POST'])
+def reload_ip_list_files():
+    """Load the IP block and allow lists again without waiting for the watcher"""
+    try:
+        result = management.request('reload_ip_lists')
+        flash(f'Loaded {result["blocked"]} blocked and {result["allowed"]} allowed networks{_sent_to(result)}', 'success')
+    except ManagementError as e:
+        flash(f'Error loading the IP lists, keeping the current ones: {str(e)}', 'error')
     return redirect(url_for('index'))
 
 @app.route('/clear_blocked_ips', methods=['POST'])
 def clear_blocked_ips():
     """Clear blocked IPs"""
     try:
-        blocked_ips.clear()
-        save_blocked_ips()
+        management.request('clear_blocked_ips')
         flash('Blocked IPs cleared successfully', 'success')
-    except Exception as e:
+    except ManagementError as e:
         flash(f'Error clearing blocked IPs: {str(e)}', 'error')
-        
+
     return redirect(url_for('index'))
 
+def _blocked_page_request():
+    """The page and filters asked for in the query string"""
+    fields = {}
+    for name in ('offset', 'limit'):
+        value = request.args.get(name, '')
+        if value.isdigit():
+            fields[name] = int(value)
+    for name in ('ip', 'domain', 'order'):
+        if request.args.get(name):
+            fields[name] = request.args[name]
+    return fields
+
 @app.route('/view_blocked_ips')
 def view_blocked_ips():
-    """View blocked IPs with time remaining"""
-    current_time = time.time()
-    formatted_ips = {}
-    
-    for key, block_time in blocked_ips.items():
-        time_left = block_time - current_time
-        if time_left > 0:
-            # Parse the key which is in format "ip:domain"
-            parts = key.split(':', 1)
-            ip = parts[0]
-            domain = parts[1] if len(parts) > 1 else 'unknown'
-            
-            # Format time left in minutes and seconds
-            minutes = int(time_left // 60)
-            seconds = int(time_left % 60)
-            time_str = f"{minutes}m {seconds}s"
-            
-            formatted_ips[key] = {
-                'ip': ip,
-                'domain': domain,
-                'time_left': time_str,
-                'raw_time_left': time_left
-            }
-    
-    return render_template('blocked_ips.html', blocked_ips=formatted_ips)
+    """View one page of blocked IPs with time remaining"""
+    fields = _blocked_page_request()
+    try:
+        page = management.request('blocked_ips', **fields)
+    except ManagementError as e:
+        flash(f'Error listing blocked IPs: {str(e)}', 'error')
+        return redirect(url_for('index'))
+
+    for block in page['blocks']:
+        # Format time left in minutes and seconds
+        minutes = int(block['time_left'] // 60)
+        seconds = int(block['time_left'] % 60)
+        block['time_left'] = f"{minutes}m {seconds}s"
+
+    # Links to the neighbouring pages keep the filters
+    filters = {name: fields[name] for name in ('ip', 'domain', 'order', 'limit') if name in fields}
+    previous_url = next_url = None
+    if page['offset'] > 0:
+        previous_url = url_for('view_blocked_ips', offset=max(0, page['offset'] - page['limit']), **filters)
+    if page['offset'] + page['limit'] < page['total']:
+        next_url = url_for('view_blocked_ips', offset=page['offset'] + page['limit'], **filters)
+
+    return render_template('blocked_ips.html', page=page, filters=filters,
+                           previous_url=previous_url, next_url=next_url)
 
 @app.route('/unblock_ip', methods=['POST'])
 def unblock_ip():
     """Unblock a specific IP"""
     try:
         key = request.form.get('key')
-        if key in blocked_ips:
-            del blocked_ips[key]
-            save_blocked_ips()
+        if management.request('unblock', key=key)['unblocked']:
             flash(f'Successfully unblocked {key}', 'success')
         else:
             flash(f'IP {key} not found in blocked list', 'error')
-    except Exception as e:
+    except ManagementError as e:
         flash(f'Error unblocking IP: {str(e)}', 'error')
-        
-    return redirect(url_for('view_blocked_ips'))
 
-def get_file_size(filepath):
-    """Get the size of a file in human-readable format"""
+    return redirect(request.referrer or url_for('view_blocked_ips'))
+
+@app.route('/api/status')
+def api_status():
+    """Settings and stats as JSON"""
+    return jsonify(management.request('status'))
+
+@app.route('/api/blocked_ips')
+def api_blocked_ips():
+    """
+    One page of blocked IPs as JSON
+    Query: offset, limit, ip (address or CIDR), domain (substring), order (newest or oldest)
+    """
     try:
-        if os.path.exists(filepath):
-            size_bytes = os.path.getsize(filepath)
-            # Convert to KB, MB, etc.
-            for unit in ['B', 'KB', 'MB', 'GB']:
-                if size_bytes < 1024.0:
-                    return f"{size_bytes:.2f} {unit}"
-                size_bytes /= 1024.0
-            return f"{size_bytes:.2f} TB"
-        return "0 B"
-    except Exception:
-        return "Error"
-
-def clear_file(filepath):
-    """Clear the contents of a file"""
-    with open(filepath, 'w') as f:
-        pass
-
-def start_web_server():
-    """Start the web server in a separate thread"""
+        return jsonify(management.request('blocked_ips', **_blocked_page_request()))
+    except ManagementError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Metrics in the Prometheus text format"""
+    return Response(management.request('metrics')['text'], mimetype='text/plain; version=0.0.4')
+
+def _exit_with_parent(parent_pid):
+    # Do not outlive the proxy, even if it was killed without stopping us
+    while True:
+        time.sleep(PARENT_CHECK_INTERVAL)
+        if os.getppid() != parent_pid:
+            os._exit(0)
+
+def start_web_server(socket_path, parent_pid=None):
+    """Serve the web interface in this process, reaching the proxy at socket_path"""
+    global management
+    management = ManagementClient(socket_path)
+    if parent_pid is not None:
+        threading.Thread(target=_exit_with_parent, args=(parent_pid,), name="parent-check", daemon=True).start()
     app.run(host='0.0.0.0', port=80, debug=False)
 
-def run_web_interface():
-    """Start the web interface in a separate thread"""
-    web_thread = threading.Thread(target=start_web_server)
-    web_thread.daemon = True
-    web_thread.start()
-    print("Web interface started on port 80")
-    return web_thread
+def run_web_interface(socket_path):
+    """Start the web interface in its own process"""
+    web_process = subprocess.Popen([sys.executable, os.path.abspath(__file__), socket_path, str(os.getpid())])
+    atexit.register(web_process.terminate)
+    _log.info("Web interface started on port 80 (process %s)", web_process.pid)
+    return web_process
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=80, debug=True)
+    # python web_interface.py [management socket] [pid to exit with]
+    if len(sys.argv) > 1:
+        start_web_server(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    else:
+        from config import current
+        start_web_server(current().MANAGEMENT_SOCKET_PATH)
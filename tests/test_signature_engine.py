@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+pytest.importorskip("re2")
+
+from detection.rules import load_rules
+from request_view import InspectedText
+
+# A value the backtracking "OR ... =" signature takes seconds on with re
+CRAFTED_HEADER = "'OR" * 2666
+# A long search Referer with the literals of the same signature
+BENIGN_REFERER = ("https://www.example.com/search?q="
+                  + "selection of information for ordering products online and more " * 13)
+
+def _check_header(value):
+    # The default settings, as shipped
+    rule_set = load_rules()
+    start = time.perf_counter()
+    verdict = rule_set.check("header", InspectedText(value))
+    return verdict, time.perf_counter() - start
+
+def test_crafted_header_is_decided_in_bounded_time():
+    verdict, elapsed = _check_header(CRAFTED_HEADER)
+    assert verdict is None
+    assert elapsed < 0.1
+
+def test_long_benign_referer_passes():
+    assert len(BENIGN_REFERER) > 800
+    verdict, _ = _check_header(BENIGN_REFERER)
+    assert verdict is None
+
+def test_injection_is_still_caught():
+    verdict, _ = _check_header("x' OR 1=1 --")
+    assert verdict is not None